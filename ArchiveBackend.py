@@ -0,0 +1,113 @@
+import abc
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from Tracing import span
+
+COPY_CHUNK_SIZE = 16*1024*1024
+
+
+class ArchiveBackend(metaclass=abc.ABCMeta):
+    """录像归档后端。
+
+    upload 把文件和目录展开成单个文件后用线程池并发上传，目录中的文件保留在以目录名命名的子目录下。
+    具体后端只需实现 upload_file，大文件的分块由后端自己完成。
+    """
+
+    def __init__(self, max_workers: int = 2):
+        self.max_workers = max_workers
+
+    @abc.abstractmethod
+    def upload_file(self, local_path: str, remote_path: str) -> None:
+        pass
+
+    def __expand(self, paths: List[str]) -> List[Tuple[str, str]]:
+        files = []
+        for path in paths:
+            if os.path.isfile(path):
+                files.append((path, os.path.basename(path)))
+            elif os.path.isdir(path):
+                for root, _, filenames in os.walk(path):
+                    for filename in filenames:
+                        local_path = os.path.join(root, filename)
+                        files.append((local_path, os.path.join(os.path.basename(os.path.normpath(path)),
+                                                               os.path.relpath(local_path, path)).replace(os.sep, "/")))
+        return files
+
+    def __upload_one(self, local_path: str, remote_path: str) -> None:
+        size = os.path.getsize(local_path)
+        start = time.time()
+        with span('archive', 'upload', path=local_path, size=size):
+            self.upload_file(local_path, remote_path)
+        elapsed = time.time()-start
+        logging.info("归档完成：%s -> %s %.1fMB 用时 %.1f 秒", local_path, remote_path,
+                     size/1024/1024, elapsed)
+
+    def upload(self, paths: List[str], skip=None) -> Tuple[List[str], List[str]]:
+        """并发上传 paths 中的文件和目录，返回上传成功和失败的本地文件，skip(local_path) 为真的文件跳过。"""
+        files = [(local_path, remote_path) for local_path, remote_path in self.__expand(paths)
+                 if skip is None or not skip(local_path)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [(local_path, pool.submit(self.__upload_one, local_path, remote_path))
+                       for local_path, remote_path in files]
+        uploaded = []
+        failed = []
+        for local_path, future in futures:
+            try:
+                future.result()
+                uploaded.append(local_path)
+            except Exception as e:
+                failed.append(local_path)
+                logging.error("归档 %s 时出现错误：%s", local_path, e)
+        return uploaded, failed
+
+
+class BypyBackend(ArchiveBackend):
+    """通过 bypy 归档到百度网盘，大文件由 bypy 按 slice_size 分块上传。"""
+
+    def __init__(self, remote_dir: str, slice_size: int, max_workers: int = 2):
+        super().__init__(max_workers)
+        self.remote_dir = remote_dir
+        self.slice_size = slice_size
+        self.local = threading.local()
+
+    def upload_file(self, local_path: str, remote_path: str) -> None:
+        # ByPy 对象不是线程安全的，每个上传线程各用一个
+        if getattr(self.local, "bypy", None) is None:
+            from bypy import ByPy
+            self.local.bypy = ByPy(slice_size=self.slice_size)
+        ret = self.local.bypy.upload(
+            local_path, self.remote_dir.rstrip("/")+"/"+remote_path)
+        if ret != 0:
+            raise RuntimeError(f"bypy 返回错误码 {ret}")
+
+
+class LocalBackend(ArchiveBackend):
+    """归档到本地目录，可用于挂载的网络存储或测试。"""
+
+    def __init__(self, root_dir: str, max_workers: int = 2):
+        super().__init__(max_workers)
+        self.root_dir = root_dir
+
+    def upload_file(self, local_path: str, remote_path: str) -> None:
+        target = os.path.join(self.root_dir, remote_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = target+".part"
+        with open(local_path, "rb") as src, open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        os.replace(tmp_path, target)
+
+
+def get_archive_backend(config: dict) -> ArchiveBackend:
+    archive_config = config['root']['archive']
+    if archive_config['backend'] == 'bypy':
+        return BypyBackend(archive_config['remote_path'], archive_config['slice_size']*1024*1024,
+                           archive_config['max_workers'])
+    if archive_config['backend'] == 'local':
+        return LocalBackend(archive_config['local_path'], archive_config['max_workers'])
+    raise ValueError(f"未知的归档后端：{archive_config['backend']}")
@@ -3,12 +3,6 @@ import datetime
 import logging
 import traceback
 
-import requests
-import urllib3
-from requests.adapters import HTTPAdapter
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
 
 class BaseLive(metaclass=abc.ABCMeta):
 
@@ -23,8 +17,7 @@ class BaseLive(metaclass=abc.ABCMeta):
         }
         self.headers = {**default_headers, **
                         config['root']['request_header']}
-        self.session = requests.session()
-        self.session.mount('https://', HTTPAdapter(max_retries=3))
+        self.__session = None
         self.room_id = ''
         self.site_name = ''
         self.site_domain = ''
@@ -34,7 +27,20 @@ class BaseLive(metaclass=abc.ABCMeta):
         self.__allowed_check_interval = datetime.timedelta(
             seconds=config['root']['check_interval'])
 
-    def common_request(self, method: str, url: str, params: dict = None, data: dict = None) -> requests.Response:
+    @property
+    def session(self):
+        # requests 导入较慢，第一次发起请求时才导入，主进程启动时不需要等待
+        if self.__session is None:
+            import requests
+            import urllib3
+            from requests.adapters import HTTPAdapter
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+            self.__session = requests.session()
+            self.__session.mount('https://', HTTPAdapter(max_retries=3))
+        return self.__session
+
+    def common_request(self, method: str, url: str, params: dict = None, data: dict = None) -> 'requests.Response':
+        import requests
         try:
             connection = None
             if method == 'GET':
@@ -84,5 +90,9 @@ class BaseLive(metaclass=abc.ABCMeta):
     def live_status(self, status: bool):
         self.__live_status = status
 
+    def expire_live_status(self) -> None:
+        """下次读取 live_status 时立即检查，不受检查间隔限制。"""
+        self.__last_check_time = datetime.datetime.min
+
     def generate_log(self, content: str = '') -> str:
         return f"[Site:{self.site_name} Room:{self.room_id}] {content}"
@@ -1,11 +1,7 @@
 import logging
 
-import urllib3
-
 from BaseLive import BaseLive
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
 
 class BiliLive(BaseLive):
     def __init__(self, config: dict):
@@ -13,11 +9,12 @@ class BiliLive(BaseLive):
         self.room_id = config['spec']['room_id']
         self.site_name = 'BiliBili'
         self.site_domain = 'live.bilibili.com'
+        self.api_base = config['root']['api']['live'].rstrip('/')
 
     def get_room_info(self) -> dict:
         data = {}
-        room_info_url = 'https://api.live.bilibili.com/room/v1/Room/get_info'
-        user_info_url = 'https://api.live.bilibili.com/live_user/v1/UserInfo/get_anchor_in_room'
+        room_info_url = self.api_base+'/room/v1/Room/get_info'
+        user_info_url = self.api_base+'/live_user/v1/UserInfo/get_anchor_in_room'
         response = self.common_request('GET', room_info_url, {
             'room_id': self.room_id
         }).json()
@@ -36,7 +33,7 @@ class BiliLive(BaseLive):
 
     def get_live_urls(self) -> list:
         live_urls = []
-        url = 'https://api.live.bilibili.com/room/v1/Room/playUrl'
+        url = self.api_base+'/room/v1/Room/playUrl'
         stream_info = self.common_request('GET', url, {
             'cid': self.room_id,
             'otype': 'json',
@@ -58,7 +55,7 @@ class BiliLive(BaseLive):
 
     def get_room_conf(self):
         data = {}
-        url = 'https://api.live.bilibili.com/room/v1/Danmu/getConf'
+        url = self.api_base+'/room/v1/Danmu/getConf'
         response = self.common_request('GET', url, {
             'room_id': self.room_id
         }).json()
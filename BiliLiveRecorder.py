@@ -1,65 +1,240 @@
 import datetime
+import json
 import logging
 import os
+import queue
 import re
+import socket
+import threading
+import time
 import traceback
 
 import requests
 import urllib3
 
+import FFmpegRunner
 import utils
 from BiliLive import BiliLive
+from KeyframeIndex import KeyframeIndexWriter
+from Metrics import MetricsClient
+from ReplayBuffer import ReplayBuffer
+from SegmentRemuxer import SegmentRemuxer
+from StallWatchdog import StallWatchdog
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
 class BiliLiveRecorder(BiliLive):
-    def __init__(self, config: dict, global_start: datetime.datetime):
+    def __init__(self, config: dict, global_start: datetime.datetime, metrics=None, scheduler=None):
         BiliLive.__init__(self, config)
         self.config = config
+        self.scheduler = scheduler
         self.record_dir = utils.init_record_dir(
             self.room_id, global_start, config['root']['data_path'])
+        self.metrics = MetricsClient(metrics)
+        self.last_record_end = None
+        # 卡顿后换用下一个地址
+        self.mirror_index = 0
+        # 未配置预期码率时，使用本场直播上一个正常连接的平均速度
+        self.learned_bps = 0
+        self.global_start = global_start
+        self.replay_buffer = None
 
-    def record(self, record_url: str, output_filename: str) -> None:
+    def expected_bps(self) -> float:
+        expected_bitrate = self.config['spec']['recorder']['expected_bitrate']
+        if expected_bitrate > 0:
+            return expected_bitrate*1000/8
+        return self.learned_bps
+
+    @staticmethod
+    def abort_response(resp: requests.Response) -> None:
+        # 关闭套接字才能打断另一个线程中阻塞的读取
+        sock = getattr(getattr(resp.raw, 'connection', None), 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        resp.close()
+
+    def save_stall_event(self, record_url: str, output_filename: str, watchdog: StallWatchdog) -> None:
+        event = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'reason': watchdog.reason,
+            'host': re.findall(r'https?://([^/]*)/', record_url+'/')[0],
+            'filename': os.path.basename(output_filename),
+            'elapsed': round(watchdog.elapsed(), 1),
+            'bytes': watchdog.total,
+            'throughput_bps': round(watchdog.throughput_at_stall),
+            'expected_bps': round(watchdog.expected_bps)
+        }
+        logging.warning(self.generate_log("录制连接卡顿（%s），窗口内速度 %.1fKB/s，预期 %.1fKB/s，已断开并换用下一个地址：%s" % (
+            event['reason'], event['throughput_bps']/1024, event['expected_bps']/1024, event['host'])))
+        self.metrics.inc('ddrecorder_record_stalls_total',
+                         room=self.room_id, reason=event['reason'])
+        try:
+            with open(os.path.join(self.record_dir, "stalls.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(event, ensure_ascii=False)+"\n")
+        except OSError as e:
+            logging.error(self.generate_log('记录卡顿事件失败：' + str(e)))
+
+    def record(self, record_url: str, output_filename: str) -> bool:
+        """录制一个连接直到断开，返回是否因卡顿被断开。"""
+        recorder_config = self.config['spec']['recorder']
+        watchdog = None
         try:
             logging.info(self.generate_log('√ 正在录制...' + self.room_id))
             default_headers = {
                 'Accept-Encoding': 'identity',
                 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36 ',
                 'Referer': re.findall(
-                    r'(https://.*\/).*\.flv',
+                    r'(https?://.*\/).*\.flv',
                     record_url)[0]
             }
             headers = {**default_headers, **
                        self.config['root']['request_header']}
             resp = requests.get(record_url, stream=True,
                                 headers=headers,
-                                timeout=20)
-            with open(output_filename, "wb") as f:
-                for chunk in resp.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
+                                timeout=(20, max(20, recorder_config['stall_timeout']*2)))
+            watchdog = StallWatchdog(lambda: self.abort_response(resp), recorder_config['stall_window'],
+                                     recorder_config['stall_timeout'], recorder_config['stall_ratio'],
+                                     self.expected_bps())
+            watchdog.start()
+            if self.last_record_end is not None:
+                self.metrics.inc(
+                    'ddrecorder_record_reconnects_total', room=self.room_id)
+                self.metrics.set('ddrecorder_record_last_gap_seconds',
+                                 time.time()-self.last_record_end, room=self.room_id)
+            index_writer = KeyframeIndexWriter(output_filename)
+            # 每个连接都是新的 FLV 流，即时回放从这个连接开始缓冲
+            replay_buffer = self.replay_buffer
+            if replay_buffer is not None:
+                replay_buffer.reset()
+            try:
+                with open(output_filename, "wb") as f:
+                    for chunk in resp.iter_content(chunk_size=1024):
+                        if chunk:
+                            f.write(chunk)
+                            watchdog.feed(len(chunk))
+                            self.metrics.inc(
+                                'ddrecorder_record_bytes_total', len(chunk), room=self.room_id)
+                            if index_writer is not None:
+                                try:
+                                    index_writer.feed(chunk)
+                                except ValueError as e:
+                                    # 索引只用于加速切分，解析失败时放弃索引，不影响录制
+                                    logging.warning(self.generate_log(
+                                        '关键帧索引解析失败，放弃索引：' + str(e)))
+                                    index_writer.discard()
+                                    index_writer = None
+                            if replay_buffer is not None:
+                                try:
+                                    replay_buffer.feed(chunk)
+                                except ValueError as e:
+                                    logging.warning(self.generate_log(
+                                        '即时回放缓冲区解析失败，本次连接不再缓冲：' + str(e)))
+                                    replay_buffer.reset()
+                                    replay_buffer = None
+            finally:
+                if index_writer is not None:
+                    index_writer.close()
         except Exception as e:
-            logging.error(self.generate_log(
-                'Error while recording:' + str(e)))
+            # 卡顿断开时读取会抛出连接错误，由下面统一记录
+            if watchdog is None or watchdog.reason is None:
+                logging.error(self.generate_log(
+                    'Error while recording:' + str(e)))
+        finally:
+            self.last_record_end = time.time()
+            if watchdog is not None:
+                watchdog.stop()
+        if watchdog is None:
+            return False
+        if watchdog.reason is not None:
+            self.save_stall_event(record_url, output_filename, watchdog)
+            return True
+        if watchdog.elapsed() >= recorder_config['stall_window']:
+            self.learned_bps = watchdog.total/watchdog.elapsed()
+        return False
+
+    def save_replay(self, reason: str) -> None:
+        replay_config = self.config['spec']['replay']
+        if self.replay_buffer is None:
+            logging.warning(self.generate_log('即时回放缓冲区不可用，忽略本次保存'))
+            return
+        replay_dir = utils.init_replay_dir(
+            self.room_id, self.global_start, self.config['root']['data_path'])
+        path = os.path.join(
+            replay_dir, f"{self.room_id}_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{reason}.flv")
+        try:
+            duration = self.replay_buffer.write_clip(
+                path, replay_config['clip_seconds'])
+        except OSError as e:
+            logging.error(self.generate_log('保存即时回放失败：' + str(e)))
+            return
+        if duration is None:
+            logging.info(self.generate_log('即时回放缓冲区中还没有数据'))
+            return
+        logging.info(self.generate_log(
+            '已保存 %.1f 秒的即时回放：%s' % (duration, path)))
+        self.metrics.inc('ddrecorder_replay_clips_total',
+                         room=self.room_id, reason=reason)
 
-    def run(self) -> None:
-        logging.basicConfig(level=utils.get_log_level(self.config['root']['logger']['log_level']),
-                            format='%(asctime)s %(thread)d %(threadName)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-                            datefmt='%a, %d %b %Y %H:%M:%S',
-                            handlers=[logging.FileHandler(os.path.join(self.config['root']['logger']['log_path'], "LiveRecoder_"+datetime.datetime.now(
-                            ).strftime('%Y-%m-%d_%H-%M-%S')+'.log'), "a", encoding="utf-8")])
+    def serve_replays(self, replay_queue) -> None:
+        # 弹幕进程发来的请求，或手动创建的 data/replays/<房间号>.trigger 文件
+        trigger_path = utils.get_replay_trigger_path(
+            self.room_id, self.config['root']['data_path'])
         while True:
             try:
-                if self.live_status:
-                    urls = self.get_live_urls()
-                    filename = utils.generate_filename(self.room_id)
-                    c_filename = os.path.join(self.record_dir, filename)
-                    self.record(urls[0], c_filename)
-                    logging.info(self.generate_log('录制完成' + c_filename))
-                else:
-                    logging.info(self.generate_log('下播了'))
-                    break
-            except Exception as e:
-                logging.error(self.generate_log(
-                    'Error while checking or recording:' + str(e)+traceback.format_exc()))
+                reason = replay_queue.get(timeout=1)
+            except queue.Empty:
+                reason = None
+            if reason is None and os.path.exists(trigger_path):
+                try:
+                    os.remove(trigger_path)
+                except OSError:
+                    pass
+                reason = 'manual'
+            if reason is not None:
+                self.save_replay(reason)
+
+    def run(self, log_queue=None, replay_queue=None) -> None:
+        utils.init_logging(self.config, log_queue, "LiveRecoder")
+        replay_config = self.config['spec']['replay']
+        if replay_config['enabled'] and replay_queue is not None:
+            self.replay_buffer = ReplayBuffer(
+                replay_config['buffer_seconds'], replay_config['max_buffer_mb']*1024*1024)
+            threading.Thread(target=self.serve_replays, args=(replay_queue,),
+                             name="ReplayServer", daemon=True).start()
+        # 录完的片段在录制期间就转码，下播后只剩最后一个片段和合并
+        remuxer = None
+        if self.config['spec']['recorder']['remux_during_live']:
+            FFmpegRunner.configure(
+                self.config['root']['ffmpeg'], self.scheduler)
+            remuxer = SegmentRemuxer(self.config, self.global_start)
+            remuxer.start()
+        finished_filename = None
+        try:
+            while True:
+                try:
+                    if self.live_status:
+                        urls = self.get_live_urls()
+                        filename = utils.generate_filename(self.room_id)
+                        c_filename = os.path.join(self.record_dir, filename)
+                        # 开始录制新文件时，上一个文件才算录完（同一秒内重连会覆盖同名文件）
+                        if remuxer is not None and finished_filename is not None and finished_filename != c_filename:
+                            remuxer.submit(finished_filename)
+                        finished_filename = None
+                        if self.record(urls[self.mirror_index % len(urls)], c_filename):
+                            self.mirror_index += 1
+                        finished_filename = c_filename
+                        logging.info(self.generate_log('录制完成' + c_filename))
+                    else:
+                        logging.info(self.generate_log('下播了'))
+                        self.metrics.flush(force=True)
+                        break
+                except Exception as e:
+                    logging.error(self.generate_log(
+                        'Error while checking or recording:' + str(e)+traceback.format_exc()))
+        finally:
+            if remuxer is not None:
+                remuxer.stop()
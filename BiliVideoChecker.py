@@ -1,20 +1,59 @@
-import datetime
+import json
 import logging
 import os
 import threading
 import time
-
-import requests
-import urllib3
+from concurrent.futures import ThreadPoolExecutor
 
 import utils
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+TICK_SECONDS = 10
+
+
+def get_job_path(bvid: str, root_dir: str) -> str:
+    return os.path.join(utils.get_review_queue_dir(root_dir), f"{bvid}.json")
+
+
+def load_job(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_job(job: dict, root_dir: str) -> None:
+    """写入临时文件后替换，调用方需持有该任务的文件锁。"""
+    path = get_job_path(job['bvid'], root_dir)
+    tmp_path = path+f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def add_review_job(bvid: str, path: str, config: dict) -> None:
+    """登记一个待过审删除的稿件，处理进程和主进程都可以调用，由主进程中的检查服务统一检查。"""
+    root_dir = config['root']['data_path']
+    job_path = get_job_path(bvid, root_dir)
+    # 处理进程、直播中上传进程和主进程中的检查服务都会读写任务文件，读改写期间持有文件锁
+    with utils.FileLock(job_path):
+        job = load_job(job_path) or {'bvid': bvid, 'paths': [], 'attempts': 0,
+                                     'next_check': time.time(), 'added': time.time()}
+        if path not in job['paths']:
+            job['paths'].append(path)
+        save_job(job, root_dir)
+    logging.info("稿件%s 已加入过审检查队列，过审后删除 %s", bvid, path)
 
 
 class BiliVideoChecker(threading.Thread):
-    def __init__(self, bvid: str, path: str, config: dict):
-        threading.Thread.__init__(self)
+    """稿件过审检查服务。
+
+    待检查的稿件保存在 data/review_queue 下，每个稿件一个文件，重启后继续检查。
+    所有稿件共用一个会话按统一的节奏检查，未过审的稿件检查间隔按指数退避增长。
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="BiliVideoChecker", daemon=True)
         default_headers = {
             'Accept': 'application/json, text/javascript, */*; q=0.01',
             'Accept-Encoding': 'gzip, deflate',
@@ -22,42 +61,102 @@ class BiliVideoChecker(threading.Thread):
             'Connection': 'keep-alive',
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36 '
         }
-        self.headers = {**default_headers, **
-                        config['root']['request_header']}
-        self.session = requests.session()
-        self.bvid = bvid
-        self.path = path
-        self.config = config
-        self.check_url = "https://api.bilibili.com/x/web-interface/view"
-        self.check_interval = config['root']['check_interval']
-
-    def common_request(self, method: str, url: str, params: dict = None, data: dict = None) -> requests.Response:
+        self.default_headers = default_headers
+        self.__session = None
+        self.config = None
+        self.check_url = None
+
+    def apply_config(self, root_config: dict) -> None:
+        self.config = {'root': root_config}
+        self.headers = {**self.default_headers, **
+                        root_config['request_header']}
+        self.check_url = root_config['api']['main'].rstrip(
+            '/')+"/x/web-interface/view"
+        if self.ident is None:
+            self.start()
+
+    @property
+    def session(self):
+        # 检查服务运行在主进程中，requests 在第一次检查时才导入
+        if self.__session is None:
+            import requests
+            import urllib3
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+            self.__session = requests.session()
+        return self.__session
+
+    def common_request(self, method: str, url: str, params: dict = None, data: dict = None) -> 'requests.Response':
+        timeout = self.config['root']['review_checker']['request_timeout']
         connection = None
         if method == 'GET':
             connection = self.session.get(
-                url, headers=self.headers, params=params, verify=False)
+                url, headers=self.headers, params=params, verify=False, timeout=timeout)
         if method == 'POST':
             connection = self.session.post(
-                url, headers=self.headers, params=params, data=data, verify=False)
+                url, headers=self.headers, params=params, data=data, verify=False, timeout=timeout)
         return connection
 
-    def run(self) -> None:
-        logging.basicConfig(level=utils.get_log_level(self.config),
-                            format='%(asctime)s %(thread)d %(threadName)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-                            datefmt='%a, %d %b %Y %H:%M:%S',
-                            handlers=[logging.FileHandler(os.path.join(self.config['root']['logger']['log_path'], "VideoChecker_"+datetime.datetime.now(
-                            ).strftime('%Y-%m-%d_%H-%M-%S')+'.log'), "a", encoding="utf-8")])
-        while True:
+    def load_jobs(self) -> list:
+        queue_dir = utils.get_review_queue_dir(self.config['root']['data_path'])
+        jobs = []
+        for filename in os.listdir(queue_dir):
+            if os.path.splitext(filename)[1] != ".json":
+                continue
+            try:
+                with open(os.path.join(queue_dir, filename), "r", encoding="utf-8") as f:
+                    jobs.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logging.error("读取过审检查任务 %s 时出现错误：%s", filename, e)
+        return jobs
+
+    def check(self, job: dict) -> None:
+        import requests
+        root_dir = self.config['root']['data_path']
+        bvid = job['bvid']
+        job_path = get_job_path(bvid, root_dir)
+        try:
             video_info = self.common_request("GET", self.check_url, {
-                'bvid': self.bvid
+                'bvid': bvid
             }).json()
+            if video_info['code'] == 0 and video_info['data']['state'] == 0:
+                with utils.FileLock(job_path):
+                    # 检查期间可能有进程追加了路径，以磁盘上的任务为准
+                    job = load_job(job_path) or job
+                    try:
+                        for path in job['paths']:
+                            logging.info("稿件%s 已开放浏览，准备删除 %s", bvid, path)
+                            # 可能已被空间管理提前清理
+                            if os.path.exists(path):
+                                utils.del_files_and_dir(path)
+                        os.remove(job_path)
+                        return
+                    except OSError as e:
+                        # 文件可能正被占用，保留任务稍后重试
+                        logging.error("稿件%s 已开放浏览，但删除文件时出现错误：%s", bvid, e)
+            else:
+                logging.info("稿件%s 未开放浏览", bvid)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.warning("检查稿件%s 时出现错误：%s", bvid, e)
+        checker_config = self.config['root']['review_checker']
+        with utils.FileLock(job_path):
+            job = load_job(job_path)
+            if job is None:
+                return
+            # 审核通常在数小时内完成，长时间未过审的稿件逐渐降低检查频率
+            job['attempts'] += 1
+            job['next_check'] = time.time()+min(self.config['root']['check_interval']*2**(job['attempts']-1),
+                                                checker_config['max_interval'])
+            save_job(job, root_dir)
+
+    def run(self) -> None:
+        while True:
             try:
-                if video_info['code'] == 0 and video_info['data']['state'] == 0:
-                    logging.info("稿件%s 已开放浏览，准备删除 %s", self.bvid, self.path)
-                    utils.del_files_and_dir(self.path)
-                    return
-                else:
-                    logging.info("稿件%s 未开放浏览", self.bvid)
-                    time.sleep(self.check_interval)
-            except KeyError:
-                pass
+                now = time.time()
+                due = [job for job in self.load_jobs()
+                       if job['next_check'] <= now]
+                if due:
+                    with ThreadPoolExecutor(max_workers=self.config['root']['review_checker']['max_workers']) as pool:
+                        list(pool.map(self.check, due))
+            except Exception as e:
+                logging.error("过审检查服务出现错误：%s", e)
+            time.sleep(TICK_SECONDS)
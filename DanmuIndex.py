@@ -0,0 +1,273 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import List
+
+import utils
+from Tracing import traced
+
+# 每个事务最多写入的行数，每个事务同时更新文件的导入位置，中断后从上一个事务结束处继续
+BATCH_ROWS = 20000
+# trigram 分词至少需要 3 个字符，更短的关键词退回按子串扫描
+TRIGRAM_MIN_LENGTH = 3
+
+
+def parse_danmu_row(obj: dict) -> tuple:
+    return (obj['properties']['time']/1000, obj['user_info']['user_id'], obj['user_info']['user_name'], obj['text'], 0)
+
+
+def parse_superchat_row(obj: dict) -> tuple:
+    return (obj['time'], obj['user_id'], obj['user_name'], obj['text'], obj['price'])
+
+
+def parse_gift_row(obj: dict) -> tuple:
+    # 金瓜子 1000 个为 1 元，银瓜子礼物不计价值
+    price = obj['total_coin']/1000 if obj.get('coin_type') == 'gold' else 0
+    return (obj['time'], obj['user_id'], obj['user_name'], obj['gift_name'], price)
+
+
+KINDS = {
+    'danmu': ("danmu.jsonl", parse_danmu_row),
+    'superchat': ("superchat.jsonl", parse_superchat_row),
+    'gift': ("gift.jsonl", parse_gift_row)
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    session TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    PRIMARY KEY (session, kind)
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    time REAL NOT NULL,
+    user_id INTEGER,
+    user_name TEXT,
+    text TEXT,
+    price REAL
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_user_id ON events (user_id, time);
+CREATE INDEX IF NOT EXISTS events_user_name ON events (user_name, time);
+CREATE INDEX IF NOT EXISTS events_room ON events (room_id, time);
+CREATE INDEX IF NOT EXISTS events_session ON events (session, kind);
+CREATE TRIGGER IF NOT EXISTS events_ai AFTER INSERT ON events BEGIN
+    INSERT INTO events_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS events_ad AFTER DELETE ON events BEGIN
+    INSERT INTO events_fts (events_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+
+class DanmuIndex():
+    """跨场次的弹幕检索索引。
+
+    把 data/danmu 下每场直播的弹幕、醒目留言和礼物记录导入 data/danmu_index.sqlite，
+    按时间、用户、直播间建立索引，文本使用 FTS5 全文索引（trigram 分词，支持中文子串检索）。
+    导入是增量的：记录每个文件已导入到的字节位置，再次导入时只读取新增的行。
+    """
+
+    def __init__(self, root_dir: str = os.getcwd()):
+        self.root_dir = root_dir
+        # 多个处理进程可能同时导入，WAL 模式下检索不会被导入阻塞
+        self.conn = sqlite3.connect(
+            utils.get_danmu_index_path(root_dir), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # 批量导入时各索引的写入位置分散，较大的页缓存能减少约四分之一的导入时间
+        self.conn.execute("PRAGMA cache_size=-65536")
+        with self.conn:
+            self.__create_fts()
+            self.conn.executescript(SCHEMA)
+
+    def __create_fts(self) -> None:
+        try:
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(text, content='events', content_rowid='id', tokenize='trigram')")
+        except sqlite3.OperationalError:
+            # SQLite 3.34 之前没有 trigram 分词，中文只能按整段匹配
+            logging.warning("当前 SQLite 不支持 trigram 分词，弹幕全文检索只能匹配完整的词")
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(text, content='events', content_rowid='id')")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __get_offset(self, session: str, kind: str) -> int:
+        row = self.conn.execute(
+            "SELECT offset FROM files WHERE session = ? AND kind = ?", (session, kind)).fetchone()
+        return row[0] if row is not None else 0
+
+    def __insert(self, session: str, room_id: str, kind: str, rows: List[tuple], offset: int) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO events (session, room_id, kind, time, user_id, user_name, text, price) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(session, room_id, kind)+row for row in rows])
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (session, kind, offset) VALUES (?, ?, ?)", (session, kind, offset))
+
+    def __index_file(self, session: str, room_id: str, kind: str, path: str) -> int:
+        _, parse_row = KINDS[kind]
+        offset = self.__get_offset(session, kind)
+        if os.path.getsize(path) < offset:
+            # 文件被替换或截断，重新导入
+            logging.warning("弹幕文件 %s 比已导入的部分短，重新导入", path)
+            with self.conn:
+                self.conn.execute(
+                    "DELETE FROM events WHERE session = ? AND kind = ?", (session, kind))
+            offset = 0
+        added = 0
+        skipped = 0
+        rows = []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                # 录制中的文件最后一行可能还没写完，留到下次导入
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    rows.append(parse_row(json.loads(line)))
+                except (ValueError, KeyError, TypeError):
+                    skipped += 1
+                    continue
+                if len(rows) >= BATCH_ROWS:
+                    self.__insert(session, room_id, kind, rows, offset)
+                    added += len(rows)
+                    rows = []
+        self.__insert(session, room_id, kind, rows, offset)
+        added += len(rows)
+        if skipped:
+            logging.warning("弹幕文件 %s 中有 %d 行无法解析，已跳过", path, skipped)
+        return added
+
+    @traced('danmu_index')
+    def index_session(self, danmu_dir: str) -> int:
+        """导入一场直播的弹幕目录中尚未导入的部分，返回新增的记录数。"""
+        session = os.path.basename(os.path.normpath(danmu_dir))
+        room_id = session.split("_")[0]
+        added = 0
+        for kind, (filename, _) in KINDS.items():
+            path = os.path.join(danmu_dir, filename)
+            if os.path.exists(path):
+                added += self.__index_file(session, room_id, kind, path)
+        return added
+
+    def index_all(self) -> int:
+        danmu_root = os.path.join(self.root_dir, 'data', 'danmu')
+        added = 0
+        for entry in sorted(os.listdir(danmu_root)):
+            if os.path.isdir(os.path.join(danmu_root, entry)):
+                added += self.index_session(os.path.join(danmu_root, entry))
+        return added
+
+    def search(self, keyword: str = None, user: str = None, room_id: str = None, kind: str = None,
+               since: datetime.datetime = None, until: datetime.datetime = None, limit: int = 100) -> List[dict]:
+        """按关键词、用户（用户名或 UID）、直播间、类型和时间范围检索，按时间从新到旧返回。
+
+        offset 为该条记录距本场录制开始的秒数，可以直接用来定位录像。
+        """
+        conditions = []
+        params = []
+        if keyword:
+            if len(keyword) >= TRIGRAM_MIN_LENGTH:
+                conditions.append(
+                    "id IN (SELECT rowid FROM events_fts WHERE events_fts MATCH ?)")
+                params.append('"'+keyword.replace('"', '""')+'"')
+            else:
+                conditions.append("text LIKE ? ESCAPE '\\'")
+                params.append(
+                    "%"+keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")+"%")
+        if user:
+            if str(user).isdigit():
+                conditions.append("user_id = ?")
+                params.append(int(user))
+            else:
+                conditions.append("user_name = ?")
+                params.append(user)
+        if room_id:
+            conditions.append("room_id = ?")
+            params.append(str(room_id))
+        if kind:
+            conditions.append("kind = ?")
+            params.append(kind)
+        if since:
+            conditions.append("time >= ?")
+            params.append(since.timestamp())
+        if until:
+            conditions.append("time < ?")
+            params.append(until.timestamp())
+        sql = "SELECT session, room_id, kind, time, user_id, user_name, text, price FROM events"
+        if conditions:
+            sql += " WHERE "+" AND ".join(conditions)
+        sql += " ORDER BY time DESC LIMIT ?"
+        params.append(limit)
+        results = []
+        for session, room_id, kind, timestamp, user_id, user_name, text, price in self.conn.execute(sql, params):
+            try:
+                offset = timestamp-utils.get_global_start_from_records(session).timestamp()
+            except ValueError:
+                offset = None
+            results.append({
+                'session': session,
+                'room_id': room_id,
+                'kind': kind,
+                'time': datetime.datetime.fromtimestamp(timestamp),
+                'offset': offset,
+                'user_id': user_id,
+                'user_name': user_name,
+                'text': text,
+                'price': price
+            })
+        return results
+
+
+def format_result(result: dict) -> str:
+    line = f"{result['time'].strftime('%Y-%m-%d %H:%M:%S')} [{result['room_id']}] {result['kind']} " \
+        f"{result['user_name']}({result['user_id']})：{result['text']}"
+    if result['price']:
+        line += f" ￥{result['price']:g}"
+    if result['offset'] is not None:
+        line += f"  （{result['session']} 第 {int(result['offset'])//60} 分 {int(result['offset']) % 60} 秒）"
+    return line
+
+
+if __name__ == "__main__":
+    # 导入全部场次：python DanmuIndex.py build [--data-path ./]
+    # 检索：python DanmuIndex.py search [关键词] [--user 用户名或UID] [--room 房间号] [--kind danmu|superchat|gift]
+    #                                   [--since 2021-11-18] [--until 2021-11-19] [--limit 50] [--data-path ./]
+    parser = argparse.ArgumentParser(description="DDRecorder 弹幕检索")
+    parser.add_argument("--data-path", default="./", help="与配置文件中的 data_path 相同")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="导入 data/danmu 下全部场次中尚未导入的弹幕")
+    search_parser = subparsers.add_parser("search", help="检索弹幕、醒目留言和礼物")
+    search_parser.add_argument("keyword", nargs="?", help="关键词，至少 3 个字时使用全文索引")
+    search_parser.add_argument("--user", help="用户名或 UID")
+    search_parser.add_argument("--room", help="房间号")
+    search_parser.add_argument("--kind", choices=list(KINDS.keys()))
+    search_parser.add_argument("--since", type=datetime.datetime.fromisoformat, help="开始时间，如 2021-11-18 或 2021-11-18T20:00")
+    search_parser.add_argument("--until", type=datetime.datetime.fromisoformat, help="结束时间")
+    search_parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    index = DanmuIndex(args.data_path)
+    start = time.time()
+    if args.command == "build":
+        added = index.index_all()
+        print(f"新增 {added} 条记录，用时 {time.time()-start:.1f} 秒")
+    else:
+        results = index.search(args.keyword, args.user, args.room, args.kind,
+                               args.since, args.until, args.limit)
+        for result in results:
+            print(format_result(result))
+        print(f"共 {len(results)} 条，用时 {(time.time()-start)*1000:.1f} 毫秒")
+    index.close()
@@ -13,16 +13,22 @@ from aiowebsocket.converses import AioWebSocket
 
 import utils
 from BiliLive import BiliLive
+from Metrics import MetricsClient
+from ReplayBuffer import DanmuBurstDetector
 
 
 class BiliDanmuRecorder(BiliLive):
-    def __init__(self, config: dict, global_start: datetime.datetime):
+    def __init__(self, config: dict, global_start: datetime.datetime, metrics=None):
         BiliLive.__init__(self, config)
         self.config = config
+        self.metrics = MetricsClient(metrics)
         self.conf = self.get_room_conf()
         self.room_server_api = f"wss://{self.conf['available_hosts'][0]['host']}:{self.conf['available_hosts'][0]['wss_port']}/sub"
         self.danmu_dir = utils.init_danmu_log_dir(
             self.room_id, global_start, config['root']['data_path'])
+        # 弹幕突增时通知录制进程从即时回放缓冲区保存片段
+        self.replay_queue = None
+        self.burst_detector = None
 
     def __pack(self, data: bytes, protocol_version: int, datapack_type: int):
         sendData = bytearray()
@@ -36,13 +42,15 @@ class BiliDanmuRecorder(BiliLive):
 
     async def __send(self, data: bytes, protocol_version: int, datapack_type: int, websocket):
         data = self.__pack(data, protocol_version, datapack_type)
-        logging.debug(self.generate_log(f'发送原始数据：{data}'))
+        logging.debug("[Site:%s Room:%s] 发送原始数据：%s",
+                      self.site_name, self.room_id, data)
         await websocket.send(data)
 
     async def __send_heart_beat(self, websocket):
         hb = self.__pack(b'[object Object]', 1, 2)
         while self.live_status:
-            logging.debug(self.generate_log(f"弹幕接收器已发送心跳包，心跳包数据{hb}"))
+            logging.debug("[Site:%s Room:%s] 弹幕接收器已发送心跳包，心跳包数据%s",
+                          self.site_name, self.room_id, hb)
             await websocket.send(hb)
             await asyncio.sleep(30)
 
@@ -64,12 +72,14 @@ class BiliDanmuRecorder(BiliLive):
             tasks = [self.__receDM(converse), self.__send_heart_beat(converse)]
             await asyncio.wait(tasks)
 
-    def run(self):
-        logging.basicConfig(level=utils.get_log_level(self.config),
-                            format='%(asctime)s %(thread)d %(threadName)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-                            datefmt='%a, %d %b %Y %H:%M:%S',
-                            handlers=[logging.FileHandler(os.path.join(self.config['root']['logger']['log_path'], "DanmuRecoder_"+datetime.datetime.now(
-                            ).strftime('%Y-%m-%d_%H-%M-%S')+'.log'), "a", encoding="utf-8")])
+    def run(self, log_queue=None, replay_queue=None):
+        utils.init_logging(self.config, log_queue, "DanmuRecoder")
+        replay_config = self.config['spec']['replay']
+        if replay_queue is not None and replay_config['auto_trigger']:
+            parser_config = self.config['spec']['parser']
+            self.replay_queue = replay_queue
+            self.burst_detector = DanmuBurstDetector(
+                parser_config['interval'], parser_config['up_ratio'], replay_config['min_danmu'], replay_config['cooldown'])
         try:
             new_loop = asyncio.new_event_loop()
             asyncio.set_event_loop(new_loop)
@@ -77,6 +87,7 @@ class BiliDanmuRecorder(BiliLive):
             loop.run_until_complete(self.__startup())
         except KeyboardInterrupt:
             logging.info(self.generate_log("键盘指令退出"))
+        self.metrics.flush(force=True)
 
     def __printDM(self, data):
         # 获取数据包的长度，版本和操作类型
@@ -91,8 +102,8 @@ class BiliDanmuRecorder(BiliLive):
 
         if ver == 1:
             if op == 3:
-                logging.debug(self.generate_log(
-                    '[RENQI]  {}\n'.format(struct.unpack(">I", data[16:20])[0])))
+                logging.debug("[Site:%s Room:%s] [RENQI]  %s", self.site_name,
+                              self.room_id, struct.unpack(">I", data[16:20])[0])
                 return
 
         # 有的时候可能会两个数据包连在一起发过来，所以利用前面的数据包长度判断，
@@ -109,16 +120,23 @@ class BiliDanmuRecorder(BiliLive):
         # ver 为1的时候为进入房间后或心跳包服务器的回应。op 为3的时候为房间的人气值。
         if ver == 1:
             if op == 8:
-                logging.debug(self.generate_log(
-                    '[VERIFY]  {}\n'.format(json.loads(data[16:].decode('utf-8', errors='ignore')))))
+                logging.debug("[Site:%s Room:%s] [VERIFY]  %s", self.site_name,
+                              self.room_id, data[16:].decode('utf-8', errors='ignore'))
 
         # ver 不为2也不为1目前就只能是0了，也就是普通的 json 数据。
         # op 为5意味着这是通知消息，cmd 基本就那几个了。
         if (ver == 0 or ver == 2) and op == 5:
             try:
                 jd = json.loads(data[16:].decode('utf-8', errors='ignore'))
-                logging.debug(self.generate_log(jd['cmd']+'\t'+str(jd)+'\n'))
+                # 每条消息都会经过这里，按参数延迟格式化，INFO 级别时不产生开销
+                logging.debug("[Site:%s Room:%s] %s\t%s", self.site_name,
+                              self.room_id, jd['cmd'], jd)
+                self.metrics.inc('ddrecorder_danmu_messages_total',
+                                 room=self.room_id, cmd=jd['cmd'])
                 if jd['cmd'] == 'DANMU_MSG':
+                    if self.burst_detector is not None and self.burst_detector.feed(time.time()):
+                        logging.info(self.generate_log("弹幕数突增，保存即时回放"))
+                        self.replay_queue.put('danmu')
                     info = dict(enumerate(jd.get("info", [])))
                     prop = dict(enumerate(info.get(0, [])))
                     user_info = dict(enumerate(info.get(2, [])))
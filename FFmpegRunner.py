@@ -0,0 +1,68 @@
+import logging
+import shutil
+import subprocess
+import sys
+from typing import List
+
+from JobScheduler import slot
+
+IONICE_CLASSES = {'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+_config = None
+_scheduler = None
+
+
+def configure(ffmpeg_config: dict, scheduler=None) -> None:
+    """在每个会调用 ffmpeg 的进程中设置一次，scheduler 为 None 时不限制并发也不感知录制状态。"""
+    global _config, _scheduler
+    _config = ffmpeg_config
+    _scheduler = scheduler
+
+
+def is_recording() -> bool:
+    if _scheduler is None:
+        return False
+    try:
+        return _scheduler.recording_count() > 0
+    except Exception as e:
+        logging.debug("查询录制状态失败：%s", e)
+        return False
+
+
+def get_priority_prefix(ffmpeg_config: dict) -> List[str]:
+    # 通过 nice / ionice 命令启动，子进程从第一条指令起就是低优先级，也不需要在多线程进程中使用 preexec_fn
+    prefix = []
+    if ffmpeg_config['nice'] > 0 and shutil.which("nice"):
+        prefix += ["nice", "-n", str(ffmpeg_config['nice'])]
+    ionice_class = IONICE_CLASSES.get(ffmpeg_config['ionice_class'])
+    if ionice_class is not None and shutil.which("ionice"):
+        prefix += ["ionice", "-c", ionice_class]
+        if ionice_class != '3':
+            prefix += ["-n", str(ffmpeg_config['ionice_level'])]
+    return prefix
+
+
+def build_command(args: List[str], recording: bool) -> List[str]:
+    """args 为 ffmpeg 之后的参数，最后一个参数是输出文件。"""
+    threads = _config['recording_threads'] if recording else _config['threads']
+    if threads > 0:
+        args = args[:-1]+["-threads", str(threads)]+args[-1:]
+    prefix = [] if sys.platform == "win32" else get_priority_prefix(_config)
+    return prefix+["ffmpeg", "-hide_banner", "-y"]+args
+
+
+def run_ffmpeg(args: List[str], logfile, name: str = '') -> subprocess.CompletedProcess:
+    """运行一次 ffmpeg：不经过 shell，按配置降低 CPU 和 I/O 优先级、限制线程数，并受全局并发数限制。
+
+    有直播间正在录制时使用 recording_threads，并发数由调度器降到 recording_max_concurrent，避免处理抢占录制。
+    """
+    if _config is None:
+        cmd = ["ffmpeg", "-hide_banner", "-y"]+args
+        return subprocess.run(cmd, check=True, stdout=logfile, stderr=logfile)
+    kwargs = {}
+    if sys.platform == "win32" and _config['nice'] > 0:
+        kwargs['creationflags'] = subprocess.BELOW_NORMAL_PRIORITY_CLASS
+    with slot(_scheduler, 'ffmpeg_process', 0, name or args[-1]):
+        cmd = build_command(args, is_recording())
+        logging.debug("运行 ffmpeg：%s", cmd)
+        return subprocess.run(cmd, check=True, stdout=logfile, stderr=logfile, **kwargs)
@@ -0,0 +1,144 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+
+# 等待时间每增加 AGING_SECONDS 秒，作业的有效优先级就提高一倍，避免大作业一直被小作业插队
+AGING_SECONDS = 600
+
+
+class JobScheduler():
+    """全局处理作业调度器。
+
+    每种资源（ffmpeg 处理、B站上传、网盘备份）有独立的并发槽位，排队的作业按体积从小到大放行，
+    使短作业优先完成。调度器运行在主进程中，处理子进程通过 SchedulerManager 提供的代理访问。
+    有直播间正在录制时，设置了 recording_limits 的资源改用其中更小的并发数。
+    """
+
+    def __init__(self, limits: dict, recording_limits: dict = None):
+        self.cond = threading.Condition()
+        self.limits = dict(limits)
+        self.recording_limits = dict(recording_limits or {})
+        self.recording = set()
+        self.running = {}
+        self.waiting = {}
+        self.wait_times = {}
+        self.seq = 0
+
+    def set_limits(self, limits: dict, recording_limits: dict = None) -> None:
+        with self.cond:
+            self.limits.update(limits)
+            if recording_limits is not None:
+                self.recording_limits = dict(recording_limits)
+            self.cond.notify_all()
+
+    def set_recording(self, name: str, recording: bool) -> None:
+        with self.cond:
+            if recording:
+                self.recording.add(name)
+            else:
+                self.recording.discard(name)
+            self.cond.notify_all()
+
+    def recording_count(self) -> int:
+        with self.cond:
+            return len(self.recording)
+
+    def __limit(self, resource: str) -> int:
+        limit = self.limits.get(resource, 1)
+        if self.recording and resource in self.recording_limits:
+            limit = min(limit, self.recording_limits[resource])
+        return limit
+
+    def __pick(self, resource: str) -> dict:
+        now = time.time()
+        return min(self.waiting[resource],
+                   key=lambda job: (job['priority']/(1+(now-job['enqueue_time'])/AGING_SECONDS), job['seq']))
+
+    def __reap(self) -> None:
+        # 子进程异常退出时不会释放槽位，回收已不存在的进程占用的槽位
+        alive = {p.pid for p in multiprocessing.active_children()}
+        alive.add(os.getpid())
+        for resource, jobs in self.running.items():
+            for job in [job for job in jobs if job['pid'] not in alive]:
+                logging.warning("回收已退出进程占用的%s槽位：%s", resource, job['name'])
+                jobs.remove(job)
+                self.cond.notify_all()
+
+    def acquire(self, resource: str, priority: float = 0, name: str = '', pid: int = None) -> int:
+        with self.cond:
+            self.seq += 1
+            job = {
+                'seq': self.seq,
+                'name': name,
+                'pid': pid or os.getpid(),
+                'priority': priority,
+                'enqueue_time': time.time()
+            }
+            self.waiting.setdefault(resource, []).append(job)
+            running = self.running.setdefault(resource, [])
+            while len(running) >= self.__limit(resource) or self.__pick(resource) is not job:
+                self.cond.wait(5)
+                self.__reap()
+            self.waiting[resource].remove(job)
+            running.append(job)
+            wait = time.time()-job['enqueue_time']
+            self.wait_times.setdefault(resource, deque(maxlen=50)).append(wait)
+            logging.info("%s 获得%s槽位，等待 %.1f 秒", name, resource, wait)
+            return job['seq']
+
+    def release(self, resource: str, seq: int) -> None:
+        with self.cond:
+            running = self.running.get(resource, [])
+            running[:] = [job for job in running if job['seq'] != seq]
+            self.cond.notify_all()
+
+    def stats(self) -> dict:
+        with self.cond:
+            now = time.time()
+            result = {}
+            for resource in sorted(set(self.limits) | set(self.waiting)):
+                waiting = self.waiting.get(resource, [])
+                wait_times = self.wait_times.get(resource, [])
+                result[resource] = {
+                    'limit': self.__limit(resource),
+                    'running': [job['name'] for job in self.running.get(resource, [])],
+                    'waiting': [job['name'] for job in waiting],
+                    'avg_wait': sum(wait_times)/len(wait_times) if wait_times else 0,
+                    'max_waiting': max((now-job['enqueue_time'] for job in waiting), default=0)
+                }
+            return result
+
+
+class SchedulerManager(BaseManager):
+    pass
+
+
+def start_scheduler(limits: dict) -> tuple:
+    """在主进程的后台线程中启动调度服务，返回调度器本体和可传给子进程的代理。"""
+    scheduler = JobScheduler(limits)
+    SchedulerManager.register('get_scheduler', callable=lambda: scheduler)
+    server = SchedulerManager().get_server()
+    threading.Thread(target=server.serve_forever,
+                     name="JobScheduler", daemon=True).start()
+    client = SchedulerManager(address=server.address)
+    client.connect()
+    return scheduler, client.get_scheduler()
+
+
+@contextmanager
+def slot(scheduler, resource: str, priority: float = 0, name: str = ''):
+    """占用一个资源槽位，scheduler 为 None 时（如单独恢复处理）不做限制。"""
+    if scheduler is None:
+        yield
+        return
+    seq = scheduler.acquire(resource, priority, name, os.getpid())
+    try:
+        yield
+    finally:
+        scheduler.release(resource, seq)
+
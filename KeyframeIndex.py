@@ -0,0 +1,147 @@
+import bisect
+import os
+import struct
+from collections import namedtuple
+from typing import List, Tuple
+
+FLV_TAG_AUDIO = 8
+FLV_TAG_VIDEO = 9
+FLV_TAG_SCRIPT = 18
+
+INDEX_ENTRY = struct.Struct(">IQ")  # 时间戳（毫秒），字节偏移
+
+FlvTag = namedtuple(
+    'FlvTag', ['offset', 'tag_type', 'timestamp', 'data_size', 'keyframe', 'sequence_header'])
+
+
+class FlvTagParser():
+    """增量解析 FLV 标签头。
+
+    只读取每个标签的 11 字节头和数据区前 2 字节，不缓存也不解码音视频数据，
+    可以直接喂入录制时收到的任意大小的数据块。
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.header_done = False
+        self.buf = bytearray()
+        self.skip = 0
+
+    def feed(self, chunk: bytes) -> List[FlvTag]:
+        tags = []
+        pos = 0
+        length = len(chunk)
+        while pos < length:
+            if self.skip:
+                n = min(self.skip, length-pos)
+                self.skip -= n
+                pos += n
+                self.offset += n
+                continue
+            need = self.__need()
+            if len(self.buf) < need:
+                n = min(need-len(self.buf), length-pos)
+                self.buf += chunk[pos:pos+n]
+                pos += n
+                self.offset += n
+                continue
+            if not self.header_done:
+                if self.buf[:3] != b'FLV':
+                    raise ValueError("不是有效的FLV数据")
+                data_offset = struct.unpack(">I", self.buf[5:9])[0]
+                self.header_done = True
+                self.buf = bytearray()
+                self.skip = data_offset-9+4  # 跳过剩余文件头和 PreviousTagSize0
+                continue
+            tag = self.__parse_tag()
+            tags.append(tag)
+            self.buf = bytearray()
+            self.skip = tag.data_size-min(tag.data_size, 2)+4
+        return tags
+
+    def __need(self) -> int:
+        if not self.header_done:
+            return 9
+        if len(self.buf) < 11:
+            return 11
+        data_size = struct.unpack(">I", b'\x00'+bytes(self.buf[1:4]))[0]
+        return 11+min(data_size, 2)
+
+    def __parse_tag(self) -> FlvTag:
+        tag_type = self.buf[0] & 0x1F
+        data_size = struct.unpack(">I", b'\x00'+bytes(self.buf[1:4]))[0]
+        timestamp = struct.unpack(">I", bytes(
+            self.buf[7:8]+self.buf[4:7]))[0]
+        body = self.buf[11:]
+        keyframe = False
+        sequence_header = False
+        if tag_type == FLV_TAG_VIDEO and len(body) >= 1:
+            keyframe = (body[0] >> 4) == 1
+            # AVC / HEVC 的 AVCPacketType 为 0 时是解码器配置
+            sequence_header = (body[0] & 0x0F) in (7, 12) and len(
+                body) >= 2 and body[1] == 0
+        elif tag_type == FLV_TAG_AUDIO and len(body) >= 2:
+            sequence_header = (body[0] >> 4) == 10 and body[1] == 0
+        elif tag_type == FLV_TAG_SCRIPT:
+            sequence_header = True
+        return FlvTag(self.offset-len(self.buf), tag_type, timestamp, data_size, keyframe and not sequence_header, sequence_header)
+
+
+def get_index_path(flv_path: str) -> str:
+    return os.path.splitext(flv_path)[0]+".kfi"
+
+
+class KeyframeIndexWriter():
+    """录制时边写边建立关键帧索引（时间戳 → 字节偏移），每个关键帧占 12 字节。"""
+
+    def __init__(self, flv_path: str):
+        self.parser = FlvTagParser()
+        self.index_file = open(get_index_path(flv_path), "wb")
+        self.keyframes = 0
+
+    def feed(self, chunk: bytes) -> List[FlvTag]:
+        tags = self.parser.feed(chunk)
+        for tag in tags:
+            if tag.keyframe:
+                self.index_file.write(INDEX_ENTRY.pack(
+                    tag.timestamp, tag.offset))
+                # 直播中上传等功能会读取正在增长的索引，每个关键帧都立即落盘
+                self.index_file.flush()
+                self.keyframes += 1
+        return tags
+
+    def close(self) -> None:
+        self.index_file.close()
+
+    def discard(self) -> None:
+        self.index_file.close()
+        os.remove(self.index_file.name)
+
+
+def load_keyframe_index(flv_path: str) -> List[Tuple[int, int]]:
+    index_path = get_index_path(flv_path)
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, "rb") as f:
+        data = f.read()
+    data = data[:len(data)-len(data) % INDEX_ENTRY.size]
+    return list(INDEX_ENTRY.iter_unpack(data))
+
+
+def get_keyframe_times(flv_path: str) -> List[float]:
+    """返回片段内关键帧相对于第一个关键帧的时间（秒）。"""
+    index = load_keyframe_index(flv_path)
+    if not index:
+        return []
+    first = index[0][0]
+    return [(ts-first)/1000 for ts, _ in index]
+
+
+def snap_to_keyframe(keyframes: List[float], point: float) -> float:
+    """返回不晚于 point 的最后一个关键帧时间，没有索引时原样返回。"""
+    if not keyframes:
+        return point
+    i = bisect.bisect_right(keyframes, point)
+    if i == 0:
+        return 0.0
+    return keyframes[i-1]
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+import struct
+import threading
+import traceback
+import zlib
+
+from BiliLive import BiliLive
+
+HEARTBEAT_SECONDS = 30
+MAX_RETRY_SECONDS = 300
+
+
+def pack(data: bytes, protocol_version: int, datapack_type: int) -> bytes:
+    header = struct.pack(">HHII", 16, protocol_version, datapack_type, 1)
+    return struct.pack(">I", len(header)+len(data)+4)+header+data
+
+
+def iter_commands(data: bytes):
+    """解出数据包中所有通知消息的 cmd，压缩包和粘在一起的多个包都会展开。"""
+    while len(data) >= 16:
+        packet_len, _, ver, op, _ = struct.unpack(">IHHII", data[:16])
+        body = data[16:packet_len]
+        data = data[packet_len:]
+        if ver == 3:
+            import brotli
+            yield from iter_commands(brotli.decompress(body))
+        elif ver == 2:
+            yield from iter_commands(zlib.decompress(body))
+        elif op == 5:
+            try:
+                yield json.loads(body.decode('utf-8', errors='ignore')).get('cmd', '')
+            except ValueError:
+                continue
+
+
+class LiveEventListener(threading.Thread):
+    """常驻的开播事件监听。
+
+    每个监控中的直播间保持一个只解析 cmd 的弹幕连接，收到 LIVE 消息时设置 live_event，
+    主循环据此立即检查直播状态，不必等到下一次定时检查。连接断开后按指数退避重连。
+    """
+
+    def __init__(self, config: dict, live_event: threading.Event):
+        threading.Thread.__init__(self, daemon=True)
+        self.bl = BiliLive(config)
+        self.name = f"LiveEventListener-{self.bl.room_id}"
+        self.live_event = live_event
+        self.stopped = threading.Event()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    async def __heart_beat(self, websocket) -> None:
+        hb = pack(b'[object Object]', 1, 2)
+        while not self.stopped.is_set():
+            await websocket.send(hb)
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+
+    async def __receive(self, websocket) -> None:
+        # 服务器每次回应心跳都会发消息，停止后最多再等一个心跳周期
+        while not self.stopped.is_set():
+            data = await websocket.receive()
+            if not data:
+                continue
+            for cmd in iter_commands(data):
+                if cmd == 'LIVE':
+                    logging.info(self.bl.generate_log("收到开播消息"))
+                    self.live_event.set()
+                elif cmd == 'PREPARING':
+                    logging.info(self.bl.generate_log("收到下播消息"))
+
+    async def __listen(self) -> None:
+        # 只在监听线程中导入，开启开播监听不会拖慢主进程启动
+        from aiowebsocket.converses import AioWebSocket
+        # 短号需要先换成完整房间号才能进入弹幕服务器
+        self.bl.get_room_info()
+        conf = self.bl.get_room_conf()
+        host = conf['available_hosts'][0]
+        verify_data = {"uid": 0, "roomid": int(self.bl.room_id),
+                       "protover": 3, "platform": "web", "type": 2, "key": conf['token']}
+        async with AioWebSocket(f"wss://{host['host']}:{host['wss_port']}/sub") as aws:
+            converse = aws.manipulator
+            await converse.send(pack(json.dumps(verify_data).encode(), 1, 7))
+            tasks = [asyncio.ensure_future(self.__receive(converse)),
+                     asyncio.ensure_future(self.__heart_beat(converse))]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    def run(self) -> None:
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                asyncio.run(self.__listen())
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logging.warning(self.bl.generate_log(
+                    "开播事件监听连接断开：" + str(e)))
+                logging.debug(traceback.format_exc())
+            self.stopped.wait(min(5*2**failures, MAX_RETRY_SECONDS))
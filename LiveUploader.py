@@ -0,0 +1,285 @@
+import bisect
+import datetime
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+import traceback
+
+from bilibiliuploader.core import VideoPart
+
+import FFmpegRunner
+import utils
+from BiliLive import BiliLive
+from FFmpegRunner import run_ffmpeg
+from KeyframeIndex import load_keyframe_index
+from MediaCache import MediaCache
+from SessionManifest import SessionManifest
+from Uploader import Uploader
+
+
+def get_segment_start(filename: str) -> datetime.datetime:
+    base = os.path.splitext(filename)[0]
+    return datetime.datetime.strptime(
+        " ".join(base.split("_")[1:3]), '%Y-%m-%d %H-%M-%S')
+
+
+def remux(input_file: str, output_file: str, ffmpeg_logfile_hander) -> subprocess.CompletedProcess:
+    ret = run_ffmpeg(["-fflags", "+discardcorrupt", "-i", input_file, "-c", "copy", "-avoid_negative_ts", "make_zero",
+                      output_file], ffmpeg_logfile_hander)
+    return ret
+
+
+class LiveUploader(BiliLive):
+    """直播中上传录播。
+
+    按关键帧索引把正在录制的 FLV 每满 live_upload_interval 秒截出一段（为 0 时按录制片段），
+    转封装为 mp4 后立即上传：第一段创建稿件，之后的分段通过编辑稿件追加，下播后几分钟内完整录播即可上线。
+
+    每个分段的状态（pending / confirmed）记录在状态文件中，只有加入稿件后才算确认，分P文件的上传结果
+    记录在与下播后上传共用的上传状态中。失败的分段按时间顺序插入到稿件中对应的位置，下播后重试所有未确认的分段，
+    仍有未确认的分段时由处理进程在同一稿件中继续补传；还没有创建稿件时，处理进程改为按常规流程切分并上传完整录播。
+    """
+
+    def __init__(self, config: dict, global_start: datetime.datetime, roomname: str, metrics=None, scheduler=None):
+        BiliLive.__init__(self, config)
+        self.config = config
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.global_start = global_start
+        self.roomname = roomname
+        # 处理进程补传时原始录像可能已被删除，只在直播中上传时创建录像目录
+        self.record_dir = None
+        self.splits_dir = utils.init_splits_dir(
+            self.room_id, global_start, config['root']['data_path'])
+        self.interval = config['spec']['uploader']['record']['live_upload_interval']
+        self.state = SessionManifest(utils.get_live_upload_state_path(
+            self.room_id, global_start, config['root']['data_path']))
+        # {文件名: {'chunks': 已确认的分段数, 'complete': 是否已全部截出, 'parts': {序号: 分段状态}}}
+        self.segments = self.state.get('segments', {})
+        for segment in self.segments.values():
+            segment.setdefault('parts', {})
+        # 扫描线程和上传线程都会修改 segments
+        self.lock = threading.Lock()
+        self.part_queue = queue.Queue()
+        self.uploader = None
+        self.upload_state = None
+        self.ffmpeg_logfile_hander = None
+        self.media_cache = MediaCache(config['root']['data_path'])
+
+    def __extract(self, path: str, header_end: int, start: int, end: int, part_name: str) -> str:
+        # 文件头、元数据和解码器配置位于第一个关键帧之前，拼在每一段的开头使其可以独立解码
+        output_file = os.path.join(self.splits_dir, part_name+".flv")
+        with open(path, "rb") as src, open(output_file, "wb") as dst:
+            dst.write(src.read(header_end))
+            src.seek(start)
+            remaining = end-start
+            while remaining > 0:
+                data = src.read(min(remaining, 4*1024*1024))
+                if not data:
+                    break
+                dst.write(data)
+                remaining -= len(data)
+        return output_file
+
+    def __save(self) -> None:
+        with self.lock:
+            self.state.set('segments', self.segments)
+
+    def __emit(self, path: str, header_end: int, start: int, end: int, start_time: float, end_time: float) -> None:
+        filename = os.path.basename(path)
+        segment = self.segments[filename]
+        index = str(len(segment['parts']))
+        part_name = f"live_{os.path.splitext(filename)[0]}_{int(index):02}"
+        flv_file = self.__extract(path, header_end, start, end, part_name)
+        segment_start = get_segment_start(filename)
+        title = (segment_start+datetime.timedelta(seconds=start_time)).strftime('%H:%M:%S~') + \
+            (segment_start+datetime.timedelta(seconds=end_time)).strftime('%H:%M:%S')
+        with self.lock:
+            segment['parts'][index] = {
+                'flv': flv_file, 'title': title, 'status': 'pending'}
+        self.__save()
+        self.part_queue.put((filename, index))
+
+    def __file_duration(self, path: str) -> float:
+        try:
+            return self.media_cache.duration(path)
+        except Exception as e:
+            logging.warning("读取 %s 的时长失败，按文件修改时间估算：%s", path, str(e))
+        return max(0, os.path.getmtime(path)-get_segment_start(os.path.basename(path)).timestamp())
+
+    def scan(self, stopping: bool = False) -> None:
+        filelist = sorted(filename for filename in os.listdir(self.record_dir)
+                          if os.path.splitext(filename)[1] == ".flv")
+        for n, filename in enumerate(filelist):
+            path = os.path.join(self.record_dir, filename)
+            # 录制器每次重连都会换一个新文件，除最后一个文件外都已经录完
+            finished = stopping or n < len(filelist)-1
+            with self.lock:
+                segment = self.segments.setdefault(
+                    filename, {'chunks': 0, 'complete': False, 'parts': {}})
+            if segment['complete']:
+                continue
+            index = load_keyframe_index(path)
+            size = os.path.getsize(path)
+            if not index:
+                # 没有索引时只能整段上传
+                if finished and size > 1024*1024:
+                    self.__emit(path, 0, 0, size, 0,
+                                self.__file_duration(path))
+            else:
+                first_ts, header_end = index[0]
+                times = [ts-first_ts for ts, _ in index]
+                while True:
+                    # 已截出的分段不论是否确认都不再重复截取
+                    emitted = len(segment['parts'])
+                    i = bisect.bisect_left(
+                        times, emitted*self.interval*1000) if self.interval > 0 else 0
+                    j = bisect.bisect_left(
+                        times, (emitted+1)*self.interval*1000) if self.interval > 0 else len(times)
+                    if i < len(times) and j < len(times):
+                        self.__emit(path, header_end, index[i][1], index[j][1],
+                                    times[i]/1000, times[j]/1000)
+                        continue
+                    if finished and i < len(times) and size-index[i][1] > 1024*1024:
+                        self.__emit(path, header_end, index[i][1], size,
+                                    times[i]/1000, times[-1]/1000)
+                    break
+            if finished:
+                with self.lock:
+                    segment['complete'] = True
+                self.__save()
+
+    def pending_parts(self) -> list:
+        with self.lock:
+            return [(filename, index) for filename, segment in sorted(self.segments.items())
+                    for index, part in sorted(segment['parts'].items(), key=lambda x: int(x[0]))
+                    if part['status'] != 'confirmed']
+
+    def __insert_index(self, filename: str, index: str) -> int:
+        # 稿件中的分P按时间排列，重试的分段插在时间上位于它之前的已确认分段之后
+        with self.lock:
+            return sum(1 for other, segment in self.segments.items() for i, part in segment['parts'].items()
+                       if part['status'] == 'confirmed' and (other, int(i)) < (filename, int(index)))
+
+    def upload_part(self, filename: str, index: str) -> bool:
+        """转封装并上传一个分段，加入稿件后才标记为已确认，失败时保持 pending 等待重试。"""
+        segment = self.segments[filename]
+        entry = segment['parts'][index]
+        datestr = self.global_start.strftime(
+            '%Y{y}%m{m}%d{d}').format(y='年', m='月', d='日')
+        try:
+            mp4_file = os.path.splitext(entry['flv'])[0]+".mp4"
+            # 重试时 flv 可能已经转封装并删除
+            if os.path.exists(entry['flv']):
+                remux(entry['flv'], mp4_file, self.ffmpeg_logfile_hander)
+                os.remove(entry['flv'])
+            part = VideoPart(
+                path=mp4_file,
+                title=entry['title'],
+                desc=self.config['spec']['uploader']['record']['desc'].format(
+                    date=datestr, title=self.roomname),
+            )
+            start = time.time()
+            bvid = self.uploader.append_record_part(
+                part, datestr, self.state.get('bvid'), self.upload_state, self.__insert_index(filename, index))
+            with self.lock:
+                self.state.set('bvid', bvid)
+        except Exception as e:
+            logging.error(self.generate_log(
+                f'直播中上传分P {entry["title"]} 失败，下播后重试：' + str(e)+traceback.format_exc()))
+            return False
+        with self.lock:
+            entry['status'] = 'confirmed'
+            segment['chunks'] += 1
+        self.__save()
+        logging.info(self.generate_log(
+            f"直播中上传分P完成：{entry['title']} 稿件：{bvid} 用时 {time.time()-start:.1f} 秒"))
+        return True
+
+    def upload_parts(self) -> None:
+        while True:
+            filename, index = self.part_queue.get()
+            if filename is None:
+                break
+            self.upload_part(filename, index)
+
+    def run(self, stop_event, extracted_event, log_queue=None) -> None:
+        upload_thread = None
+        try:
+            # 初始化失败时也要通知主进程，否则主进程会一直等待截取完成而不处理录像
+            utils.init_logging(self.config, log_queue, "LiveUploader")
+            FFmpegRunner.configure(self.config['root']['ffmpeg'], self.scheduler)
+            self.record_dir = utils.init_record_dir(
+                self.room_id, self.global_start, self.config['root']['data_path'])
+            self.__prepare()
+            # 重启后先上传状态文件中尚未确认的分段
+            for filename, index in self.pending_parts():
+                self.part_queue.put((filename, index))
+            upload_thread = threading.Thread(
+                target=self.upload_parts, name="LiveUploader")
+            upload_thread.start()
+            while not stop_event.wait(30):
+                try:
+                    self.scan()
+                except Exception as e:
+                    logging.error(self.generate_log(
+                        'Error while scanning records:' + str(e)+traceback.format_exc()))
+            self.scan(stopping=True)
+        except Exception as e:
+            logging.error(self.generate_log(
+                'Error while scanning records:' + str(e)+traceback.format_exc()))
+        finally:
+            # 最后的分段已经截出，原始录像可以交给处理进程了
+            extracted_event.set()
+            self.part_queue.put((None, None))
+        if upload_thread is None:
+            # 初始化失败，状态中没有 finished 标记，处理进程会按常规流程切分上传
+            if self.ffmpeg_logfile_hander is not None:
+                self.ffmpeg_logfile_hander.close()
+            return
+        upload_thread.join()
+        try:
+            self.finish()
+        finally:
+            self.ffmpeg_logfile_hander.close()
+
+    def __prepare(self) -> None:
+        self.ffmpeg_logfile_hander = open(os.path.join(self.config['root']['logger']['log_path'], "FFMpeg_"+datetime.datetime.now(
+        ).strftime('%Y-%m-%d_%H-%M-%S')+'.log'), mode="a", encoding="utf-8")
+        self.uploader = Uploader(None, self.splits_dir,
+                                 self.config, self.roomname, self.metrics, self.scheduler)
+        self.upload_state = self.uploader.get_upload_state(self.global_start)
+
+    def finish(self) -> bool:
+        """重试所有未确认的分段并记录结果，全部加入稿件时添加过审检查任务并返回 True。"""
+        try:
+            for filename, index in self.pending_parts():
+                self.upload_part(filename, index)
+        finally:
+            pending = self.pending_parts()
+            self.state.set('confirmed', not pending)
+            self.state.set('finished', True)
+        bvid = self.state.get('bvid')
+        if pending:
+            if bvid is None:
+                logging.error(self.generate_log(
+                    f"直播中上传有 {len(pending)} 个分段未能加入稿件，处理进程将按常规流程切分并上传完整录播"))
+            else:
+                logging.error(self.generate_log(
+                    f"直播中上传有 {len(pending)} 个分段未能加入稿件{bvid}，将在处理时继续补传"))
+            return False
+        if bvid is not None and not self.config['spec']['uploader']['record']['keep_record_after_upload']:
+            from BiliVideoChecker import add_review_job
+            add_review_job(bvid, self.splits_dir, self.config)
+        return True
+
+    def resume_upload(self) -> bool:
+        """在处理进程中补传直播中上传未确认的分段，加入到同一稿件而不是重新投稿。"""
+        self.__prepare()
+        try:
+            return self.finish()
+        finally:
+            self.ffmpeg_logfile_hander.close()
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from bilibiliuploader import core
+from bilibiliuploader.bilibiliuploader import BilibiliUploader
+
+import utils
+
+# 未登录、access_key 错误、令牌过期
+AUTH_ERROR_CODES = (-101, -2, -658)
+AUTH_ERROR_PATTERN = re.compile(r"""['"]?code['"]?\s*[:=]\s*(-\d+)""")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_token_path(config: dict) -> str:
+    # 令牌与密码同样敏感，与密码文件放在一起
+    return os.path.join(os.path.dirname(os.path.abspath(config['password_path'])), "tokens.json")
+
+
+def _load_tokens(token_path: str) -> dict:
+    try:
+        with open(token_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_token(token_path: str, username: str, token: dict) -> None:
+    tokens = _load_tokens(token_path)
+    if token is None:
+        tokens.pop(username, None)
+    else:
+        tokens[username] = token
+    tmp_path = token_path+f".{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(tokens, f)
+    os.replace(tmp_path, token_path)
+
+
+class LoginSession():
+    def __init__(self, username: str):
+        self.username = username
+        self.lock = threading.Lock()
+        self.uploader = None
+        self.expires_at = 0
+
+    def __fresh(self, refresh_before: float) -> bool:
+        return self.uploader is not None and self.expires_at-time.time() > refresh_before
+
+    def get(self, config: dict) -> BilibiliUploader:
+        uploader_config = config['root']['uploader']
+        refresh_before = uploader_config['token_refresh_days']*86400
+        with self.lock:
+            if self.__fresh(refresh_before):
+                return self.uploader
+            token_path = get_token_path(config)
+            with utils.FileLock(token_path):
+                # 其他进程可能刚刚登录过，优先使用磁盘上的令牌
+                token = _load_tokens(token_path).get(self.username)
+                if token is not None and token['expires_at']-time.time() > refresh_before:
+                    try:
+                        uploader = BilibiliUploader()
+                        uploader.login_by_access_token(
+                            token['access_token'], token['refresh_token'])
+                        self.uploader = uploader
+                        self.expires_at = token['expires_at']
+                        logging.info("账号 %s 使用缓存的登录令牌", self.username)
+                        return self.uploader
+                    except Exception as e:
+                        logging.warning(
+                            "账号 %s 的缓存令牌已失效，重新登录：%s", self.username, e)
+                with open(config['password_path'], "r", encoding="UTF-8") as f:
+                    pw_config = json.load(f)
+                # BilibiliUploader.login 会丢弃服务器返回的有效期，这里直接调用 core.login
+                code, access_token, refresh_token, sid, mid, expires_in = core.login(
+                    self.username, pw_config.get(self.username, None))
+                if code != 0 or access_token is None:
+                    raise RuntimeError(f"账号 {self.username} 登录失败：{code}")
+                uploader = BilibiliUploader()
+                uploader.access_token = access_token
+                uploader.refresh_token = refresh_token
+                uploader.sid = sid
+                uploader.mid = mid
+                self.uploader = uploader
+                # 服务器没有返回有效期时按配置估计
+                self.expires_at = time.time() + \
+                    (expires_in or uploader_config['token_lifetime_days']*86400)
+                _save_token(token_path, self.username, {
+                    'access_token': uploader.access_token,
+                    'refresh_token': uploader.refresh_token,
+                    'expires_at': self.expires_at
+                })
+                logging.info("账号 %s 使用密码登录，令牌已缓存，%.1f 天后过期",
+                             self.username, (self.expires_at-time.time())/86400)
+                return self.uploader
+
+    def invalidate(self, config: dict, uploader: BilibiliUploader) -> None:
+        """令牌被服务器拒绝时丢弃内存和磁盘上的缓存，下次获取时重新登录。"""
+        with self.lock:
+            # 其他线程可能已经重新登录，只丢弃出错的那个客户端
+            if self.uploader is not uploader:
+                return
+            self.uploader = None
+            self.expires_at = 0
+            token_path = get_token_path(config)
+            with utils.FileLock(token_path):
+                token = _load_tokens(token_path).get(self.username)
+                if token is not None and token['access_token'] == uploader.access_token:
+                    _save_token(token_path, self.username, None)
+            logging.warning("账号 %s 的登录令牌已被服务器拒绝，已清除缓存", self.username)
+
+
+def _get_session(config: dict) -> LoginSession:
+    username = config['spec']['uploader']['account']['username']
+    with _sessions_lock:
+        return _sessions.setdefault(username, LoginSession(username))
+
+
+def get_uploader(config: dict) -> BilibiliUploader:
+    """返回已登录的上传客户端，同一账号在进程内共享一个客户端，跨进程共享磁盘上缓存的令牌。"""
+    return _get_session(config).get(config)
+
+
+def is_auth_error(e: Exception) -> bool:
+    """根据异常信息中的 B站错误码判断是否为登录失效。"""
+    return any(int(code) in AUTH_ERROR_CODES for code in AUTH_ERROR_PATTERN.findall(str(e)))
+
+
+def relogin(config: dict, uploader: BilibiliUploader) -> BilibiliUploader:
+    """丢弃失效的令牌并重新登录，返回新的上传客户端。"""
+    _get_session(config).invalidate(config, uploader)
+    return get_uploader(config)
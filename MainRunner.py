@@ -2,34 +2,49 @@ import json
 import os
 import datetime
 import logging
+import queue
+import sys
 import threading
 import time
 import traceback
-from multiprocessing import Process, Value
+from multiprocessing import Event, Process, Queue, Value
 
+import FFmpegRunner
+import Tracing
 import utils
 from BiliLive import BiliLive
-from BiliLiveRecorder import BiliLiveRecorder
-from BiliVideoChecker import BiliVideoChecker
-from DanmuRecorder import BiliDanmuRecorder
-from Processor import Processor
-from Uploader import Uploader
+from JobScheduler import slot
+from SessionManifest import SessionManifest
+
+# 录制、弹幕、处理和上传模块只在对应的子进程中导入，
+# 主进程和每个子进程启动时都不必加载 ffmpeg、jieba、bilibiliuploader 等重量级依赖。
+
+# 收到开播消息后，在这段时间内每隔几秒检查一次直播状态，直到接口也显示开播
+LIVE_EVENT_RECHECK_WINDOW = 60
+LIVE_EVENT_RECHECK_SECONDS = 3
 
 
 class MainRunner():
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, scheduler=None, metrics=None, log_queue=None):
         self.config = config
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.log_queue = log_queue
         self.prev_live_status = False
         self.current_state = Value(
             'i', int(utils.state.WAITING_FOR_LIVE_START))
         self.state_change_time = Value('f', time.time())
-        if config['root']['enable_baiduyun']:
-            from bypy import ByPy
-            _ = ByPy()
         self.bl = BiliLive(config)
         self.blr = None
         self.bdr = None
         self.logger = utils.get_logger(config, "MainRunner")
+        # 由主线程在配置变化时设置，在没有录制时应用
+        self.pending_config = None
+        self.stop_requested = False
+        # 开播事件监听，只在主进程中使用
+        self.live_event = threading.Event()
+        self.live_listener = None
+        self.fast_check_until = 0
 
         # logging.basicConfig(level=utils.get_log_level(self.config['root']['logger']['log_level']),
         #                     format='%(asctime)s %(thread)d %(threadName)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
@@ -37,63 +52,317 @@ class MainRunner():
         #                     handlers=[logging.FileHandler(os.path.join(self.config['root']['logger']['log_path'], "MainRunner_"+datetime.datetime.now(
         #                     ).strftime('%Y-%m-%d_%H-%M-%S')+'.log'), "a", encoding="utf-8")])
 
-    def proc(self, global_start: datetime.datetime, global_end: datetime.datetime) -> None:
-        p = Processor(self.config, global_start)
-        p.run()
+    def __upload(self, p, global_start: datetime.datetime, global_end: datetime.datetime, result: dict) -> None:
+        from Uploader import Uploader
+        try:
+            # 上传槽位由 Uploader 按分P占用，等待处理切出分P时不占用
+            u = Uploader(p.outputs_dir, p.splits_dir,
+                         self.config, self.roomname, self.metrics, self.scheduler)
+            result.update(u.upload_from_queue(
+                p.part_queue, global_start, global_end))
+        except Exception as e:
+            self.upload_ok = False
+            self.logger.error('Error when uploading to Bilibili:' +
+                              str(e)+traceback.format_exc())
+
+    def __finish_live_upload(self, p) -> bool:
+        """直播中上传已经创建了稿件但还有分段未确认时，在同一稿件中补传，返回是否全部加入稿件。"""
+        from LiveUploader import LiveUploader
+        try:
+            state = p.live_upload_state()
+            if state.get('finished', False) and state.get('confirmed', False):
+                return True
+            bvid = state.get('bvid')
+            if bvid is None:
+                return False
+            p.manifest.set('live_upload_bvid', bvid)
+            if not state.get('finished', False):
+                self.logger.warning(
+                    f"{self.bl.room_id} 直播中上传进程异常退出，稿件{bvid} 可能缺少最后的分段，完整录像保留在 merged 目录")
+            lu = LiveUploader(self.config, p.global_start,
+                              self.roomname, self.metrics, self.scheduler)
+            return lu.resume_upload()
+        except Exception as e:
+            self.logger.error('Error when resuming live upload:' +
+                              str(e)+traceback.format_exc())
+            return False
 
+    def __archive(self, p) -> None:
+        from ArchiveBackend import get_archive_backend
+        try:
+            p.concat_done.wait()
+            # 合并失败或没有开始处理时同样会通知，不能把缺失或不完整的文件记为已备份
+            if not p.manifest.is_done('concat'):
+                self.archive_ok = False
+                self.logger.error(f"{self.bl.room_id} 录像未合并完成，跳过网盘备份")
+                return
+            paths = [path for path in [p.merged_file_path, p.danmu_path]
+                     if os.path.exists(path)]
+            with slot(self.scheduler, 'backup', sum(utils.get_dir_size(path) for path in paths), f"{self.bl.room_id} 备份网盘"):
+                backend = get_archive_backend(self.config)
+                uploaded, failed = backend.upload(
+                    paths, skip=lambda path: p.manifest.is_done('archive', os.path.abspath(path)))
+                for path in uploaded:
+                    p.manifest.mark_done(
+                        'archive', [path], os.path.abspath(path))
+                self.archive_ok = not failed
+        except Exception as e:
+            self.archive_ok = False
+            self.logger.error('Error when uploading to Baiduyun:' +
+                              str(e)+traceback.format_exc())
+
+    def __index_danmu(self, p) -> None:
+        from DanmuIndex import DanmuIndex
+        try:
+            index = DanmuIndex(self.config['root']['data_path'])
+            try:
+                added = index.index_session(p.danmu_path)
+            finally:
+                index.close()
+            self.logger.info(f"{self.bl.room_id} 已将 {added} 条弹幕记录导入检索索引")
+        except Exception as e:
+            self.logger.error('Error when indexing danmu:' +
+                              str(e)+traceback.format_exc())
+
+    def proc(self, global_start: datetime.datetime, global_end: datetime.datetime, live_upload_done=None) -> None:
+        utils.init_logging(self.config, self.log_queue, "Processor")
+        FFmpegRunner.configure(self.config['root']['ffmpeg'], self.scheduler)
+        if self.config['root']['enable_trace']:
+            Tracing.start_trace(utils.get_trace_path(
+                self.config['spec']['room_id'], global_start, self.config['root']['data_path']))
+        try:
+            with Tracing.span('proc', room=self.config['spec']['room_id']):
+                self.__proc(global_start, global_end, live_upload_done)
+        finally:
+            Tracing.stop_trace()
+
+    def __proc(self, global_start: datetime.datetime, global_end: datetime.datetime, live_upload_done=None) -> None:
+        from Processor import Processor
+        p = Processor(self.config, global_start, self.metrics)
+        p.live_upload_done = live_upload_done
+        p.manifest.set('roomname', self.roomname)
+        p.manifest.set('global_end', global_end.isoformat())
+        record_size = utils.get_dir_size(p.record_dir)
+        self.upload_ok = True
+        self.archive_ok = True
+
+        # 转码、合并、切分各产生一份与录像大小相当的文件
+        from SpaceManager import SpaceManager
+        space_config = self.config['root']['space']
+        required = int(record_size*space_config['output_ratio'])
+        if not SpaceManager(self.config).ensure_free(required):
+            if space_config['on_insufficient_space'] == 'refuse':
+                self.logger.error(
+                    f"磁盘剩余空间不足 {required/1024**3:.1f}GB，暂不处理 {global_start} 开始的直播，腾出空间后可通过中断恢复继续处理")
+                self.current_state.value = int(
+                    utils.state.WAITING_FOR_LIVE_START)
+                self.state_change_time.value = time.time()
+                return
+            self.logger.warning(
+                f"磁盘剩余空间可能不足以处理 {global_start} 开始的直播，预计需要 {required/1024**3:.1f}GB")
+
+        # 上传线程与处理同时进行，每切出一个分P就开始上传
+        # 直播中上传模式下通常不会有录播分P，直播中上传未全部完成时处理进程才会切分录播交给上传线程
         uploader_config = self.config['spec']['uploader']
+        upload_thread = None
+        d = {}
         if uploader_config['record']['upload_record'] or uploader_config['clips']['upload_clips']:
+            p.part_queue = queue.Queue()
+            upload_thread = threading.Thread(target=self.__upload, args=(
+                p, global_start, global_end, d), name="Uploader")
+            upload_thread.start()
+
+        # 归档与处理、B站上传同时进行，合并完成后即开始上传
+        archive_thread = None
+        if self.config['root']['enable_baiduyun'] and self.config['spec']['backup']:
+            archive_thread = threading.Thread(
+                target=self.__archive, args=(p,), name="Archiver")
+            archive_thread.start()
+
+        self.current_state.value = int(utils.state.WAITING_FOR_RESOURCE)
+        self.state_change_time.value = time.time()
+        try:
+            with slot(self.scheduler, 'ffmpeg', record_size, f"{self.bl.room_id} 处理录像"):
+                self.current_state.value = int(
+                    utils.state.PROCESSING_RECORDS)
+                self.state_change_time.value = time.time()
+                p.run()
+        finally:
+            p.concat_done.set()
+            if p.part_queue is not None:
+                p.part_queue.put((None, None, None))
+
+        # 弹幕导入检索索引不占用 ffmpeg 资源，与上传、归档同时进行
+        index_thread = None
+        if self.config['root']['enable_danmu_index']:
+            index_thread = threading.Thread(
+                target=self.__index_danmu, args=(p,), name="DanmuIndexer")
+            index_thread.start()
+
+        if upload_thread is not None:
+            from BiliVideoChecker import add_review_job
             self.current_state.value = int(utils.state.UPLOADING_TO_BILIBILI)
             self.state_change_time.value = time.time()
-            u = Uploader(p.outputs_dir, p.splits_dir,
-                         self.config, self.roomname)
-            d = u.upload(global_start, global_end)
+            upload_thread.join()
             if not uploader_config['record']['keep_record_after_upload'] and d.get("record", None) is not None and not self.config['root']['uploader']['upload_by_edit']:
-                rc = BiliVideoChecker(d['record']['bvid'],
-                                      p.splits_dir, self.config)
-                rc.start()
+                add_review_job(d['record']['bvid'],
+                               p.splits_dir, self.config)
             if not uploader_config['clips']['keep_clips_after_upload'] and d.get("clips", None) is not None and not self.config['root']['uploader']['upload_by_edit']:
-                cc = BiliVideoChecker(d['clips']['bvid'],
-                                      p.outputs_dir, self.config)
-                cc.start()
+                add_review_job(d['clips']['bvid'],
+                               p.outputs_dir, self.config)
 
-        try:
-            if self.config['root']['enable_baiduyun'] and self.config['spec']['backup']:
+        if archive_thread is not None:
+            if archive_thread.is_alive():
                 self.current_state.value = int(
                     utils.state.UPLOADING_TO_BAIDUYUN)
                 self.state_change_time.value = time.time()
-                from bypy import ByPy
-                bp = ByPy()
-                bp.upload(p.merged_file_path, remotepath="/L_archives/")
-                bp.upload(p.danmu_path, remotepath="/L_archives/")
-        except Exception as e:
-            self.logger.error('Error when uploading to Baiduyun:' +
-                              str(e)+traceback.format_exc())
+            archive_thread.join()
+
+        if index_thread is not None:
+            index_thread.join()
+
+        # 直播中上传的分段全部加入稿件，或没有创建稿件时改为下播后切分上传并已成功
+        record_config = uploader_config['record']
+        live_upload_ok = True
+        if record_config['upload_record'] and record_config['live_upload']:
+            live_upload_ok = d.get('record', None) is not None or self.__finish_live_upload(p)
+
+        # 全部完成后录像才会在磁盘空间不足时被清理
+        p.manifest.set('finished', bool(p.manifest.get('processed')) and self.upload_ok and
+                       all(v is not None for v in d.values()) and live_upload_ok and self.archive_ok)
 
         if self.current_state.value != int(utils.state.LIVE_STARTED):
             self.current_state.value = int(utils.state.WAITING_FOR_LIVE_START)
             self.state_change_time.value = time.time()
 
+    def resume(self, global_start: datetime.datetime) -> None:
+        manifest = SessionManifest(utils.get_manifest_path(
+            self.config['spec']['room_id'], global_start, self.config['root']['data_path']))
+        self.roomname = manifest.get('roomname', '')
+        global_end = manifest.get('global_end')
+        global_end = datetime.datetime.fromisoformat(
+            global_end) if global_end else datetime.datetime.now()
+        self.logger.info(f"恢复处理 {global_start} 开始的直播")
+        self.proc(global_start, global_end)
+
+    def __getstate__(self):
+        # 处理进程不需要开播事件监听（spawn 启动时也无法 pickle 线程和事件）
+        state = self.__dict__.copy()
+        state['live_event'] = None
+        state['live_listener'] = None
+        return state
+
+    def start_live_listener(self) -> None:
+        self.stop_live_listener()
+        if self.config['root']['enable_live_listener']:
+            from LiveEventListener import LiveEventListener
+            self.live_listener = LiveEventListener(
+                self.config, self.live_event)
+            self.live_listener.start()
+
+    def stop_live_listener(self) -> None:
+        if self.live_listener is not None:
+            self.live_listener.stop()
+            self.live_listener = None
+
+    @staticmethod
+    def wait_live_upload(live_upload_process, live_upload_done) -> None:
+        live_upload_process.join()
+        live_upload_done.set()
+
+    def set_recording(self, recording: bool) -> None:
+        # 有直播间正在录制时，调度器会降低 ffmpeg 的并发数和线程数
+        if self.scheduler is None:
+            return
+        try:
+            self.scheduler.set_recording(str(self.bl.room_id), recording)
+        except Exception as e:
+            self.logger.error(f"更新录制状态失败：{e}")
+
+    def wait_for_live(self) -> None:
+        """等待到下一次检查直播状态：通常按 check_interval 轮询，收到开播消息时提前检查。"""
+        interval = self.config['root']['check_interval']
+        if time.time() < self.fast_check_until:
+            interval = LIVE_EVENT_RECHECK_SECONDS
+        if self.live_event.wait(interval):
+            self.live_event.clear()
+            self.fast_check_until = time.time()+LIVE_EVENT_RECHECK_WINDOW
+        if time.time() < self.fast_check_until:
+            self.bl.expire_live_status()
+
+    def reconfigure(self) -> None:
+        config, self.pending_config = self.pending_config, None
+        self.config = config
+        self.bl = BiliLive(config)
+        self.logger.setLevel(utils.get_log_level(
+            config['root']['logger']['log_level']))
+        self.start_live_listener()
+        self.logger.info(f"{self.bl.room_id} 已应用新的配置")
+
     def run(self):
         proc_process = None
+        self.start_live_listener()
         try:
             while True:
+                if self.stop_requested:
+                    self.logger.info(f"{self.bl.room_id} 已从配置中移除，停止监控")
+                    return
+                if self.pending_config is not None:
+                    self.reconfigure()
                 if not self.prev_live_status and self.bl.live_status:
+                    from BiliLiveRecorder import BiliLiveRecorder
+                    from DanmuRecorder import BiliDanmuRecorder
                     start = datetime.datetime.now()
-                    self.blr = BiliLiveRecorder(self.config, start)
-                    self.bdr = BiliDanmuRecorder(self.config, start)
-                    record_process = Process(target=self.blr.run)
-                    danmu_process = Process(target=self.bdr.run)
+                    self.blr = BiliLiveRecorder(
+                        self.config, start, self.metrics, self.scheduler)
+                    self.bdr = BiliDanmuRecorder(
+                        self.config, start, self.metrics)
+                    # 弹幕进程检测到弹幕突增时，通过该队列让录制进程保存即时回放
+                    replay_queue = Queue() if self.config['spec']['replay']['enabled'] else None
+                    record_process = Process(
+                        target=self.blr.run, args=(self.log_queue, replay_queue))
+                    danmu_process = Process(
+                        target=self.bdr.run, args=(self.log_queue, replay_queue))
                     danmu_process.start()
                     record_process.start()
+                    self.set_recording(True)
+                    # 已经开播，之前收到的开播消息不再需要加快检查
+                    self.live_event.clear()
+                    self.fast_check_until = 0
 
                     self.current_state.value = int(utils.state.LIVE_STARTED)
                     self.state_change_time.value = time.time()
                     self.prev_live_status = True
                     self.roomname = self.bl.get_room_info()['roomname']
 
+                    live_upload_process = None
+                    live_upload_done = None
+                    record_config = self.config['spec']['uploader']['record']
+                    if record_config['upload_record'] and record_config['live_upload']:
+                        from LiveUploader import LiveUploader
+                        stop_event = Event()
+                        extracted_event = Event()
+                        live_upload_done = Event()
+                        lu = LiveUploader(
+                            self.config, start, self.roomname, self.metrics, self.scheduler)
+                        live_upload_process = Process(
+                            target=lu.run, args=(stop_event, extracted_event, self.log_queue))
+                        live_upload_process.start()
+
                     record_process.join()
                     danmu_process.join()
+                    if live_upload_process is not None:
+                        # 等最后一段截取完毕再开始处理，处理进程会删除原始录像
+                        stop_event.set()
+                        # 上传进程异常退出时不会再通知截取完成，不能一直等待
+                        while not extracted_event.wait(5) and live_upload_process.is_alive():
+                            pass
+                        if not live_upload_process.is_alive():
+                            live_upload_process.join()
+                    self.set_recording(False)
+                    # 处理进程会 pickle 整个 MainRunner，清掉录制器引用以免子进程再导入录制模块
+                    self.blr = None
+                    self.bdr = None
 
                     end = datetime.datetime.now()
                     self.current_state.value = int(
@@ -101,41 +370,59 @@ class MainRunner():
                     self.state_change_time.value = time.time()
 
                     self.prev_live_status = False
-                    proc_process = Process(target=self.proc, args=(start, end))
+                    proc_process = Process(
+                        target=self.proc, args=(start, end, live_upload_done))
                     proc_process.start()
-                time.sleep(self.config['root']['check_interval'])
+                    if live_upload_process is not None:
+                        # 处理进程据此判断直播中上传是否全部完成，未完成时改为切分上传完整录播
+                        threading.Thread(target=self.wait_live_upload, args=(
+                            live_upload_process, live_upload_done), name="LiveUploadWaiter", daemon=True).start()
+                    # 录制期间收到的开播消息属于这一场直播，不应让下播后立即进入快速检查
+                    self.live_event.clear()
+                    self.fast_check_until = 0
+                self.wait_for_live()
         except KeyboardInterrupt:
             return
         except Exception as e:
             self.logger.error('Error in Mainrunner:' +
                               str(e)+traceback.format_exc())
+        finally:
+            self.stop_live_listener()
+            self.set_recording(False)
 
 
 class MainThreadRunner(threading.Thread):
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, scheduler=None, metrics=None, log_queue=None):
         threading.Thread.__init__(self)
-        self.mr = MainRunner(config)
+        self.mr = MainRunner(config, scheduler, metrics, log_queue)
 
     def run(self):
         self.mr.run()
 
 
 if __name__ == "__main__":
+    # 恢复中断的处理流程，已完成的阶段会被跳过：
+    # python MainRunner.py <配置文件> <密码文件> <会话名，如 5561470_2021-11-18_00-18-00>
+    from main import initroot, initspec
     if utils.is_windows():
         utils.add_path("./ffmpeg/bin")
-    with open("config/config.json", "r", encoding="UTF-8") as f:
+    with open(sys.argv[1], "r", encoding="UTF-8") as f:
         all_config = json.load(f)
+    session = os.path.basename(os.path.normpath(sys.argv[3]))
+    room_id = session.split("_")[0]
+    global_start = utils.get_global_start_from_records(session)
     root_config: dict = all_config.get('root', {})
-    spec_config = all_config.get('spec', [])[0]
+    initroot(root_config)
+    spec_config = [spec for spec in all_config.get('spec', [])
+                   if str(spec.get('room_id')) == room_id][0]
+    initspec(spec_config)
     config = {
         'root': root_config,
         'spec': spec_config,
-        'password_path': "config/passwd.json"
+        'password_path': sys.argv[2]
     }
+    utils.check_and_create_dir(root_config['logger']['log_path'])
+    utils.init_data_dirs(root_config['data_path'])
     mr = MainRunner(config)
-    start = datetime.datetime(2021, 11, 28, 22, 31, 32)
-    mr.blr = BiliLiveRecorder(mr.config, start)
-    mr.bdr = BiliDanmuRecorder(mr.config, start)
-    mr.roomname = '游戏时间！'
-    mr.proc()
+    mr.resume(global_start)
     print("end")
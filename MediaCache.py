@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import threading
+
+import ffmpeg
+
+import utils
+from Tracing import traced
+
+STREAM_FIELDS = ['index', 'codec_type', 'codec_name', 'width', 'height', 'r_frame_rate',
+                 'sample_rate', 'channels', 'bit_rate', 'duration']
+
+
+class MediaCache():
+    """媒体元数据缓存。
+
+    以 (路径, 大小, 修改时间) 为键保存时长和流信息，存放在数据目录旁的 media_cache.json 中，
+    文件未变化时直接返回缓存结果，只有未命中时才调用 ffprobe。
+    """
+
+    def __init__(self, root_dir: str = os.getcwd()):
+        self.cache_path = utils.get_media_cache_path(root_dir)
+        self.lock = threading.Lock()
+        self.entries = self.__load()
+        self.dirty = {}
+
+    def __load(self) -> dict:
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def __key(path: str) -> str:
+        return os.path.abspath(path)
+
+    def __lookup(self, path: str) -> dict:
+        stat = os.stat(path)
+        entry = self.entries.get(self.__key(path))
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry
+        return None
+
+    @traced('probe')
+    def probe(self, path: str) -> dict:
+        with self.lock:
+            entry = self.__lookup(path)
+        if entry is not None:
+            return entry
+        stat = os.stat(path)
+        info = ffmpeg.probe(path)
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'duration': float(info['format']['duration']),
+            'bit_rate': int(info['format'].get('bit_rate', 0)),
+            'streams': [{k: s[k] for k in STREAM_FIELDS if k in s} for s in info.get('streams', [])]
+        }
+        logging.debug("媒体信息缓存未命中：%s", path)
+        with self.lock:
+            self.entries[self.__key(path)] = entry
+            self.dirty[self.__key(path)] = entry
+        self.save()
+        return entry
+
+    def duration(self, path: str) -> float:
+        return self.probe(path)['duration']
+
+    def save(self) -> None:
+        # 多个处理进程可能同时写入，保存前合并磁盘上的最新内容，并清除已不存在的文件
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = self.__load()
+            entries.update(self.dirty)
+            entries = {k: v for k, v in entries.items() if os.path.exists(k)}
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(entries, f, ensure_ascii=False)
+                os.replace(tmp_path, self.cache_path)
+                self.entries = entries
+                self.dirty = {}
+            except OSError as e:
+                logging.error("保存媒体信息缓存时出现错误："+str(e))
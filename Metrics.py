@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.managers import BaseManager
+
+# 指标名称: (类型, 说明)
+METRICS = {
+    'ddrecorder_record_bytes_total': ('counter', '已录制的字节数'),
+    'ddrecorder_record_reconnects_total': ('counter', '录制断流重连次数'),
+    'ddrecorder_record_last_gap_seconds': ('gauge', '最近一次断流到重新开始录制的间隔'),
+    'ddrecorder_record_stalls_total': ('counter', '录制连接卡顿被断开重连的次数'),
+    'ddrecorder_danmu_messages_total': ('counter', '按 cmd 统计的直播间消息数'),
+    'ddrecorder_process_stage_seconds_total': ('counter', '处理各阶段累计用时'),
+    'ddrecorder_process_stage_last_seconds': ('gauge', '处理各阶段最近一次用时'),
+    'ddrecorder_upload_bytes_total': ('counter', '已上传到B站的字节数'),
+    'ddrecorder_upload_seconds_total': ('counter', '上传分P累计用时'),
+    'ddrecorder_scheduler_running': ('gauge', '各资源正在运行的作业数'),
+    'ddrecorder_scheduler_waiting': ('gauge', '各资源排队的作业数'),
+    'ddrecorder_data_bytes': ('gauge', 'data 下各目录的占用'),
+    'ddrecorder_disk_free_bytes': ('gauge', '数据目录所在磁盘的剩余空间'),
+}
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{"+",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                        for k, v in labels)+"}"
+
+
+class MetricsRegistry():
+    """运行在主进程中的指标汇总，各子进程通过 MetricsClient 批量推送计数。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {name: {} for name in METRICS}
+        self.collectors = []
+
+    def push(self, updates: list) -> None:
+        with self.lock:
+            for op, name, labels, value in updates:
+                values = self.values[name]
+                if op == 'inc':
+                    values[labels] = values.get(labels, 0)+value
+                else:
+                    values[labels] = value
+
+    def add_collector(self, collector) -> None:
+        """collector() 返回 [(指标名称, 标签元组, 值)]，在每次抓取时调用。"""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        with self.lock:
+            values = {name: dict(v) for name, v in self.values.items()}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    values[name][labels] = value
+            except Exception as e:
+                logging.error("收集指标时出现错误：%s", e)
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in sorted(values[name].items()):
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines)+"\n"
+
+
+class MetricsClient():
+    """在子进程中累积指标，每隔 flush_interval 秒合并推送一次，registry 为 None 时什么都不做。"""
+
+    def __init__(self, registry=None, flush_interval: float = 5):
+        self.registry = registry
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.last_flush = time.time()
+
+    def __getstate__(self):
+        # 录制器等对象会被传给子进程，只带上注册表代理
+        return {'registry': self.registry, 'flush_interval': self.flush_interval}
+
+    def __setstate__(self, state):
+        self.__init__(state['registry'], state['flush_interval'])
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        if self.registry is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0)+value
+        self.flush()
+
+    def set(self, name: str, value: float, **labels) -> None:
+        if self.registry is None:
+            return
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+        self.flush()
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time()-start
+            self.inc('ddrecorder_process_stage_seconds_total',
+                     elapsed, stage=stage, **labels)
+            self.set('ddrecorder_process_stage_last_seconds',
+                     elapsed, stage=stage, **labels)
+
+    def flush(self, force: bool = False) -> None:
+        if self.registry is None or (not force and time.time()-self.last_flush < self.flush_interval):
+            return
+        with self.lock:
+            updates = [('inc', name, labels, value) for (name, labels), value in self.counters.items()] + \
+                [('set', name, labels, value)
+                 for (name, labels), value in self.gauges.items()]
+            self.counters = {}
+            self.gauges = {}
+            self.last_flush = time.time()
+        if not updates:
+            return
+        try:
+            self.registry.push(updates)
+        except Exception as e:
+            # 主进程退出或连接断开时丢弃指标，不影响录制和处理
+            logging.debug("推送指标失败：%s", e)
+
+
+class MetricsManager(BaseManager):
+    pass
+
+
+class MetricsService():
+    """指标服务：在主进程中汇总指标，开启 metrics.enabled 后在本地提供 Prometheus 文本格式的 /metrics。"""
+
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        MetricsManager.register('get_registry', callable=lambda: self.registry)
+        server = MetricsManager().get_server()
+        threading.Thread(target=server.serve_forever,
+                         name="MetricsManager", daemon=True).start()
+        client = MetricsManager(address=server.address)
+        client.connect()
+        self.proxy = client.get_registry()
+        self.http_started = False
+
+    def apply_config(self, root_config: dict) -> None:
+        metrics_config = root_config['metrics']
+        if not metrics_config['enabled'] or self.http_started:
+            return
+        self.http_started = True
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            http_server = ThreadingHTTPServer(
+                (metrics_config['host'], metrics_config['port']), Handler)
+        except OSError as e:
+            logging.error("指标服务启动失败：%s", e)
+            return
+        threading.Thread(target=http_server.serve_forever,
+                         name="MetricsHTTP", daemon=True).start()
+        logging.info("指标服务已启动：http://%s:%d/metrics",
+                     metrics_config['host'], metrics_config['port'])
@@ -1,21 +1,27 @@
-import json
-from Uploader import Uploader
 import copy
 import datetime
+import json
 import logging
 import os
-import shutil
 import subprocess
+import threading
 from itertools import groupby
 from typing import Dict, List, Tuple
 
-import ffmpeg
 import jsonlines
 
 import utils
 from BiliLive import BiliLive
+from FFmpegRunner import run_ffmpeg
+from KeyframeIndex import snap_to_keyframe
+from MediaCache import MediaCache
+from Metrics import MetricsClient
+from SegmentRemuxer import MIN_SEGMENT_SIZE, remux_segment
+from SessionManifest import SessionManifest
+from Tracing import span, traced
 
 
+@traced('parse_danmu')
 def parse_danmu(dir_name):
     danmu_list = []
     if os.path.exists(os.path.join(dir_name, 'danmu.jsonl')):
@@ -74,6 +80,17 @@ def get_true_timestamp(video_times: List[Tuple[datetime.datetime, float]], point
     return time_passed
 
 
+def get_wall_time(video_times: List[Tuple[datetime.datetime, float]], offset: float) -> datetime.datetime:
+    """get_true_timestamp 的逆运算：合并文件中的时间偏移对应的实际时间，断流重连的间隔不计入偏移。"""
+    time_passed = 0
+    for t, d in video_times:
+        if offset <= time_passed+d:
+            return t+datetime.timedelta(seconds=offset-time_passed)
+        time_passed += d
+    t, d = video_times[-1]
+    return t+datetime.timedelta(seconds=d+offset-time_passed)
+
+
 def count(danmu_list: List, live_start: datetime.datetime, live_duration: float, interval: int = 60) -> Dict[datetime.datetime, List[str]]:
     start_timestamp = int(live_start.timestamp())
     return_dict = {}
@@ -86,15 +103,22 @@ def count(danmu_list: List, live_start: datetime.datetime, live_duration: float,
     return return_dict
 
 
-def flv2ts(input_file: str, output_file: str, ffmpeg_logfile_hander) -> subprocess.CompletedProcess:
-    ret = subprocess.run(f"ffmpeg -y -fflags +discardcorrupt -i {input_file} -c copy -bsf:v h264_mp4toannexb -f mpegts {output_file}",
-                         shell=True, check=True, stdout=ffmpeg_logfile_hander, stderr=ffmpeg_logfile_hander)
-    return ret
+def merge_keyframes(durations: List[float], segment_keyframes: List[List[float]]) -> List[float]:
+    """把各片段的关键帧时间换算到合并后文件的时间轴上，任一片段缺少索引时返回空列表。"""
+    if not segment_keyframes or not all(segment_keyframes):
+        return []
+    keyframes = []
+    offset = 0
+    for duration, times in zip(durations, segment_keyframes):
+        keyframes.extend(offset+t for t in times)
+        offset += duration
+    return keyframes
 
 
+@traced('concat')
 def concat(merge_conf_path: str, merged_file_path: str, ffmpeg_logfile_hander) -> subprocess.CompletedProcess:
-    ret = subprocess.run(f"ffmpeg -y -f concat -safe 0 -i {merge_conf_path} -c copy -fflags +igndts -avoid_negative_ts make_zero {merged_file_path}",
-                         shell=True, check=True, stdout=ffmpeg_logfile_hander, stderr=ffmpeg_logfile_hander)
+    ret = run_ffmpeg(["-f", "concat", "-safe", "0", "-i", merge_conf_path, "-c", "copy", "-fflags", "+igndts",
+                      "-avoid_negative_ts", "make_zero", merged_file_path], ffmpeg_logfile_hander)
     return ret
 
 
@@ -105,9 +129,10 @@ def get_start_time(filename: str) -> datetime.datetime:
 
 
 class Processor(BiliLive):
-    def __init__(self, config: dict, global_start: datetime.datetime):
+    def __init__(self, config: dict, global_start: datetime.datetime, metrics=None):
         super().__init__(config)
         self.config = config
+        self.metrics = MetricsClient(metrics)
         self.global_start = global_start
         self.record_dir = utils.init_record_dir(
             self.room_id, self.global_start, config['root']['data_path'])
@@ -117,7 +142,23 @@ class Processor(BiliLive):
             self.room_id, self.global_start, config['root']['data_path'])
         self.merged_file_path = utils.get_merged_filename(
             self.room_id, self.global_start, config['root']['data_path'])
+        self.media_cache = MediaCache(config['root']['data_path'])
+        self.manifest = SessionManifest(utils.get_manifest_path(
+            self.room_id, self.global_start, config['root']['data_path']))
+        self.outputs_dir = utils.init_outputs_dir(
+            self.room_id, self.global_start, config['root']['data_path'])
+        self.splits_dir = utils.init_splits_dir(
+            self.room_id, self.global_start, config['root']['data_path'])
+        # 设置后每切出一个切片或分P就放入 (类别, 文件路径)，供上传线程边处理边上传
+        self.part_queue = None
+        # 合并阶段结束（无论成功与否）后设置，归档线程据此开始上传合并后的录像
+        self.concat_done = threading.Event()
+        # 直播中上传进程结束后设置，为 None 时（如单独恢复处理）直接读取其状态文件
+        self.live_upload_done = None
         self.times = []
+        self.keyframes = []
+        # 以链接代替复制而省下的写入量
+        self.io_saved = 0
         self.live_start = self.global_start
         self.live_duration = 0
         self.ffmpeg_logfile = os.path.join(config['root']['logger']['log_path'], "FFMpeg_"+datetime.datetime.now(
@@ -126,84 +167,145 @@ class Processor(BiliLive):
             self.ffmpeg_logfile, mode="a", encoding="utf-8")
 
     def pre_concat(self) -> None:
-        filelist = os.listdir(self.record_dir)
-        with open(self.merge_conf_path, "w", encoding="utf-8") as f:
+        if not self.manifest.is_done('concat'):
+            # 文件名以开始时间命名，排序后即为录制顺序，与合并顺序保持一致
+            # 录制期间已由 SegmentRemuxer 转码的片段在清单中已完成，这里通常只剩最后一个片段
+            filelist = sorted(os.listdir(self.record_dir))
             for filename in filelist:
                 file_path = os.path.join(self.record_dir, filename)
-                if os.path.splitext(file_path)[1] == ".flv" and os.path.getsize(file_path) > 1024*1024:
-                    ts_path = os.path.splitext(file_path)[0]+".ts"
-                    _ = flv2ts(file_path, ts_path, self.ffmpeg_logfile_hander)
+                if os.path.splitext(file_path)[1] == ".flv" and os.path.getsize(file_path) > MIN_SEGMENT_SIZE:
+                    if not self.manifest.is_done('remux', filename):
+                        remux_segment(file_path, self.manifest,
+                                      self.media_cache, self.ffmpeg_logfile_hander)
+                    else:
+                        logging.info("跳过已转码的片段：%s", filename)
                     if not self.config['spec']['recorder']['keep_raw_record']:
                         os.remove(file_path)
-                    # ts_path = os.path.join(self.record_dir, filename)
-                    duration = float(ffmpeg.probe(ts_path)[
-                                     'format']['duration'])
-                    start_time = get_start_time(filename)
-                    self.times.append((start_time, duration))
-                    f.write(
-                        f"file '{os.path.abspath(ts_path)}'\n")
-        _ = concat(self.merge_conf_path, self.merged_file_path,
-                   self.ffmpeg_logfile_hander)
-        self.times.sort(key=lambda x: x[0])
+            with open(self.merge_conf_path, "w", encoding="utf-8") as f:
+                for filename, segment in sorted(self.manifest.stage('remux').items()):
+                    f.write(f"file '{segment['outputs'][0]['path']}'\n")
+            # 旧的合并文件可能与分P共用数据，先删除再重新写入，避免改写已链接的分P
+            if os.path.exists(self.merged_file_path):
+                os.remove(self.merged_file_path)
+            _ = concat(self.merge_conf_path, self.merged_file_path,
+                       self.ffmpeg_logfile_hander)
+            self.manifest.mark_done('concat', [self.merged_file_path])
+        else:
+            logging.info("跳过已完成的合并：%s", self.merged_file_path)
+
+        segments = sorted(self.manifest.stage('remux').items())
+        self.times = [(get_start_time(filename), segment['duration'])
+                      for filename, segment in segments]
         self.live_start = self.times[0][0]
         self.live_duration = (
             self.times[-1][0]-self.times[0][0]).total_seconds()+self.times[-1][1]
+        self.keyframes = merge_keyframes(
+            [d for _, d in self.times], [segment['keyframes'] for _, segment in segments])
 
-    def __cut_video(self, outhint: List[str], start_time: int, delta: int) -> subprocess.CompletedProcess:
-        self.outputs_dir = utils.init_outputs_dir(
-            self.room_id, self.global_start, self.config['root']['data_path'])
+    def live_upload_state(self) -> SessionManifest:
+        """等待直播中上传进程结束，返回其状态。"""
+        if self.live_upload_done is not None:
+            self.live_upload_done.wait()
+        return SessionManifest(utils.get_live_upload_state_path(
+            self.room_id, self.global_start, self.config['root']['data_path']))
+
+    def live_upload_fallback(self) -> bool:
+        """直播中上传未全部完成且没有创建稿件时，需要按常规流程切分并上传完整录播。
+
+        已经创建了稿件时未确认的分段由上传线程补传到同一稿件中，不再切分，以免重复投稿。
+        """
+        state = self.live_upload_state()
+        return not state.get('confirmed', False) and state.get('bvid') is None
+
+    def __publish(self, kind: str, path: str, start: float = None, end: float = None) -> None:
+        """把产物交给上传线程，start 和 end 为实际切出的起止位置（合并文件中的秒数），上传时换算为实际时间作为标题。"""
+        if self.part_queue is None:
+            return
+        bounds = None
+        if start is not None and self.times:
+            bounds = (get_wall_time(self.times, start),
+                      get_wall_time(self.times, end))
+        self.part_queue.put((kind, path, bounds))
+
+    def __cut_video(self, outhint: List[str], start_time: float, delta: float) -> subprocess.CompletedProcess:
         output_file = os.path.join(
-            self.outputs_dir, f"{self.room_id}_{self.global_start.strftime('%Y-%m-%d_%H-%M-%S')}_{start_time:012}_{outhint}.mp4")
-        cmd = f'ffmpeg -y -ss {start_time} -t {delta} -accurate_seek -i "{self.merged_file_path}" -c copy -avoid_negative_ts 1 "{output_file}"'
-        ret = subprocess.run(cmd, shell=True, check=True,
-                             stdout=self.ffmpeg_logfile_hander)
+            self.outputs_dir, f"{self.room_id}_{self.global_start.strftime('%Y-%m-%d_%H-%M-%S')}_{int(start_time):012}_{outhint}.mp4")
+        args = ["-ss", f"{start_time:.3f}", "-t", f"{delta:.3f}", "-accurate_seek", "-i", self.merged_file_path,
+                "-c", "copy", "-avoid_negative_ts", "1", output_file]
+        if self.manifest.is_done('cut', os.path.basename(output_file)):
+            logging.info("跳过已完成的切片：%s", output_file)
+            self.__publish('clips', output_file)
+            return None
+        with span('cut', start=start_time, duration=delta):
+            ret = run_ffmpeg(args, self.ffmpeg_logfile_hander)
+        self.manifest.mark_done(
+            'cut', [output_file], os.path.basename(output_file))
+        self.__publish('clips', output_file)
         return ret
 
     def cut(self, cut_points: List[Tuple[datetime.datetime, datetime.datetime, List[str]]], min_length: int = 60) -> None:
-        duration = float(ffmpeg.probe(self.merged_file_path)
-                         ['format']['duration'])
+        duration = self.media_cache.duration(self.merged_file_path)
         for cut_start, cut_end, tags in cut_points:
             start = get_true_timestamp(self.times,
                                        cut_start) + self.config['spec']['clipper']['start_offset']
             end = min(get_true_timestamp(self.times,
                                          cut_end) + self.config['spec']['clipper']['end_offset'], duration)
-            delta = end-start
+            if self.keyframes:
+                # 起点对齐到关键帧，流复制时切出的片段与计划一致
+                start = snap_to_keyframe(self.keyframes, max(0, start))
+                delta = end-start
+            else:
+                delta = int(end-start)
+                start = max(0, int(start))
             outhint = " ".join(tags)
             if delta >= min_length:
-                self.__cut_video(outhint, max(
-                    0, int(start)), int(delta))
+                self.__cut_video(outhint, start, delta)
 
     def split(self, split_interval: int = 3600) -> None:
-        self.splits_dir = utils.init_splits_dir(
-            self.room_id, self.global_start, self.config['root']['data_path'])
         if split_interval <= 0:
-            shutil.copy2(self.merged_file_path, os.path.join(
-                self.splits_dir, f"{self.room_id}_{self.global_start.strftime('%Y-%m-%d_%H-%M-%S')}_0000.mp4"))
+            output_file = os.path.join(
+                self.splits_dir, f"{self.room_id}_{self.global_start.strftime('%Y-%m-%d_%H-%M-%S')}_0000.mp4")
+            if not self.manifest.is_done('split', '0'):
+                method = utils.place_file(self.merged_file_path, output_file)
+                logging.info("分P以%s方式放置：%s", method, output_file)
+                if method != 'copy':
+                    self.io_saved += os.path.getsize(output_file)
+                self.manifest.mark_done('split', [output_file], '0')
+            self.__publish('record', output_file, 0,
+                           self.media_cache.duration(self.merged_file_path))
             return
 
-        duration = float(ffmpeg.probe(self.merged_file_path)
-                         ['format']['duration'])
+        duration = self.media_cache.duration(self.merged_file_path)
         num_splits = int(duration) // split_interval + 1
+        # 分P边界对齐到关键帧，相邻分P首尾相接，不重叠也不丢帧
+        bounds = [snap_to_keyframe(self.keyframes, i*split_interval)
+                  for i in range(num_splits)]+[duration]
         for i in range(num_splits):
             output_file = os.path.join(self.splits_dir, f"{i}.mp4")
-            cmd = f'ffmpeg -y -ss {i*split_interval} -t {split_interval} -accurate_seek -i "{self.merged_file_path}" -c copy -avoid_negative_ts 1 "{output_file}"'
-            _ = subprocess.run(cmd, shell=True, check=True,
-                               stdout=self.ffmpeg_logfile_hander, stderr=self.ffmpeg_logfile_hander)
+            if self.manifest.is_done('split', str(i)):
+                logging.info("跳过已完成的分P：%s", output_file)
+                self.__publish('record', output_file, bounds[i], bounds[i+1])
+                continue
+            args = ["-ss", f"{bounds[i]:.3f}", "-t", f"{bounds[i+1]-bounds[i]:.3f}", "-accurate_seek", "-i",
+                    self.merged_file_path, "-c", "copy", "-avoid_negative_ts", "1", output_file]
+            with span('split', part=i):
+                _ = run_ffmpeg(args, self.ffmpeg_logfile_hander)
+            self.manifest.mark_done('split', [output_file], str(i))
+            self.__publish('record', output_file, bounds[i], bounds[i+1])
 
     def run(self) -> None:
-        logging.basicConfig(level=utils.get_log_level(self.config),
-                            format='%(asctime)s %(thread)d %(threadName)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-                            datefmt='%a, %d %b %Y %H:%M:%S',
-                            filename=os.path.join(self.config['root']['logger']['log_path'], "Processor_"+datetime.datetime.now(
-                            ).strftime('%Y-%m-%d_%H-%M-%S')+'.log'),
-                            filemode='a')
+        succeeded = True
         try:
-            self.pre_concat()
+            with self.metrics.timer('concat', room=self.room_id):
+                self.pre_concat()
             if not self.config['spec']['recorder']['keep_raw_record']:
                 if os.path.exists(self.merged_file_path):
                     utils.del_files_and_dir(self.record_dir)
         except Exception as e:
             logging.error("文件转码出现错误："+str(e))
+            succeeded = False
+        finally:
+            self.concat_done.set()
         # duration = float(ffmpeg.probe(self.merged_file_path)[
         #                              'format']['duration'])
         # start_time = get_start_time(self.merged_file_path)
@@ -220,19 +322,35 @@ class Processor(BiliLive):
                     danmu_list, self.live_start, self.live_duration, paser_config['interval'])
                 cut_points = get_cut_points(counted_danmu_dict, paser_config['up_ratio'],
                                             paser_config['down_ratio'], paser_config['topK'])
-                self.cut(
-                    cut_points, self.config['spec']['clipper']['min_length'])
+                with self.metrics.timer('clip', room=self.room_id):
+                    self.cut(
+                        cut_points, self.config['spec']['clipper']['min_length'])
         except Exception as e:
             logging.error("切片出现错误："+str(e))
+            succeeded = False
         try:
-            if self.config['spec']['uploader']['record']['upload_record']:
-                self.split(self.config['spec']['uploader']
-                           ['record']['split_interval'])
+            record_config = self.config['spec']['uploader']['record']
+            # 直播中上传模式下录播已经在直播时上传，不再切分；没能创建稿件时按常规流程切分上传
+            if record_config['upload_record'] and (not record_config['live_upload'] or self.live_upload_fallback()):
+                if record_config['live_upload']:
+                    logging.warning("直播中上传没有创建稿件，改为切分并上传完整录播")
+                with self.metrics.timer('split', room=self.room_id):
+                    self.split(self.config['spec']['uploader']
+                               ['record']['split_interval'])
         except Exception as e:
             logging.error("文件切分出现错误："+str(e))
+            succeeded = False
+        if self.io_saved > 0:
+            logging.info("本场直播通过链接放置文件节省写入 %.2fGB",
+                         self.io_saved/1024**3)
+        self.manifest.set('io_saved', self.io_saved)
+        self.manifest.set('processed', succeeded)
+        self.metrics.flush(force=True)
 
 
 if __name__ == "__main__":
+    from Uploader import Uploader
+
     with open("config/config.json", "r", encoding="UTF-8") as f:
         all_config = json.load(f)
     root_config: dict = all_config.get('root', {})
@@ -0,0 +1,174 @@
+import logging
+import os
+import threading
+from collections import deque
+
+from KeyframeIndex import FLV_TAG_VIDEO, FlvTagParser
+
+
+class ReplayBuffer():
+    """录制中的即时回放缓冲区。
+
+    在内存中按关键帧分组（GOP）保存最近 max_seconds 秒、不超过 max_bytes 的直播流，
+    第一个关键帧之前的文件头、元数据和解码器配置单独保存，拼在每个回放片段的开头使其可以独立播放。
+    只在标签边界切分，不解码音视频数据。
+    """
+
+    def __init__(self, max_seconds: float, max_bytes: int):
+        self.max_ms = max_seconds*1000
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """每个录制连接都是一个新的 FLV 流，换连接时清空。"""
+        with self.lock:
+            self.parser = FlvTagParser()
+            self.pos = 0
+            self.header = bytearray()
+            self.header_done = False
+            # 第一个关键帧之前的部分，流中途更换视频解码器配置时在此基础上重建文件头
+            self.base_header = None
+            # 流中途出现新的视频解码器配置时，收集到下一个关键帧为止作为新的文件头
+            self.new_header = None
+            # [关键帧时间戳, 起始偏移, 数据]
+            self.gops = deque()
+            self.size = 0
+            self.pending_ends = []
+            self.complete_end = 0
+            self.last_timestamp = 0
+
+    def __sink(self) -> bytearray:
+        if self.new_header is not None:
+            return self.new_header
+        if not self.header_done:
+            return self.header
+        return self.gops[-1][2]
+
+    def __start(self, offset: int, kind: str, timestamp: int, tail: bytes) -> None:
+        if kind == 'sequence_header':
+            if self.new_header is None:
+                logging.info("直播流中途更换了视频解码器配置，回放缓冲区从下一个关键帧重新开始")
+                # 原有的元数据和音频解码器配置仍然有效，新的视频解码器配置放在后面
+                self.new_header = bytearray(self.base_header)
+            self.new_header += tail
+            return
+        if self.new_header is not None:
+            self.header = self.new_header
+            self.new_header = None
+            self.gops.clear()
+            self.size = 0
+        if not self.header_done:
+            self.base_header = bytes(self.header)
+        self.header_done = True
+        self.gops.append([timestamp, offset, bytearray(tail)])
+        self.size += len(tail)
+
+    def __evict(self) -> None:
+        newest = self.last_timestamp
+        while len(self.gops) > 1 and (newest-self.gops[1][0] >= self.max_ms or self.size > self.max_bytes):
+            self.size -= len(self.gops.popleft()[2])
+
+    def feed(self, chunk: bytes) -> None:
+        with self.lock:
+            chunk_start = self.pos
+            tags = self.parser.feed(chunk)
+            self.pos += len(chunk)
+            consumed = 0
+            for tag in tags:
+                self.pending_ends.append(tag.offset+11+tag.data_size+4)
+                self.last_timestamp = max(self.last_timestamp, tag.timestamp)
+                if tag.keyframe:
+                    kind = 'keyframe'
+                elif tag.sequence_header and self.header_done and tag.tag_type == FLV_TAG_VIDEO:
+                    kind = 'sequence_header'
+                else:
+                    continue
+                sink = self.__sink()
+                if tag.offset < chunk_start+consumed:
+                    # 标签头跨越了两个数据块，已写入上一组的部分移到新的一组
+                    tail_len = chunk_start+consumed-tag.offset
+                    tail = bytes(sink[-tail_len:])
+                    del sink[-tail_len:]
+                    if sink is not self.header and sink is not self.new_header:
+                        self.size -= tail_len
+                else:
+                    sink += chunk[consumed:tag.offset-chunk_start]
+                    if sink is not self.header and sink is not self.new_header:
+                        self.size += tag.offset-chunk_start-consumed
+                    consumed = tag.offset-chunk_start
+                    tail = b''
+                self.__start(tag.offset, kind, tag.timestamp, tail)
+            sink = self.__sink()
+            sink += chunk[consumed:]
+            if sink is not self.header and sink is not self.new_header:
+                self.size += len(chunk)-consumed
+            ends = [end for end in self.pending_ends if end <= self.pos]
+            if ends:
+                self.complete_end = max(self.complete_end, max(ends))
+                self.pending_ends = [
+                    end for end in self.pending_ends if end > self.pos]
+            if self.gops:
+                self.__evict()
+
+    def duration(self) -> float:
+        with self.lock:
+            if not self.gops:
+                return 0
+            return (self.last_timestamp-self.gops[0][0])/1000
+
+    def write_clip(self, path: str, seconds: float) -> float:
+        """把最近 seconds 秒（从不晚于起点的关键帧开始）写入 path，返回片段的实际时长，缓冲区中还没有关键帧时不写入并返回 None。"""
+        with self.lock:
+            if not self.gops:
+                return None
+            newest = self.last_timestamp
+            start = 0
+            for i, gop in enumerate(self.gops):
+                if gop[0] <= newest-seconds*1000:
+                    start = i
+            # 最后一组可能停在某个标签中间，只写到最后一个完整的标签
+            gops = [(gop[1], bytes(gop[2])) for gop in list(self.gops)[start:]]
+            header = bytes(self.header)
+            complete_end = self.complete_end
+            duration = (newest-self.gops[start][0])/1000
+        tmp_path = path+".part"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            for offset, data in gops:
+                f.write(data[:max(0, complete_end-offset)])
+        os.replace(tmp_path, path)
+        return duration
+
+
+class DanmuBurstDetector():
+    """弹幕数突增检测，与处理时切片的判断一致：当前时间段的弹幕数达到上一时间段的 up_ratio 倍时触发，
+    不必等到时间段结束；每个时间段最多触发一次，两次触发至少间隔 cooldown 秒。"""
+
+    def __init__(self, interval: float, up_ratio: float, min_count: int, cooldown: float):
+        self.interval = interval
+        self.up_ratio = up_ratio
+        self.min_count = min_count
+        self.cooldown = cooldown
+        self.bucket = None
+        self.count = 0
+        self.prev_count = 0
+        self.triggered = False
+        self.last_trigger = 0
+
+    def feed(self, now: float) -> bool:
+        bucket = int(now//self.interval)
+        if bucket != self.bucket:
+            # 中间没有弹幕的时间段按 0 条计
+            self.prev_count = self.count if self.bucket is not None and bucket == self.bucket+1 else 0
+            self.bucket = bucket
+            self.count = 0
+            self.triggered = False
+        self.count += 1
+        if self.triggered or now-self.last_trigger < self.cooldown:
+            return False
+        if self.count >= max(self.min_count, self.prev_count*self.up_ratio):
+            self.triggered = True
+            self.last_trigger = now
+            return True
+        return False
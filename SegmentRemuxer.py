@@ -0,0 +1,78 @@
+import datetime
+import logging
+import os
+import queue
+import subprocess
+import threading
+import traceback
+
+import utils
+from FFmpegRunner import run_ffmpeg
+from KeyframeIndex import get_keyframe_times
+from MediaCache import MediaCache
+from SessionManifest import SessionManifest
+from Tracing import traced
+
+# 小于该大小的片段通常只有文件头或几秒的断流残片，不参与合并
+MIN_SEGMENT_SIZE = 1024*1024
+
+
+@traced('flv2ts')
+def flv2ts(input_file: str, output_file: str, ffmpeg_logfile_hander) -> subprocess.CompletedProcess:
+    ret = run_ffmpeg(["-fflags", "+discardcorrupt", "-i", input_file, "-c", "copy", "-bsf:v", "h264_mp4toannexb",
+                      "-f", "mpegts", output_file], ffmpeg_logfile_hander)
+    return ret
+
+
+def remux_segment(file_path: str, manifest: SessionManifest, media_cache: MediaCache, ffmpeg_logfile_hander) -> None:
+    """把一个录完的 flv 片段转为 ts 并读取时长，连同关键帧时间记入清单的 remux 阶段。"""
+    ts_path = os.path.splitext(file_path)[0]+".ts"
+    keyframes = get_keyframe_times(file_path)
+    _ = flv2ts(file_path, ts_path, ffmpeg_logfile_hander)
+    duration = media_cache.duration(ts_path)
+    manifest.mark_done('remux', [ts_path], os.path.basename(file_path),
+                       duration=duration, keyframes=keyframes)
+
+
+class SegmentRemuxer(threading.Thread):
+    """录制期间在后台转码已经录完的片段。
+
+    录制器每换一个新文件就提交上一个文件，转码结果写入本场直播的处理清单，
+    下播后处理进程的 pre_concat 会跳过这些片段，只需转码最后一个片段再合并。
+    转码失败的片段不记入清单，由处理进程重新转码。
+    """
+
+    def __init__(self, config: dict, global_start: datetime.datetime):
+        threading.Thread.__init__(self, name="SegmentRemuxer", daemon=True)
+        self.config = config
+        self.manifest = SessionManifest(utils.get_manifest_path(
+            config['spec']['room_id'], global_start, config['root']['data_path']))
+        self.media_cache = MediaCache(config['root']['data_path'])
+        self.segments = queue.Queue()
+
+    def submit(self, file_path: str) -> None:
+        self.segments.put(file_path)
+
+    def stop(self) -> None:
+        """等待已提交的片段全部转码完成，处理进程启动前清单必须已经写好。"""
+        self.segments.put(None)
+        self.join()
+
+    def run(self) -> None:
+        ffmpeg_logfile = os.path.join(self.config['root']['logger']['log_path'], "FFMpeg_Remux_"+datetime.datetime.now(
+        ).strftime('%Y-%m-%d_%H-%M-%S')+'.log')
+        with open(ffmpeg_logfile, mode="a", encoding="utf-8") as ffmpeg_logfile_hander:
+            while True:
+                file_path = self.segments.get()
+                if file_path is None:
+                    return
+                filename = os.path.basename(file_path)
+                try:
+                    if os.path.getsize(file_path) <= MIN_SEGMENT_SIZE or self.manifest.is_done('remux', filename):
+                        continue
+                    remux_segment(file_path, self.manifest,
+                                  self.media_cache, ffmpeg_logfile_hander)
+                    logging.info("已在录制期间转码片段：%s", filename)
+                except Exception as e:
+                    logging.error("录制期间转码片段 %s 失败，下播后将重新转码：%s",
+                                  filename, str(e)+traceback.format_exc())
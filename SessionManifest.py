@@ -0,0 +1,82 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import List
+
+CHECKSUM_BLOCK = 1024*1024
+
+
+def quick_checksum(path: str) -> str:
+    """对文件大小及首尾各 1MB 计算 SHA1，用于快速判断产物是否完整、是否被替换。"""
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(CHECKSUM_BLOCK))
+        if size > CHECKSUM_BLOCK:
+            f.seek(max(CHECKSUM_BLOCK, size-CHECKSUM_BLOCK))
+            h.update(f.read(CHECKSUM_BLOCK))
+    return h.hexdigest()
+
+
+class SessionManifest():
+    """单场直播处理进度的清单。
+
+    每完成一个阶段（或阶段内的一项，如一个片段的转码、一个分P的切分）就记录其产物路径、大小和校验和，
+    重新处理时跳过产物仍然完好的项目，只重做未完成或产物损坏的部分。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'stages': {}}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error("读取处理清单时出现错误，将重新处理："+str(e))
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key: str, value) -> None:
+        with self.lock:
+            self.data[key] = value
+            self.__save()
+
+    def stage(self, name: str) -> dict:
+        return self.data['stages'].get(name, {})
+
+    def is_done(self, name: str, item: str = '', verify: bool = True) -> bool:
+        entry = self.stage(name).get(item)
+        if entry is None:
+            return False
+        if not verify:
+            return True
+        for output in entry['outputs']:
+            if not os.path.exists(output['path']) or os.path.getsize(output['path']) != output['size']:
+                return False
+            if quick_checksum(output['path']) != output['checksum']:
+                return False
+        return True
+
+    def mark_done(self, name: str, outputs: List[str], item: str = '', **info) -> None:
+        entry = {
+            'outputs': [{
+                'path': os.path.abspath(path),
+                'size': os.path.getsize(path),
+                'checksum': quick_checksum(path)
+            } for path in outputs],
+            **info
+        }
+        with self.lock:
+            self.data['stages'].setdefault(name, {})[item] = entry
+            self.__save()
+
+    def __save(self) -> None:
+        tmp_path = self.path+".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
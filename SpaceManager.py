@@ -0,0 +1,170 @@
+import datetime
+import logging
+import os
+import shutil
+import threading
+import time
+
+import utils
+from SessionManifest import SessionManifest
+
+# 按淘汰顺序排列，弹幕体积很小且是切片和检索的原始数据，只统计不淘汰；即时回放是手动或弹幕触发保存的片段，也不淘汰
+CATEGORIES = ['records', 'merge_confs', 'merged', 'splits', 'outputs', 'danmu', 'replays']
+EVICTABLE = ['records', 'merge_confs', 'merged', 'splits', 'outputs']
+
+
+def get_session_name(entry: str) -> str:
+    # 各数据目录下的条目都以 {房间号}_{日期}_{时间} 开头
+    return "_".join(os.path.splitext(entry)[0].split("_")[:3])
+
+
+def get_session_start(session: str) -> datetime.datetime:
+    try:
+        return utils.get_global_start_from_records(session)
+    except ValueError:
+        return datetime.datetime.max
+
+
+class SpaceManager(threading.Thread):
+    """数据目录空间管理。
+
+    增量统计 data 下各目录中每场直播的占用：已完成的会话不会再变化，只在目录修改时间变化时重新统计。
+    磁盘使用率超过高水位时，从最早的直播开始删除已经处理、上传和归档完成的文件，直到低于低水位。
+    处理进程开始处理前也会调用 ensure_free，为预计产生的文件腾出空间。
+    """
+
+    def __init__(self, config: dict = None):
+        threading.Thread.__init__(self, name="SpaceManager", daemon=True)
+        self.config = config
+        self.lock = threading.Lock()
+        self.usage = {category: {} for category in CATEGORIES}
+        # {会话: (清单修改时间, 是否已完成)}，清单未修改时不重新读取
+        self.manifests = {}
+        # 已经提示过可以清理的没有清单的会话
+        self.unmanaged = set()
+
+    def apply_config(self, root_config: dict) -> None:
+        self.config = {'root': root_config}
+        if self.ident is None:
+            self.start()
+
+    def data_dir(self, category: str = '') -> str:
+        return os.path.join(self.config['root']['data_path'], 'data', category)
+
+    def is_finished(self, session: str) -> bool:
+        # 处理进程全部完成（处理、上传、归档均成功）后才会在清单中写入 finished
+        manifest_path = os.path.join(
+            self.data_dir('manifests'), f"{session}_manifest.json")
+        try:
+            mtime = os.path.getmtime(manifest_path)
+        except OSError:
+            return self.__unmanaged_finished(session)
+        cached = self.manifests.get(session)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, bool(SessionManifest(
+                manifest_path).get('finished', False)))
+            self.manifests[session] = cached
+        return cached[1]
+
+    def __unmanaged_finished(self, session: str) -> bool:
+        """没有处理清单的会话（此前版本录制的直播）长时间未修改时视为已完成。"""
+        idle_days = self.config['root']['space']['unmanaged_idle_days']
+        last_modified = max((entries[entry][0] for entries in self.usage.values()
+                             for entry in entries if get_session_name(entry) == session), default=time.time())
+        # 正在录制且未开启录制期间转码的直播也没有清单，按修改时间与之区分
+        finished = idle_days > 0 and time.time()-last_modified > idle_days*86400
+        if finished and session not in self.unmanaged:
+            self.unmanaged.add(session)
+            logging.info("直播 %s 没有处理清单且已超过 %d 天未修改，视为已完成，空间不足时可以清理",
+                         session, idle_days)
+        return finished
+
+    def scan(self) -> None:
+        with self.lock:
+            for category in CATEGORIES:
+                category_dir = self.data_dir(category)
+                if not os.path.isdir(category_dir):
+                    continue
+                old = self.usage[category]
+                new = {}
+                for entry in os.listdir(category_dir):
+                    path = os.path.join(category_dir, entry)
+                    try:
+                        mtime = os.path.getmtime(path)
+                        cached = old.get(entry)
+                        if cached is not None and cached[0] == mtime and self.is_finished(get_session_name(entry)):
+                            new[entry] = cached
+                        else:
+                            new[entry] = (mtime, utils.get_dir_size(path))
+                    except OSError:
+                        continue
+                self.usage[category] = new
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {category: {
+                'size': sum(size for _, size in entries.values()),
+                'sessions': len({get_session_name(entry) for entry in entries})
+            } for category, entries in self.usage.items()}
+
+    def free_space(self) -> int:
+        return shutil.disk_usage(self.data_dir()).free
+
+    def evict_until(self, target_free: int) -> int:
+        """按直播开始时间从早到晚删除已完成会话的文件，直到剩余空间不少于 target_free，返回释放的字节数。"""
+        self.scan()
+        with self.lock:
+            candidates = sorted(
+                {get_session_name(entry)
+                 for category in EVICTABLE for entry in self.usage[category]},
+                key=get_session_start)
+            freed = 0
+            for session in candidates:
+                if self.free_space() >= target_free:
+                    break
+                if not self.is_finished(session):
+                    continue
+                for category in EVICTABLE:
+                    for entry in [entry for entry in self.usage[category] if get_session_name(entry) == session]:
+                        path = os.path.join(self.data_dir(category), entry)
+                        try:
+                            if os.path.isdir(path):
+                                shutil.rmtree(path)
+                            else:
+                                os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                        except OSError as e:
+                            logging.error("清理 %s 时出现错误：%s", path, e)
+                            continue
+                        freed += self.usage[category].pop(entry)[1]
+                        logging.info("磁盘空间不足，已清理 %s", path)
+            return freed
+
+    def ensure_free(self, required: int) -> bool:
+        """确保剩余空间能容纳 required 字节，必要时清理旧文件，空间仍然不足时返回 False。"""
+        if self.free_space() >= required:
+            return True
+        freed = self.evict_until(required)
+        logging.info("为处理腾出空间，释放 %.1fGB", freed/1024**3)
+        return self.free_space() >= required
+
+    def check_watermarks(self) -> None:
+        space_config = self.config['root']['space']
+        usage = shutil.disk_usage(self.data_dir())
+        if usage.used*100 >= usage.total*space_config['high_watermark']:
+            target_free = usage.total * \
+                (100-space_config['low_watermark'])//100
+            freed = self.evict_until(target_free)
+            usage = shutil.disk_usage(self.data_dir())
+            logging.warning("磁盘使用率超过 %d%%，已释放 %.1fGB，当前使用率 %.1f%%",
+                            space_config['high_watermark'], freed/1024**3, usage.used*100/usage.total)
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.scan()
+                self.check_watermarks()
+            except Exception as e:
+                logging.error("空间管理出现错误：%s", e)
+            time.sleep(self.config['root']['space']['check_interval'])
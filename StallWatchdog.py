@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+from collections import deque
+
+
+class StallWatchdog(threading.Thread):
+    """单个录制连接的卡顿检测。
+
+    录制循环每收到一块数据就调用 feed，检测线程每秒按滑动窗口计算吞吐量：
+    超过 stall_timeout 秒没有收到数据，或窗口内的平均速度低于预期码率的 min_ratio 时，
+    记录原因并调用 abort 断开连接，由录制器换用其他地址重连。
+    """
+
+    def __init__(self, abort, window: int, stall_timeout: float, min_ratio: float, expected_bps: float = 0):
+        threading.Thread.__init__(self, name="StallWatchdog", daemon=True)
+        self.abort = abort
+        self.window = window
+        self.stall_timeout = stall_timeout
+        self.min_ratio = min_ratio
+        self.expected_bps = expected_bps
+        self.lock = threading.Lock()
+        # [秒, 该秒内收到的字节数]
+        self.buckets = deque()
+        self.total = 0
+        self.start_time = time.time()
+        self.last_data = self.start_time
+        self.stopped = threading.Event()
+        self.reason = None
+        self.throughput_at_stall = 0
+
+    def feed(self, size: int) -> None:
+        now = time.time()
+        second = int(now)
+        with self.lock:
+            self.total += size
+            self.last_data = now
+            if self.buckets and self.buckets[-1][0] == second:
+                self.buckets[-1][1] += size
+            else:
+                self.buckets.append([second, size])
+
+    def throughput(self, now: float) -> float:
+        """最近 window 秒的平均速度，单位字节/秒。"""
+        with self.lock:
+            while self.buckets and self.buckets[0][0] <= now-self.window:
+                self.buckets.popleft()
+            return sum(size for _, size in self.buckets)/self.window
+
+    def elapsed(self) -> float:
+        return time.time()-self.start_time
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def run(self) -> None:
+        while not self.stopped.wait(1):
+            now = time.time()
+            throughput = self.throughput(now)
+            if now-self.last_data >= self.stall_timeout:
+                self.reason = 'no_data'
+            elif self.expected_bps > 0 and now-self.start_time >= self.window and \
+                    throughput < self.expected_bps*self.min_ratio:
+                self.reason = 'low_throughput'
+            if self.reason is not None:
+                self.throughput_at_stall = throughput
+                try:
+                    self.abort()
+                except Exception as e:
+                    logging.error("断开卡顿的录制连接时出现错误：%s", e)
+                return
@@ -0,0 +1,112 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+_tracer = None
+_NOOP = contextlib.nullcontext()
+
+
+class Tracer():
+    """记录一个处理进程内的耗时区间，保存为 Chrome trace-event JSON（可用 chrome://tracing 或 Perfetto 打开）。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.events = []
+        self.threads = {}
+
+    def add(self, name: str, cat: str, start: float, end: float, args: dict) -> None:
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        self.events.append({
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': (start-self.origin)*1e6,
+            'dur': (end-start)*1e6,
+            'pid': self.pid,
+            'tid': tid,
+            'args': args
+        })
+
+    def save(self) -> None:
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                     'args': {'name': name}} for tid, name in self.threads.items()]
+        tmp_path = self.path+".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({'traceEvents': metadata+self.events,
+                       'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+class _Span():
+    __slots__ = ('tracer', 'name', 'cat', 'args',
+                 'start', 'cpu_start', 'child_start')
+
+    def __init__(self, tracer: Tracer, name: str, cat: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        times = os.times()
+        self.child_start = times.children_user+times.children_system
+        self.cpu_start = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        times = os.times()
+        # 子进程 CPU 时间只统计已结束的子进程（如 subprocess.run 调用的 ffmpeg），并发时会包含其他线程的子进程
+        self.args['cpu_ms'] = (time.process_time()-self.cpu_start)*1000
+        self.args['child_cpu_ms'] = (
+            times.children_user+times.children_system-self.child_start)*1000
+        if exc[0] is not None:
+            self.args['error'] = repr(exc[1])
+        self.tracer.add(self.name, self.cat, self.start, end, self.args)
+        return False
+
+
+def span(name: str, cat: str = 'process', **args):
+    """计时一个代码区间，未开启追踪时返回空的上下文管理器。"""
+    if _tracer is None:
+        return _NOOP
+    return _Span(_tracer, name, cat, args)
+
+
+def traced(name: str, cat: str = 'process'):
+    """函数版的 span。"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _Span(_tracer, name, cat, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_trace(path: str) -> None:
+    global _tracer
+    _tracer = Tracer(path)
+
+
+def stop_trace() -> None:
+    global _tracer
+    if _tracer is None:
+        return
+    tracer, _tracer = _tracer, None
+    try:
+        tracer.save()
+        logging.info("处理过程追踪已保存：%s", tracer.path)
+    except OSError as e:
+        logging.error("保存追踪文件时出现错误：%s", e)
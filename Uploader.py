@@ -2,19 +2,35 @@ import datetime
 import json
 import logging
 import os
+import queue
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from bilibiliuploader.bilibiliuploader import BilibiliUploader
-from bilibiliuploader.core import VideoPart
+from bilibiliuploader.core import VideoPart, upload_video_part
 
+import LoginSession
 import utils
 from BiliLive import BiliLive
+from JobScheduler import slot
+from Metrics import MetricsClient
+from SessionManifest import SessionManifest
+from Tracing import span, traced
 
+# 服务器上已上传的分P文件不会一直保留，超过该时间的上传记录不再复用
+PART_REUSE_SECONDS = 86400
 
-def upload(uploader: BilibiliUploader, parts: list, cr: int, title: str, tid: int, tags: list, desc: str, source: str, thread_pool_workers: int = 1, max_retry: int = 3, upload_by_edit: bool = False) -> tuple:
+
+def upload(uploader: BilibiliUploader, parts: list, cr: int, title: str, tid: int, tags: list, desc: str, source: str, thread_pool_workers: int = 1, max_retry: int = 3, upload_by_edit: bool = False, max_attempts: int = 0) -> tuple:
+    """投稿，max_attempts 为 0 时一直重试到成功，否则超过次数后抛出 RuntimeError。"""
     bvid = None
+    attempts = 0
     if upload_by_edit:
         while bvid is None:
+            if max_attempts > 0 and attempts >= max_attempts:
+                raise RuntimeError(f"投稿失败，已尝试 {max_attempts} 次：{title}")
+            attempts += 1
             avid, bvid = uploader.upload(
                 parts=[parts[0]],
                 copyright=cr,
@@ -35,6 +51,9 @@ def upload(uploader: BilibiliUploader, parts: list, cr: int, title: str, tid: in
             )
     else:
         while bvid is None:
+            if max_attempts > 0 and attempts >= max_attempts:
+                raise RuntimeError(f"投稿失败，已尝试 {max_attempts} 次：{title}")
+            attempts += 1
             avid, bvid = uploader.upload(
                 parts=parts,
                 copyright=cr,
@@ -50,109 +69,271 @@ def upload(uploader: BilibiliUploader, parts: list, cr: int, title: str, tid: in
     return avid, bvid
 
 
+def get_part_index(path: str) -> int:
+    # 分P文件名为 {序号}.mp4，不切分时为 {房间号}_{日期}_0000.mp4
+    return int(os.path.splitext(os.path.basename(path))[0].split("_")[-1])
+
+
 class Uploader(BiliLive):
-    def __init__(self, output_dir: str, splits_dir: str, config: dict, roomname: str):
+    def __init__(self, output_dir: str, splits_dir: str, config: dict, roomname: str, metrics=None, scheduler=None):
         super().__init__(config)
         self.config = config
+        # 每个分P上传和每次提交各占用一个上传槽位，等待处理时不占用
+        self.scheduler = scheduler
+        self.metrics = MetricsClient(metrics)
         self.roomname = roomname
         self.output_dir = output_dir
         self.splits_dir = splits_dir
-        self.uploader = BilibiliUploader()
-        logging.basicConfig(level=utils.get_log_level(config['root']['logger']['log_level']),
-                            format='%(asctime)s %(thread)d %(threadName)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-                            datefmt='%a, %d %b %Y %H:%M:%S',
-                            filename=os.path.join(config['root']['logger']['log_path'], "Uploader_"+datetime.datetime.now(
-                            ).strftime('%Y-%m-%d_%H-%M-%S')+'.log'),
-                            filemode='a')
         try:
-            with open(config['password_path'], "r", encoding="UTF-8") as f:
-                pw_config = json.load(f)
-            username = config['spec']['uploader']['account']['username']
-            passwd = pw_config.get(username, None)
-            self.uploader.login(username, passwd)
+            self.uploader = LoginSession.get_uploader(config)
         except Exception as e:
+            self.uploader = BilibiliUploader()
             logging.error("解析密码文件时出现错误，请用户名密码是否正确")
             logging.error("错误详情："+str(e))
 
+    def submission_info(self, kind: str, datestr: str) -> dict:
+        return {
+            'cr': self.config['spec']['uploader']['copyright'],
+            'title': self.config['spec']['uploader'][kind]['title'].format(
+                date=datestr, title=self.roomname),
+            'tid': self.config['spec']['uploader'][kind]['tid'],
+            'tags': self.config['spec']['uploader'][kind]['tags'],
+            'desc': self.config['spec']['uploader'][kind]['desc'].format(
+                date=datestr, title=self.roomname),
+            'source': "https://live.bilibili.com/"+self.room_id,
+            'thread_pool_workers': self.config['root']['uploader']['thread_pool_workers'],
+            'max_retry': self.config['root']['uploader']['max_retry'],
+        }
+
+    def get_upload_state(self, global_start: datetime.datetime) -> SessionManifest:
+        """每个分P的 server_file_name 和稿件提交进度，直播中上传与下播后上传共用。"""
+        return SessionManifest(os.path.splitext(utils.get_manifest_path(
+            self.room_id, global_start, self.config['root']['data_path']))[0]+"_upload.json")
+
+    def append_record_part(self, part: VideoPart, datestr: str, bvid: str = None, state: SessionManifest = None, insert_index: int = None) -> str:
+        """直播中上传：第一个分P创建录播稿件，之后的分P通过编辑稿件插入到 insert_index 处（为 None 时追加到末尾），返回稿件的 bvid。
+
+        传入 state 时分P文件的上传结果记录在上传状态中，重试时不会重复上传。失败时抛出异常。
+        """
+        if state is not None and not self.__restore_part(state, part):
+            self.__upload_part('record', state, part)
+            if not self.__restore_part(state, part):
+                raise RuntimeError(f"分P上传失败：{part.path}")
+        with slot(self.scheduler, 'upload', self.__pending_size([part]), f"{self.room_id} 提交分P"):
+            try:
+                if bvid is None:
+                    _, bvid = upload(self.uploader, [part], **self.submission_info('record', datestr),
+                                     upload_by_edit=True, max_attempts=3)
+                else:
+                    self.uploader.edit(
+                        bvid=bvid,
+                        parts=[part],
+                        insert_index=insert_index,
+                        max_retry=self.config['root']['uploader']['max_retry'],
+                        thread_pool_workers=self.config['root']['uploader']['thread_pool_workers']
+                    )
+            except Exception as e:
+                # 分段保持未确认，重试时使用新的令牌
+                self.__relogin(e)
+                raise
+        return bvid
+
+    def __relogin(self, e: Exception) -> bool:
+        """令牌被服务器拒绝时清除缓存并重新登录，返回是否重新登录。"""
+        if not LoginSession.is_auth_error(e):
+            return False
+        logging.warning(self.generate_log(f"登录已失效，重新登录：{e}"))
+        try:
+            self.uploader = LoginSession.relogin(self.config, self.uploader)
+        except Exception as login_error:
+            logging.error(self.generate_log(f"重新登录失败：{login_error}"))
+            return False
+        return True
+
+    @staticmethod
+    def __pending_size(parts: list) -> int:
+        # 提交时会补传尚未上传的分P，只有这部分数据计入排队优先级
+        return sum(os.path.getsize(part.path) for part in parts
+                   if part.server_file_name is None and os.path.exists(part.path))
+
+    def __restore_part(self, state: SessionManifest, part: VideoPart) -> bool:
+        entry = state.stage('upload').get(os.path.abspath(part.path))
+        if entry is None or time.time()-entry['uploaded_at'] > PART_REUSE_SECONDS:
+            return False
+        if not state.is_done('upload', os.path.abspath(part.path)):
+            return False
+        part.server_file_name = entry['server_file_name']
+        return True
+
+    def __upload_part(self, kind: str, state: SessionManifest, part: VideoPart) -> None:
+        size = os.path.getsize(part.path)
+        try:
+            with slot(self.scheduler, 'upload', size, f"{self.room_id} 上传分P"), \
+                    span('upload_part', 'upload', path=part.path, size=size):
+                start = time.time()
+                ok = upload_video_part(self.uploader.access_token, self.uploader.sid, self.uploader.mid,
+                                       part, self.config['root']['uploader']['max_retry'])
+        except Exception as e:
+            logging.error(self.generate_log(
+                f"分P上传失败，将在提交时重试：{part.path} {e}"))
+            self.__relogin(e)
+            return
+        elapsed = time.time()-start
+        if not ok or part.server_file_name is None:
+            logging.error(self.generate_log(
+                f"分P上传失败，将在提交时重试：{part.path}"))
+            return
+        self.metrics.inc('ddrecorder_upload_bytes_total',
+                         size, room=self.room_id, kind=kind)
+        self.metrics.inc('ddrecorder_upload_seconds_total',
+                         elapsed, room=self.room_id, kind=kind)
+        logging.info(self.generate_log(
+            f"分P上传完成：{part.path} {size/1024/1024:.1f}MB 用时 {elapsed:.1f} 秒 {size/1024/1024/max(elapsed, 0.001):.2f}MB/s"))
+        state.mark_done('upload', [part.path], item=os.path.abspath(part.path),
+                        server_file_name=part.server_file_name, uploaded_at=time.time(),
+                        elapsed=elapsed)
+
+    def __submit(self, kind: str, parts: list, datestr: str, state: SessionManifest) -> tuple:
+        with slot(self.scheduler, 'upload', self.__pending_size(parts), f"{self.room_id} 提交稿件"):
+            try:
+                return self.__do_submit(kind, parts, datestr, state)
+            except Exception as e:
+                if not self.__relogin(e):
+                    raise
+            # 提交进度已记录在上传状态中，重新登录后从中断处继续
+            return self.__do_submit(kind, parts, datestr, state)
+
+    @traced('submit', 'upload')
+    def __do_submit(self, kind: str, parts: list, datestr: str, state: SessionManifest) -> tuple:
+        submission = state.get(kind, {})
+        if submission.get('bvid') is not None and submission['submitted'] >= len(parts):
+            logging.info(self.generate_log(
+                f"稿件已提交过，跳过：{submission['bvid']}"))
+            return submission['avid'], submission['bvid']
+        info = self.submission_info(kind, datestr)
+        if submission.get('bvid') is None:
+            if not self.config['root']['uploader']['upload_by_edit']:
+                avid, bvid = upload(self.uploader, parts, **info)
+                state.set(kind, {'avid': avid, 'bvid': bvid,
+                                 'submitted': len(parts)})
+                return avid, bvid
+            avid, bvid = upload(self.uploader, parts[:1], **info,
+                                upload_by_edit=True)
+            submission = {'avid': avid, 'bvid': bvid, 'submitted': 1}
+            state.set(kind, submission)
+        else:
+            # 稿件已经存在（如重启后又切出了新的分P），只追加剩余的分P，不能重新投稿
+            logging.info(self.generate_log(
+                f"稿件{submission['bvid']} 已提交 {submission['submitted']} 个分P，追加剩余的 {len(parts)-submission['submitted']} 个"))
+        # 通过编辑稿件追加分P时逐个记录进度，重启后从第一个未追加的分P继续
+        for i in range(submission['submitted'], len(parts)):
+            self.uploader.edit(
+                bvid=submission['bvid'],
+                parts=[parts[i]],
+                max_retry=info['max_retry'],
+                thread_pool_workers=info['thread_pool_workers']
+            )
+            submission['submitted'] = i+1
+            state.set(kind, submission)
+        return submission['avid'], submission['bvid']
+
+    def clip_part(self, path: str, datestr: str) -> VideoPart:
+        title = os.path.splitext(os.path.basename(path))[0].split("_")[-1]
+        return VideoPart(
+            path=path,
+            title=title,
+            desc=self.config['spec']['uploader']['clips']['desc'].format(
+                date=datestr, title=self.roomname),
+        )
+
+    def record_part(self, path: str, datestr: str, global_start: datetime.datetime, global_end: datetime.datetime, bounds: tuple = None) -> VideoPart:
+        if bounds is not None:
+            # 处理进程给出的实际切分位置（已对齐到关键帧）
+            start, end = bounds
+        else:
+            split_interval = datetime.timedelta(
+                0, self.config['spec']['uploader']['record']['split_interval'])
+            i = get_part_index(path)
+            start = global_start + split_interval*i
+            end = global_start + split_interval*(i+1)
+            if(end > global_end):
+                end = global_end
+        title = start.strftime(
+            '%H:%M:%S~') + end.strftime('%H:%M:%S')
+        return VideoPart(
+            path=path,
+            title=title,
+            desc=self.config['spec']['uploader']['record']['desc'].format(
+                date=datestr, title=self.roomname),
+        )
+
     def upload(self, global_start: datetime.datetime, global_end: datetime.datetime) -> dict:
+        part_queue = queue.Queue()
+        if self.config['spec']['uploader']['clips']['upload_clips']:
+            for filename in os.listdir(self.output_dir):
+                part_queue.put(
+                    ('clips', os.path.join(self.output_dir, filename), None))
+        if self.config['spec']['uploader']['record']['upload_record']:
+            for filename in os.listdir(self.splits_dir):
+                part_queue.put(
+                    ('record', os.path.join(self.splits_dir, filename), None))
+        part_queue.put((None, None, None))
+        return self.upload_from_queue(part_queue, global_start, global_end)
+
+    def upload_from_queue(self, part_queue: queue.Queue, global_start: datetime.datetime, global_end: datetime.datetime) -> dict:
+        """边处理边上传。
 
+        part_queue 中依次放入 (类别, 文件路径, 起止时间)，类别为 clips 或 record，以 (None, None, None) 结束。
+        起止时间为处理进程实际切出的范围，录播分P用作标题，为 None 时按分P序号和 split_interval 推算。
+        每个文件一放入队列就开始上传分P，全部处理完成后再按原有的顺序和标题提交稿件。
+        已上传的分P带有 server_file_name，提交时不会重复上传。
+        每个分P的 server_file_name 和稿件的提交进度记录在上传状态文件中，重试或重启后只上传未完成的分P。
+        """
+        state = self.get_upload_state(global_start)
         return_dict = {}
-        try:
-            if self.config['spec']['uploader']['clips']['upload_clips']:
-                output_parts = []
-                datestr = global_start.strftime(
-                    '%Y{y}%m{m}%d{d}').format(y='年', m='月', d='日')
-                filelists = os.listdir(self.output_dir)
-                for filename in filelists:
-                    if os.path.getsize(os.path.join(self.output_dir, filename)) < 1024*1024:
-                        continue
-                    title = os.path.splitext(filename)[0].split("_")[-1]
-                    output_parts.append(VideoPart(
-                        path=os.path.join(self.output_dir, filename),
-                        title=title,
-                        desc=self.config['spec']['uploader']['clips']['desc'].format(
-                            date=datestr, title=self.roomname),
-                    ))
-
-                avid, bvid = upload(self.uploader, output_parts,
-                                    cr=self.config['spec']['uploader']['copyright'],
-                                    title=self.config['spec']['uploader']['clips']['title'].format(
-                                        date=datestr, title=self.roomname),
-                                    tid=self.config['spec']['uploader']['clips']['tid'],
-                                    tags=self.config['spec']['uploader']['clips']['tags'],
-                                    desc=self.config['spec']['uploader']['clips']['desc'].format(
-                                        date=datestr, title=self.roomname),
-                                    source="https://live.bilibili.com/"+self.room_id,
-                                    thread_pool_workers=self.config['root']['uploader']['thread_pool_workers'],
-                                    max_retry=self.config['root']['uploader']['max_retry'],
-                                    upload_by_edit=self.config['root']['uploader']['upload_by_edit'])
-                return_dict["clips"] = {
-                    "avid": avid,
-                    "bvid": bvid
-                }
-            if self.config['spec']['uploader']['record']['upload_record']:
-                splits_parts = []
-                datestr = global_start.strftime(
-                    '%Y{y}%m{m}%d{d}').format(y='年', m='月', d='日')
-                split_interval = datetime.timedelta(
-                    0, self.config['spec']['uploader']['record']['split_interval'])
-                filelists = os.listdir(self.splits_dir)
-                for filename in filelists:
-                    if os.path.getsize(os.path.join(self.splits_dir, filename)) < 1024*1024:
-                        continue
-                    i = int(os.path.splitext(filename)[0])
-                    start = global_start + split_interval*i
-                    end = global_start + split_interval*(i+1)
-                    if(end > global_end):
-                        end = global_end
-                    title = start.strftime(
-                        '%H:%M:%S~') + end.strftime('%H:%M:%S')
-                    splits_parts.append(VideoPart(
-                        path=os.path.join(self.splits_dir, filename),
-                        title=title,
-                        desc=self.config['spec']['uploader']['record']['desc'].format(
-                            date=datestr, title=self.roomname),
-                    ))
-
-                avid, bvid = upload(self.uploader, splits_parts,
-                                    cr=self.config['spec']['uploader']['copyright'],
-                                    title=self.config['spec']['uploader']['record']['title'].format(
-                                        date=datestr, title=self.roomname),
-                                    tid=self.config['spec']['uploader']['record']['tid'],
-                                    tags=self.config['spec']['uploader']['record']['tags'],
-                                    desc=self.config['spec']['uploader']['record']['desc'].format(
-                                        date=datestr, title=self.roomname),
-                                    source="https://live.bilibili.com/"+self.room_id,
-                                    thread_pool_workers=self.config['root']['uploader']['thread_pool_workers'],
-                                    max_retry=self.config['root']['uploader']['max_retry'],
-                                    upload_by_edit=self.config['root']['uploader']['upload_by_edit'])
-                return_dict["record"] = {
+        datestr = global_start.strftime(
+            '%Y{y}%m{m}%d{d}').format(y='年', m='月', d='日')
+        pending = {'clips': [], 'record': []}
+        with ThreadPoolExecutor(max_workers=self.config['root']['uploader']['thread_pool_workers']) as pool:
+            while True:
+                kind, path, bounds = part_queue.get()
+                if kind is None:
+                    break
+                if not self.config['spec']['uploader'][kind]['upload_'+kind]:
+                    continue
+                if os.path.getsize(path) < 1024*1024:
+                    continue
+                if kind == 'clips':
+                    part = self.clip_part(path, datestr)
+                    order = os.path.basename(path)
+                else:
+                    part = self.record_part(
+                        path, datestr, global_start, global_end, bounds)
+                    order = get_part_index(path)
+                if self.__restore_part(state, part):
+                    logging.info(self.generate_log(
+                        f"分P已上传过，跳过：{path}"))
+                else:
+                    logging.info(self.generate_log(f"开始上传分P：{path}"))
+                    pool.submit(self.__upload_part, kind, state, part)
+                pending[kind].append((order, part))
+
+        for kind in ['clips', 'record']:
+            if not pending[kind]:
+                continue
+            parts = [part for _, part in sorted(
+                pending[kind], key=lambda x: x[0])]
+            try:
+                avid, bvid = self.__submit(kind, parts, datestr, state)
+                return_dict[kind] = {
                     "avid": avid,
                     "bvid": bvid
                 }
-        except Exception as e:
-            logging.error(self.generate_log(
-                'Error while uploading:' + str(e)+traceback.format_exc()))
+            except Exception as e:
+                return_dict[kind] = None
+                logging.error(self.generate_log(
+                    'Error while uploading:' + str(e)+traceback.format_exc()))
+        self.metrics.flush(force=True)
         return return_dict
 
 
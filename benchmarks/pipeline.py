@@ -0,0 +1,436 @@
+"""处理流水线端到端基准测试。
+
+用 ffmpeg 的 lavfi 测试源生成多段 FLV 录像（片段之间留有模拟断流重连的间隔）和带高能时段的弹幕、礼物、SC 数据，
+然后依次运行转码合并（pre_concat）、弹幕统计（count/get_cut_points）、切片（cut）、分P（split）
+和上传（Uploader，上传到本地的替身服务器），统计每个阶段的耗时、CPU 时间、峰值内存和读写字节数。
+
+每个阶段在 fork 出的子进程中运行，峰值内存和读写字节数只包含该阶段（及其 ffmpeg 子进程）。
+读写字节数来自 /proc/self/io，不支持的平台上为 null。
+上传阶段的替身服务器与上传在同一进程中运行，CPU 时间包含接收端。
+
+用法：python benchmarks/pipeline.py [--segments 3] [--segment-seconds 120] [--json result.json] [--baseline old.json]
+"""
+import argparse
+import datetime
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+ROOM_ID = "10000"
+UPLOAD_CHUNK_SIZE = 4*1024*1024
+
+DANMU_TEXTS = ["哈哈哈哈哈", "草", "好听", "？？？", "awsl", "8888888", "来了来了", "晚上好",
+               "这波操作可以", "笑死我了", "前方高能", "好耶", "再来一首", "主播加油", "太强了吧",
+               "名场面", "切片man在哪", "这也行", "下次一定", "好可爱", "经典", "破防了", "666666"]
+SUPERCHAT_TEXTS = ["主播今天唱得太好了，明天也要来哦", "第一次看直播，已关注", "生日快乐！",
+                   "这首歌可以再唱一遍吗", "辛苦了，早点休息"]
+GIFTS = [("辣条", 1, 100), ("小心心", 30607, 0), ("牛哇牛哇", 31036, 100), ("打call", 31037, 500)]
+
+
+def get_ffmpeg_version() -> str:
+    try:
+        ret = subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, universal_newlines=True)
+        return ret.stdout.splitlines()[0] if ret.stdout else ""
+    except OSError:
+        return ""
+
+
+def generate_segment(path: str, seconds: int, resolution: str, fps: int, bitrate: str) -> None:
+    # 关键帧间隔 2 秒，与B站直播流一致
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error",
+                    "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate={fps}",
+                    "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100",
+                    "-t", str(seconds), "-c:v", "libx264", "-preset", "ultrafast", "-g", str(fps*2),
+                    "-b:v", bitrate, "-c:a", "aac", "-b:a", "128k", "-f", "flv", path], check=True)
+    # 与录制时一样建立关键帧索引
+    from KeyframeIndex import KeyframeIndexWriter
+    writer = KeyframeIndexWriter(path)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            writer.feed(chunk)
+    writer.close()
+
+
+def get_burst_windows(live_seconds: int, rng: random.Random) -> List[tuple]:
+    """每 3 到 6 分钟安排一段 30 到 90 秒的高能时段，弹幕密度为平时的 4 到 8 倍。"""
+    windows = []
+    t = rng.uniform(60, 180)
+    while t < live_seconds:
+        windows.append((t, t+rng.uniform(30, 90), rng.uniform(4, 8)))
+        t += rng.uniform(180, 360)
+    return windows
+
+
+def generate_danmu(danmu_dir: str, live_start: datetime.datetime, live_seconds: int, danmu_rate: float, rng: random.Random) -> dict:
+    windows = get_burst_windows(live_seconds, rng)
+    start_ts = live_start.timestamp()
+    counts = {'danmu': 0, 'superchat': 0, 'gift': 0}
+    with open(os.path.join(danmu_dir, "danmu.jsonl"), "w", encoding="utf-8") as danmu_f, \
+            open(os.path.join(danmu_dir, "superchat.jsonl"), "w", encoding="utf-8") as sc_f, \
+            open(os.path.join(danmu_dir, "gift.jsonl"), "w", encoding="utf-8") as gift_f:
+        for second in range(live_seconds):
+            rate = danmu_rate
+            for begin, end, ratio in windows:
+                if begin <= second < end:
+                    rate *= ratio
+            # 每秒的弹幕数取平均值附近的整数，保持可复现
+            n = int(rate)+(1 if rng.random() < rate-int(rate) else 0)
+            for _ in range(n):
+                ts = start_ts+second+rng.random()
+                uid = rng.randint(1, 500000)
+                text = rng.choice(DANMU_TEXTS)
+                info = [[0, 1, 25, 16777215, int(ts*1000), rng.randint(1, 2**31), 0, "", 0, 0, 0, "", 0, {}, {}],
+                        text, [uid, f"用户{uid}", 0, 0, 0, 10000, 1, ""], [rng.randint(1, 30), "粉丝团", "主播", int(ROOM_ID), 0, "", 0],
+                        [rng.randint(0, 60), 0, 0, ">50000"], ["", ""], 0, rng.choice([0, 0, 0, 3]), None, {"ts": int(ts), "ct": ""}]
+                danmu_f.write(json.dumps({
+                    "raw": info,
+                    "properties": {"type": 1, "size": 25, "color": 16777215, "time": int(ts*1000)},
+                    "text": text,
+                    "user_info": {"user_id": uid, "user_name": f"用户{uid}", "user_isAdmin": False, "user_isVip": False},
+                    "medal_info": {"medal_level": info[3][0], "medal_name": "粉丝团", "medal_liver_name": "主播",
+                                   "medal_liver_roomid": int(ROOM_ID), "medal_liver_uid": 0, "medal_is_lighted": True,
+                                   "medal_guard_level": 0},
+                    "ul_info": {"ul_level": info[4][0]},
+                    "title_info": ["", ""],
+                    "guard_level": info[7]
+                }, ensure_ascii=False)+"\n")
+                counts['danmu'] += 1
+            if rng.random() < 0.01:
+                uid = rng.randint(1, 500000)
+                price = rng.choice([30, 50, 100, 500])
+                sc_f.write(json.dumps({
+                    "raw": {}, "text": rng.choice(SUPERCHAT_TEXTS), "user_id": uid, "user_name": f"用户{uid}",
+                    "time": int(start_ts)+second, "price": price, "SCkeep_time": 60,
+                    "medal_info": {"medal_level": 0, "medal_name": "", "medal_liver_name": "", "medal_liver_uid": 0,
+                                   "medal_is_lighted": False, "medal_guard_level": 0}
+                }, ensure_ascii=False)+"\n")
+                counts['superchat'] += 1
+            if rng.random() < 0.2:
+                uid = rng.randint(1, 500000)
+                gift_name, gift_id, price = rng.choice(GIFTS)
+                num = rng.choice([1, 1, 1, 5, 10])
+                gift_f.write(json.dumps({
+                    "raw": {}, "user_id": uid, "user_name": f"用户{uid}", "time": int(start_ts)+second,
+                    "gift_name": gift_name, "gift_id": gift_id, "gift_type": 0, "price": price, "num": num,
+                    "total_coin": price*num, "coin_type": "gold" if price else "silver",
+                    "medal_info": {"medal_level": 0, "medal_name": "", "medal_liver_uid": 0,
+                                   "medal_is_lighted": False, "medal_guard_level": 0}
+                }, ensure_ascii=False)+"\n")
+                counts['gift'] += 1
+    return counts
+
+
+def get_config(workdir: str, split_interval: int) -> dict:
+    from main import initroot, initspec
+    root_config = {
+        'data_path': workdir,
+        'logger': {'log_path': os.path.join(workdir, 'log'), 'log_level': 'INFO'},
+        'uploader': {'thread_pool_workers': 2}
+    }
+    spec_config = {
+        'room_id': ROOM_ID,
+        'recorder': {'keep_raw_record': True},
+        'clipper': {'enable_clipper': True},
+        'uploader': {
+            'clips': {'upload_clips': True},
+            'record': {'upload_record': True, 'split_interval': split_interval}
+        }
+    }
+    initroot(root_config)
+    initspec(spec_config)
+    return {'root': root_config, 'spec': spec_config, 'password_path': os.path.join(workdir, 'passwd.json')}
+
+
+class StandInServer():
+    """本地的上传替身：接收分P数据块和稿件提交，只计数不保存。"""
+
+    def __init__(self):
+        self.received = 0
+        self.submissions = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if self.path.startswith("/chunk"):
+                    server.received += length
+                while length > 0:
+                    length -= len(self.rfile.read(min(length, 1024*1024)))
+                if self.path.startswith("/submit"):
+                    server.submissions += 1
+                body = b'{"code":0}'
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.address = self.httpd.server_address
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def post(self, path: str, body: bytes) -> None:
+        conn = http.client.HTTPConnection(*self.address)
+        try:
+            conn.request("POST", path, body)
+            conn.getresponse().read()
+        finally:
+            conn.close()
+
+    def upload_video_part(self, access_token, sid, mid, video_part, max_retry=5) -> bool:
+        if video_part.server_file_name is not None:
+            return True
+        # 与真实上传一样按块读取文件并逐块发送
+        with open(video_part.path, "rb") as f:
+            for n, chunk in enumerate(iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b"")):
+                self.post(f"/chunk?part={os.path.basename(video_part.path)}&n={n}", chunk)
+        video_part.server_file_name = "standin/"+os.path.basename(video_part.path)
+        return True
+
+    def get_uploader(self, config: dict):
+        server = self
+
+        class StandInUploader():
+            access_token = "standin"
+            refresh_token = "standin"
+            sid = "standin"
+            mid = 0
+
+            def upload(self, parts, **kwargs):
+                for part in parts:
+                    server.upload_video_part(None, None, None, part)
+                server.post("/submit", json.dumps({'title': kwargs.get('title'), 'parts': len(parts)}).encode())
+                return 1, "BVstandin"
+
+            def edit(self, bvid=None, parts=None, **kwargs):
+                for part in parts:
+                    server.upload_video_part(None, None, None, part)
+                server.post("/submit?edit=1", b"{}")
+
+        return StandInUploader()
+
+
+def read_proc_io() -> dict:
+    try:
+        with open("/proc/self/io", "r") as f:
+            return {k: int(v) for k, v in (line.split(":") for line in f)}
+    except OSError:
+        return {}
+
+
+def measure(func: Callable, result_queue) -> None:
+    """在子进程中运行一个阶段，把统计结果和阶段返回值放入队列。"""
+    io_start = read_proc_io()
+    times_start = os.times()
+    start = time.perf_counter()
+    error = ""
+    value = None
+    try:
+        value = func()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    wall = time.perf_counter()-start
+    times_end = os.times()
+    io_end = read_proc_io()
+    stats = {
+        'wall_s': wall,
+        'cpu_user_s': times_end.user-times_start.user,
+        'cpu_system_s': times_end.system-times_start.system,
+        'children_cpu_s': (times_end.children_user+times_end.children_system) -
+        (times_start.children_user+times_start.children_system),
+        'peak_rss_mb': None,
+        'children_peak_rss_mb': None,
+        'read_bytes': None,
+        'write_bytes': None,
+        'rchar': None,
+        'wchar': None,
+        'error': error
+    }
+    if resource is not None:
+        # Linux 上单位为 KB，macOS 上为字节
+        scale = 1024*1024 if sys.platform == "darwin" else 1024
+        stats['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale
+        stats['children_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/scale
+    if io_start and io_end:
+        # 已结束的子进程（ffmpeg）的读写量会计入父进程
+        for key in ['read_bytes', 'write_bytes', 'rchar', 'wchar']:
+            stats[key] = io_end[key]-io_start[key]
+    result_queue.put((stats, value))
+
+
+def run_stage(name: str, func: Callable, results: dict):
+    if "fork" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("fork")
+        result_queue = ctx.Queue()
+        p = ctx.Process(target=measure, args=(func, result_queue))
+        p.start()
+        stats, value = result_queue.get()
+        p.join()
+    else:
+        # 不支持 fork 时在本进程中运行，峰值内存为整个进程的峰值
+        import queue
+        result_queue = queue.Queue()
+        measure(func, result_queue)
+        stats, value = result_queue.get()
+    results['stages'][name] = stats
+    status = "失败："+stats['error'] if stats['error'] else "OK"
+    print(f"  {name:<10}{stats['wall_s']:>9.2f} s  {status}", flush=True)
+    return value
+
+
+def run(args) -> dict:
+    import Processor
+    import utils
+    from SessionManifest import SessionManifest
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ddrecorder_bench_")
+    rng = random.Random(args.seed)
+    config = get_config(workdir, args.split_interval)
+    utils.check_and_create_dir(config['root']['logger']['log_path'])
+    utils.init_data_dirs(workdir)
+    global_start = datetime.datetime(2021, 11, 18, 20, 0, 0)
+    record_dir = utils.init_record_dir(ROOM_ID, global_start, workdir)
+    danmu_dir = utils.init_danmu_log_dir(ROOM_ID, global_start, workdir)
+    results = {
+        'python': sys.version,
+        'ffmpeg': get_ffmpeg_version(),
+        'params': {k: v for k, v in vars(args).items() if k not in ('json', 'baseline', 'workdir', 'keep')},
+        'input': {},
+        'stages': {}
+    }
+    print(f"工作目录：{workdir}")
+
+    def generate():
+        offset = 0
+        for i in range(args.segments):
+            start = global_start+datetime.timedelta(seconds=offset)
+            path = os.path.join(record_dir, f"{ROOM_ID}_{start.strftime('%Y-%m-%d_%H-%M-%S')}.flv")
+            generate_segment(path, args.segment_seconds, args.resolution, args.fps, args.bitrate)
+            offset += args.segment_seconds+args.gap_seconds
+        live_seconds = offset-args.gap_seconds
+        counts = generate_danmu(danmu_dir, global_start, live_seconds, args.danmu_rate, rng)
+        return {'live_seconds': live_seconds, 'record_bytes': utils.get_dir_size(record_dir), **counts}
+
+    results['input'] = run_stage('generate', generate, results) or {}
+    p = Processor.Processor(config, global_start)
+
+    def reload_manifest():
+        # 各阶段在子进程中更新处理清单，父进程需要重新读取
+        p.manifest = SessionManifest(p.manifest.path)
+
+    run_stage('concat', p.pre_concat, results)
+    reload_manifest()
+    # 合并已记录在处理清单中，这里只读取各片段的时间信息供后续阶段使用
+    p.pre_concat()
+
+    def analyze():
+        parser_config = config['spec']['parser']
+        danmu_list = Processor.parse_danmu(p.danmu_path)
+        counted = Processor.count(danmu_list, p.live_start, p.live_duration, parser_config['interval'])
+        return Processor.get_cut_points(counted, parser_config['up_ratio'], parser_config['down_ratio'], parser_config['topK'])
+
+    cut_points = run_stage('analyze', analyze, results) or []
+    results['input']['cut_points'] = len(cut_points)
+    run_stage('cut', lambda: p.cut(cut_points, config['spec']['clipper']['min_length']), results)
+    reload_manifest()
+    run_stage('split', lambda: p.split(args.split_interval), results)
+
+    def upload():
+        import LoginSession
+        import Uploader
+        server = StandInServer()
+        Uploader.upload_video_part = server.upload_video_part
+        LoginSession.get_uploader = server.get_uploader
+        u = Uploader.Uploader(p.outputs_dir, p.splits_dir, config, "基准测试")
+        ret = u.upload(global_start, global_start+datetime.timedelta(seconds=p.live_duration))
+        if any(v is None for v in ret.values()):
+            raise RuntimeError(f"提交失败：{ret}")
+        return server.received
+
+    if not args.skip_upload:
+        results['uploaded_bytes'] = run_stage('upload', upload, results)
+    results['output_bytes'] = {
+        'merged': os.path.getsize(p.merged_file_path) if os.path.exists(p.merged_file_path) else 0,
+        'outputs': utils.get_dir_size(p.outputs_dir),
+        'splits': utils.get_dir_size(p.splits_dir)
+    }
+    p.ffmpeg_logfile_hander.close()
+    if not args.workdir and not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def format_bytes(n) -> str:
+    return "-" if n is None else f"{n/1024/1024:.1f}"
+
+
+def print_report(results: dict, baseline: dict = None) -> None:
+    print(f"\nPython {results['python'].split()[0]}，{results['ffmpeg'] or '未找到 ffmpeg'}")
+    print("输入："+"，".join(f"{k}={v}" for k, v in results['input'].items()))
+    header = f"{'阶段':<10}{'耗时(s)':>9}{'CPU(s)':>9}{'子进程CPU(s)':>13}{'峰值内存(MB)':>13}{'读(MB)':>9}{'写(MB)':>9}"
+    if baseline:
+        header += f"{'对比基线':>10}"
+    print(header)
+    for name, s in results['stages'].items():
+        peak = max(s['peak_rss_mb'] or 0, s['children_peak_rss_mb'] or 0)
+        line = f"{name:<10}{s['wall_s']:>9.2f}{s['cpu_user_s']+s['cpu_system_s']:>9.2f}{s['children_cpu_s']:>13.2f}" \
+            f"{peak:>13.1f}{format_bytes(s['rchar']):>9}{format_bytes(s['wchar']):>9}"
+        old = (baseline or {}).get('stages', {}).get(name)
+        if old and old['wall_s'] > 0:
+            line += f"{(s['wall_s']/old['wall_s']-1)*100:>+9.1f}%"
+        if s['error']:
+            line += f"  失败：{s['error']}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DDRecorder 处理流水线基准测试")
+    parser.add_argument("--segments", type=int, default=3, help="录像片段数（相邻片段之间模拟一次断流重连）")
+    parser.add_argument("--segment-seconds", type=int, default=120, help="每个片段的时长，单位秒")
+    parser.add_argument("--gap-seconds", type=int, default=5, help="断流重连的间隔，单位秒")
+    parser.add_argument("--resolution", default="1280x720", help="视频分辨率")
+    parser.add_argument("--fps", type=int, default=30, help="视频帧率")
+    parser.add_argument("--bitrate", default="2M", help="视频码率")
+    parser.add_argument("--danmu-rate", type=float, default=5, help="平时每秒的弹幕数，高能时段为其 4 到 8 倍")
+    parser.add_argument("--split-interval", type=int, default=120, help="分P时长，单位秒，0 为不切分")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("--skip-upload", action="store_true", help="不运行上传阶段")
+    parser.add_argument("--workdir", help="工作目录，默认使用临时目录并在结束后删除")
+    parser.add_argument("--keep", action="store_true", help="保留临时工作目录")
+    parser.add_argument("--json", help="将结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果比较耗时")
+    args = parser.parse_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    results = run(args)
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+    if any(s['error'] for s in results['stages'].values()):
+        sys.exit(1)
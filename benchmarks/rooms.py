@@ -0,0 +1,200 @@
+"""大量直播间的压力测试。
+
+启动本地替身服务器（benchmarks/standin.py），生成监控 N 个直播间、接口指向替身服务器的配置，
+以独立进程运行 main.py，每秒采样主进程及其全部子进程的 CPU、内存、线程数和进程数，
+并统计实际的状态检查速率（与 直播间数/check_interval 比较）、开播直播间全部开始录制所需的时间，
+以及测试中途让一批直播间开播后被检测到并开始录制的延迟。只支持 Linux（读取 /proc）。
+
+用法：python benchmarks/rooms.py [--rooms 500] [--duration 180] [--check-interval 30] [--json result.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standin import BiliStandIn  # noqa: E402
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def get_process_tree(root_pid: int) -> List[int]:
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    pids = [root_pid]
+    for pid in pids:
+        pids.extend(children.get(pid, []))
+    return pids
+
+
+def sample_tree(root_pid: int) -> Dict[str, float]:
+    cpu_ticks = 0
+    rss = 0
+    threads = 0
+    pids = get_process_tree(root_pid)
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu_ticks += int(fields[11])+int(fields[12])
+            threads += int(fields[17])
+            with open(f"/proc/{pid}/statm", "r") as f:
+                rss += int(f.read().split()[1])*PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+    return {'time': time.time(), 'cpu_s': cpu_ticks/CLOCK_TICKS, 'rss_mb': rss/1024/1024,
+            'threads': threads, 'processes': len(pids)}
+
+
+def write_config(workdir: str, args, api_url: str) -> str:
+    config = {
+        'root': {
+            'check_interval': args.check_interval,
+            'print_interval': 3600,
+            'data_path': workdir,
+            'api': {'live': api_url, 'main': api_url},
+            'enable_live_listener': False,
+            'logger': {'log_path': os.path.join(workdir, 'log'), 'log_level': 'INFO'}
+        },
+        'spec': [{
+            'room_id': str(args.first_room+i),
+            'clipper': {'enable_clipper': False},
+            'uploader': {'record': {'upload_record': False}, 'clips': {'upload_clips': False}}
+        } for i in range(args.rooms)]
+    }
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+    with open(os.path.join(workdir, "passwd.json"), "w", encoding="utf-8") as f:
+        json.dump({}, f)
+    return config_path
+
+
+def wait_for_streams(standin: BiliStandIn, target: int, timeout: float) -> float:
+    start = time.time()
+    while time.time()-start < timeout:
+        if standin.stats()['active_streams'] >= target:
+            return time.time()-start
+        time.sleep(0.2)
+    return None
+
+
+def run(args) -> dict:
+    standin = BiliStandIn(live_ratio=args.live_ratio, mirrors=2, bitrate=args.bitrate, latency=args.latency,
+                          jitter=args.latency/2, failure_rate=args.failure_rate, seed=args.seed)
+    standin.start()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ddrecorder_rooms_")
+    config_path = write_config(workdir, args, standin.url)
+    room_ids = [str(args.first_room+i) for i in range(args.rooms)]
+    live_rooms = [room_id for room_id in room_ids if standin.is_live(room_id)]
+    offline_rooms = [room_id for room_id in room_ids if room_id not in live_rooms]
+    print(f"工作目录：{workdir}，替身服务器：{standin.url}，{len(live_rooms)}/{args.rooms} 个直播间开播", flush=True)
+
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "main.py"), config_path,
+                             os.path.join(workdir, "passwd.json")], cwd=workdir, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    launched = time.time()
+    samples = []
+    results = {'params': {k: v for k, v in vars(args).items() if k not in ('json', 'workdir', 'keep')},
+               'live_rooms': len(live_rooms)}
+    try:
+        results['time_to_all_streams_s'] = wait_for_streams(
+            standin, len(live_rooms), args.duration/2)
+        # 中途让一批直播间开播，检测延迟取决于检查间隔
+        toggled = offline_rooms[:args.toggle]
+        toggle_time = time.time()
+        for room_id in toggled:
+            standin.set_live(room_id, True)
+        polls_start = standin.stats()['requests'].get('get_info', 0)
+        polls_start_time = time.time()
+        results['toggle_rooms'] = len(toggled)
+        results['toggle_detect_s'] = None
+        while time.time()-launched < args.duration and proc.poll() is None:
+            samples.append(sample_tree(proc.pid))
+            if results['toggle_detect_s'] is None and toggled and \
+                    standin.stats()['active_streams'] >= len(live_rooms)+len(toggled):
+                results['toggle_detect_s'] = time.time()-toggle_time
+            time.sleep(1)
+        polls = standin.stats()['requests'].get('get_info', 0)-polls_start
+        results['poll_rate'] = polls/max(time.time()-polls_start_time, 0.001)
+        results['expected_poll_rate'] = args.rooms/args.check_interval
+        results['exited_early'] = proc.poll() is not None
+    finally:
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait(10)
+        except (ProcessLookupError, subprocess.TimeoutExpired):
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        standin.stop()
+    if len(samples) >= 2:
+        cpu = [(b['cpu_s']-a['cpu_s'])/(b['time']-a['time'])*100 for a, b in zip(samples, samples[1:])]
+        results['cpu_percent'] = {'mean': statistics.mean(cpu), 'max': max(cpu)}
+        results['rss_mb'] = {'mean': statistics.mean(s['rss_mb'] for s in samples),
+                             'max': max(s['rss_mb'] for s in samples)}
+        results['threads_max'] = max(s['threads'] for s in samples)
+        results['processes_max'] = max(s['processes'] for s in samples)
+    results['standin'] = standin.stats()
+    results['samples'] = samples
+    if not args.workdir and not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_report(results: dict) -> None:
+    def fmt(v, unit=""):
+        return "-" if v is None else f"{v:.1f}{unit}"
+    print(f"直播间 {results['params']['rooms']} 个，开播 {results['live_rooms']} 个")
+    print(f"全部开始录制用时：{fmt(results.get('time_to_all_streams_s'), ' s')}")
+    print(f"中途开播 {results.get('toggle_rooms', 0)} 个，检测并开始录制用时：{fmt(results.get('toggle_detect_s'), ' s')}")
+    print(f"状态检查速率：{fmt(results.get('poll_rate'))}/s（预期 {fmt(results.get('expected_poll_rate'))}/s）")
+    if 'cpu_percent' in results:
+        print(f"CPU：平均 {results['cpu_percent']['mean']:.1f}% 最高 {results['cpu_percent']['max']:.1f}%，"
+              f"内存：平均 {results['rss_mb']['mean']:.1f}MB 最高 {results['rss_mb']['max']:.1f}MB，"
+              f"线程最多 {results['threads_max']}，进程最多 {results['processes_max']}")
+    print("替身服务器："+json.dumps(results['standin'], ensure_ascii=False))
+    if results.get('exited_early'):
+        print("main.py 提前退出，请检查工作目录中的日志（--keep）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DDRecorder 大量直播间压力测试")
+    parser.add_argument("--rooms", type=int, default=500, help="监控的直播间数")
+    parser.add_argument("--first-room", type=int, default=100000, help="第一个直播间的房间号，之后依次加一")
+    parser.add_argument("--live-ratio", type=float, default=0.02, help="开播的直播间比例")
+    parser.add_argument("--toggle", type=int, default=5, help="测试中途开播的直播间数")
+    parser.add_argument("--check-interval", type=int, default=30, help="直播状态检查间隔，单位秒")
+    parser.add_argument("--bitrate", type=int, default=500, help="直播流码率，单位 kbps")
+    parser.add_argument("--latency", type=float, default=50, help="接口平均延迟，单位毫秒")
+    parser.add_argument("--failure-rate", type=float, default=0, help="接口请求失败的概率")
+    parser.add_argument("--duration", type=int, default=180, help="测试时长，单位秒")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="工作目录，默认使用临时目录并在结束后删除")
+    parser.add_argument("--keep", action="store_true", help="保留临时工作目录")
+    parser.add_argument("--json", help="将结果写入 JSON 文件")
+    args = parser.parse_args()
+    results = run(args)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,235 @@
+"""B站接口的本地替身服务器，用于离线测试和大量直播间的压力测试。
+
+模拟直播间状态（get_info、get_anchor_in_room）、多个镜像地址的直播流（playUrl，每个地址都是按码率
+实时输出的无尽 FLV 流，关键帧间隔 2 秒）、弹幕服务器配置（getConf）和稿件审核状态（web-interface/view），
+可以注入接口延迟、失败和卡顿的镜像。弹幕 websocket 不在模拟范围内，压力测试时请关闭 enable_live_listener。
+
+把配置文件中的 root.api.live 和 root.api.main 都设为 http://127.0.0.1:<端口> 即可使用。
+管理接口：/admin/stats 返回各接口的请求数和推流情况，/admin/live?room=<房间号>&status=<0|1> 切换直播状态。
+
+用法：python benchmarks/standin.py [--port 8710] [--live-ratio 0.1] [--latency 50] [--failure-rate 0.01]
+"""
+import argparse
+import json
+import random
+import struct
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FLV_HEADER = b'FLV\x01\x05\x00\x00\x00\x09'+struct.pack(">I", 0)
+
+
+def flv_tag(tag_type: int, timestamp: int, data: bytes) -> bytes:
+    header = struct.pack(">B", tag_type)+struct.pack(">I", len(data))[1:] + \
+        struct.pack(">I", timestamp & 0xFFFFFF)[1:]+struct.pack(">B", timestamp >> 24 & 0xFF)+b'\x00\x00\x00'
+    return header+data+struct.pack(">I", 11+len(data))
+
+
+class BiliStandIn():
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, live_ratio: float = 0.1, mirrors: int = 2,
+                 bitrate: int = 2000, fps: int = 25, latency: float = 0, jitter: float = 0,
+                 failure_rate: float = 0, failure_status: int = 412, stall_mirrors: tuple = (),
+                 stall_after: float = 30, review_seconds: float = 60, seed: int = 0):
+        self.live_ratio = live_ratio
+        self.mirrors = mirrors
+        self.bitrate = bitrate
+        self.fps = fps
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.stall_mirrors = set(stall_mirrors)
+        self.stall_after = stall_after
+        self.review_seconds = review_seconds
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.live = {}
+        self.review_first_seen = {}
+        self.requests = Counter()
+        self.failures = Counter()
+        self.streams = 0
+        self.stream_bytes = 0
+        self.rng = random.Random(seed)
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                standin.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://%s:%d" % self.httpd.server_address
+
+    def start(self) -> None:
+        threading.Thread(target=self.httpd.serve_forever,
+                         name="BiliStandIn", daemon=True).start()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+
+    def is_live(self, room_id: str) -> bool:
+        with self.lock:
+            if room_id not in self.live:
+                self.live[room_id] = random.Random(
+                    f"{self.seed}-{room_id}").random() < self.live_ratio
+            return self.live[room_id]
+
+    def set_live(self, room_id: str, status: bool) -> None:
+        with self.lock:
+            self.live[room_id] = status
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'requests': dict(self.requests),
+                'failures': dict(self.failures),
+                'live_rooms': sum(self.live.values()),
+                'known_rooms': len(self.live),
+                'active_streams': self.streams,
+                'stream_bytes': self.stream_bytes
+            }
+
+    def send_json(self, handler: BaseHTTPRequestHandler, obj: dict, status: int = 200) -> None:
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json; charset=utf-8")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle(self, handler: BaseHTTPRequestHandler) -> None:
+        url = urlparse(handler.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        endpoint = url.path.rsplit("/", 1)[-1] if not url.path.startswith("/live/") else "stream"
+        with self.lock:
+            self.requests[endpoint] += 1
+            fail = not url.path.startswith("/admin/") and self.rng.random() < self.failure_rate
+            delay = max(0, self.latency+self.rng.uniform(-self.jitter, self.jitter))/1000
+        if delay:
+            time.sleep(delay)
+        if fail:
+            with self.lock:
+                self.failures[endpoint] += 1
+            self.send_json(handler, {'code': -412, 'message': '请求被拦截'}, self.failure_status)
+            return
+        try:
+            if url.path == "/room/v1/Room/get_info":
+                room_id = query.get('room_id', '0')
+                self.send_json(handler, {'code': 0, 'msg': 'ok', 'message': 'ok', 'data': {
+                    'room_id': int(room_id), 'uid': int(room_id), 'title': f"替身直播间{room_id}",
+                    'live_status': 1 if self.is_live(room_id) else 0}})
+            elif url.path == "/live_user/v1/UserInfo/get_anchor_in_room":
+                room_id = query.get('roomid', '0')
+                self.send_json(handler, {'code': 0, 'msg': 'success', 'data': {
+                    'info': {'uid': int(room_id), 'uname': f"替身主播{room_id}"}}})
+            elif url.path == "/room/v1/Room/playUrl":
+                room_id = query.get('cid', '0')
+                self.send_json(handler, {'code': 0, 'msg': 'ok', 'data': {
+                    'accept_quality': [["10000", "原画"]],
+                    'durl': [{'url': f"{self.url}/live/mirror{i}/{room_id}.flv", 'order': i+1}
+                             for i in range(self.mirrors)]}})
+            elif url.path == "/room/v1/Danmu/getConf":
+                host, port = self.httpd.server_address
+                self.send_json(handler, {'code': 0, 'msg': 'ok', 'data': {
+                    'token': 'standin', 'host_server_list': [{'host': host, 'port': port, 'wss_port': port, 'ws_port': port}]}})
+            elif url.path == "/x/web-interface/view":
+                bvid = query.get('bvid', '')
+                with self.lock:
+                    first_seen = self.review_first_seen.setdefault(bvid, time.time())
+                # 审核中的稿件 state 为 -1
+                state = 0 if time.time()-first_seen >= self.review_seconds else -1
+                self.send_json(handler, {'code': 0, 'message': '0', 'data': {'bvid': bvid, 'state': state}})
+            elif url.path.startswith("/live/"):
+                self.stream(handler, url.path)
+            elif url.path == "/admin/stats":
+                self.send_json(handler, self.stats())
+            elif url.path == "/admin/live":
+                self.set_live(query.get('room', '0'), query.get('status', '1') == '1')
+                self.send_json(handler, {'code': 0})
+            else:
+                self.send_json(handler, {'code': -404, 'message': '啥都木有'}, 404)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def stream(self, handler: BaseHTTPRequestHandler, path: str) -> None:
+        _, _, mirror, filename = path.split("/", 3)
+        room_id = filename.split(".")[0]
+        if not self.is_live(room_id):
+            self.send_json(handler, {'code': -404, 'message': '未开播'}, 404)
+            return
+        handler.send_response(200)
+        handler.send_header("Content-Type", "video/x-flv")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        stall = int(mirror.replace("mirror", "") or 0) in self.stall_mirrors
+        frame_size = max(16, self.bitrate*1000//8//self.fps)
+        payload = bytes(frame_size)
+        with self.lock:
+            self.streams += 1
+        try:
+            handler.wfile.write(FLV_HEADER)
+            # 解码器配置，与真实直播流一样位于开头
+            handler.wfile.write(flv_tag(9, 0, b'\x17\x00\x00\x00\x00\x01\x64\x00\x1f'))
+            handler.wfile.write(flv_tag(8, 0, b'\xaf\x00\x12\x10'))
+            start = time.time()
+            frame = 0
+            while self.is_live(room_id):
+                timestamp = frame*1000//self.fps
+                if stall and timestamp >= self.stall_after*1000:
+                    # 卡顿的镜像保持连接，但每隔几秒才发送一个字节
+                    handler.wfile.write(b'\x00')
+                    handler.wfile.flush()
+                    time.sleep(3)
+                    continue
+                keyframe = frame % (self.fps*2) == 0
+                tag = flv_tag(9, timestamp, (b'\x17\x01' if keyframe else b'\x27\x01')+b'\x00\x00\x00'+payload)
+                handler.wfile.write(tag)
+                with self.lock:
+                    self.stream_bytes += len(tag)
+                frame += 1
+                wait = start+frame/self.fps-time.time()
+                if wait > 0:
+                    time.sleep(wait)
+        finally:
+            with self.lock:
+                self.streams -= 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="B站接口本地替身服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8710)
+    parser.add_argument("--live-ratio", type=float, default=0.1, help="开播的直播间比例，按房间号固定")
+    parser.add_argument("--mirrors", type=int, default=2, help="playUrl 返回的直播流地址数")
+    parser.add_argument("--bitrate", type=int, default=2000, help="直播流码率，单位 kbps")
+    parser.add_argument("--fps", type=int, default=25, help="直播流帧率")
+    parser.add_argument("--latency", type=float, default=0, help="接口平均延迟，单位毫秒")
+    parser.add_argument("--jitter", type=float, default=0, help="接口延迟的波动范围，单位毫秒")
+    parser.add_argument("--failure-rate", type=float, default=0, help="接口请求失败的概率")
+    parser.add_argument("--failure-status", type=int, default=412, help="失败时返回的 HTTP 状态码")
+    parser.add_argument("--stall-mirrors", default="", help="会卡顿的镜像序号，逗号分隔，如 0")
+    parser.add_argument("--stall-after", type=float, default=30, help="卡顿的镜像在推流多少秒后开始卡顿")
+    parser.add_argument("--review-seconds", type=float, default=60, help="稿件第一次被查询后多少秒过审")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stats-interval", type=float, default=10, help="打印统计的间隔，单位秒")
+    args = parser.parse_args()
+    standin = BiliStandIn(args.host, args.port, args.live_ratio, args.mirrors, args.bitrate, args.fps,
+                          args.latency, args.jitter, args.failure_rate, args.failure_status,
+                          tuple(int(m) for m in args.stall_mirrors.split(",") if m), args.stall_after,
+                          args.review_seconds, args.seed)
+    standin.start()
+    print(f"替身服务器已启动：{standin.url}", flush=True)
+    try:
+        while True:
+            time.sleep(args.stats_interval)
+            print(json.dumps(standin.stats(), ensure_ascii=False), flush=True)
+    except KeyboardInterrupt:
+        standin.stop()
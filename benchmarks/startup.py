@@ -0,0 +1,176 @@
+"""启动耗时基准测试。
+
+按进程角色统计导入耗时（基于 python -X importtime）以及 spawn 子进程从启动到完成导入的延迟，
+并与启动预算比较，同时检查各角色没有在导入阶段加载只应在使用时才导入的依赖。Windows 打包版本使用 spawn 启动子进程，子进程会重新导入 main.py，
+因此每个角色的耗时都包含 main 本身。
+
+用法：python benchmarks/startup.py [--repeat 5] [--top 10] [--json result.json] [--strict]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 每个角色的子进程实际需要导入的模块
+ROLES = {
+    'main': ['main'],
+    'recorder': ['main', 'BiliLiveRecorder'],
+    'danmu': ['main', 'DanmuRecorder'],
+    'processor': ['main', 'MainRunner', 'Processor'],
+    'uploader': ['main', 'MainRunner', 'Uploader'],
+    'checker': ['main', 'BiliVideoChecker'],
+    'listener': ['main', 'MainRunner', 'LiveEventListener'],
+}
+
+# 每个角色的导入耗时预算，单位毫秒
+BUDGET_MS = {
+    'main': 300,
+    'recorder': 350,
+    'danmu': 450,
+    'processor': 900,
+    'uploader': 900,
+    'checker': 350,
+    'listener': 350,
+}
+
+# 各角色导入阶段不应加载的模块（及其子模块）：主进程只做监控和调度，
+# 网络请求、开播监听和上传相关的依赖在第一次使用时才导入
+FORBIDDEN_IMPORTS = {
+    'main': ['requests', 'urllib3', 'brotli', 'aiowebsocket', 'bilibiliuploader',
+             'ffmpeg', 'jieba', 'prettytable', 'lastversion'],
+    'checker': ['requests', 'urllib3', 'bilibiliuploader'],
+    'listener': ['requests', 'urllib3', 'brotli', 'aiowebsocket', 'bilibiliuploader'],
+}
+
+
+def parse_importtime(stderr: str) -> Tuple[Dict[str, int], int]:
+    """解析 -X importtime 的输出，返回每个模块的累计耗时（微秒）及全部导入的总耗时。"""
+    modules = {}
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3:
+            continue
+        cumulative = int(fields[1].strip())
+        name = fields[2].rstrip()
+        modules[name.strip()] = cumulative
+        if name.startswith(" ") and not name.startswith("  "):
+            # 只有一个空格缩进的是被直接导入的顶层模块，其累计耗时之和即总耗时
+            total += cumulative
+    return modules, total
+
+
+def find_forbidden(role: str, imported: Dict[str, int]) -> List[str]:
+    forbidden = FORBIDDEN_IMPORTS.get(role, [])
+    return sorted({name for name in imported for f in forbidden
+                   if name == f or name.startswith(f+".")})
+
+
+def measure_imports(modules: List[str]) -> Tuple[Dict[str, int], int, float, str]:
+    code = "; ".join(f"import {m}" for m in modules)
+    start = time.perf_counter()
+    ret = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                         cwd=ROOT_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.perf_counter()-start
+    error = ""
+    if ret.returncode != 0:
+        error = ret.stderr.strip().splitlines()[-1] if ret.stderr.strip() else f"exit {ret.returncode}"
+    top_level, total = parse_importtime(ret.stderr)
+    return top_level, total, wall, error
+
+
+def _spawn_child(modules: List[str], queue) -> None:
+    sys.path.insert(0, ROOT_DIR)
+    error = ""
+    try:
+        for m in modules:
+            __import__(m)
+    except Exception as e:
+        error = str(e)
+    queue.put((time.time(), error))
+
+
+def measure_spawn(modules: List[str]) -> Tuple[float, str]:
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    start = time.time()
+    p = ctx.Process(target=_spawn_child, args=(modules, queue))
+    p.start()
+    ready, error = queue.get()
+    p.join()
+    return ready-start, error
+
+
+def run(repeat: int = 5, top: int = 10) -> dict:
+    baseline = statistics.median(
+        measure_imports(["sys"])[2] for _ in range(repeat))
+    results = {"python": sys.version, "interpreter_startup_ms": baseline*1000, "roles": {}}
+    for role, modules in ROLES.items():
+        walls = []
+        totals = []
+        spawns = []
+        top_level = {}
+        error = ""
+        for _ in range(repeat):
+            top_level, total, wall, error = measure_imports(modules)
+            walls.append(wall)
+            totals.append(total)
+            spawn, spawn_error = measure_spawn(modules)
+            spawns.append(spawn)
+            error = error or spawn_error
+        import_ms = statistics.median(totals)/1000
+        forbidden = find_forbidden(role, top_level)
+        results["roles"][role] = {
+            "modules": modules,
+            "import_ms": import_ms,
+            "process_wall_ms": statistics.median(walls)*1000,
+            "spawn_latency_ms": statistics.median(spawns)*1000,
+            "budget_ms": BUDGET_MS.get(role),
+            "over_budget": BUDGET_MS.get(role) is not None and import_ms > BUDGET_MS[role],
+            "forbidden_imports": forbidden,
+            "top_modules_ms": {k: v/1000 for k, v in sorted(top_level.items(), key=lambda x: -x[1])[:top]},
+            "error": error,
+        }
+    return results
+
+
+def print_report(results: dict) -> None:
+    print(f"Python {results['python'].split()[0]}，解释器空启动 {results['interpreter_startup_ms']:.1f} ms")
+    print(f"{'角色':<10}{'导入(ms)':>10}{'进程(ms)':>10}{'spawn(ms)':>11}{'预算(ms)':>10}  状态")
+    for role, r in results["roles"].items():
+        status = "超出预算" if r["over_budget"] else "OK"
+        if r["forbidden_imports"]:
+            status = ("超出预算，" if r["over_budget"] else "") + \
+                f"导入了应延迟导入的模块：{', '.join(r['forbidden_imports'])}"
+        if r["error"]:
+            status += f"（导入失败：{r['error']}）"
+        print(f"{role:<10}{r['import_ms']:>10.1f}{r['process_wall_ms']:>10.1f}{r['spawn_latency_ms']:>11.1f}{r['budget_ms']:>10}  {status}")
+    for role, r in results["roles"].items():
+        print(f"\n[{role}] 耗时最多的模块：")
+        for name, ms in r["top_modules_ms"].items():
+            print(f"  {ms:>9.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DDRecorder 启动耗时基准测试")
+    parser.add_argument("--repeat", type=int, default=5, help="每个角色重复测量次数，取中位数")
+    parser.add_argument("--top", type=int, default=10, help="每个角色列出耗时最多的模块数")
+    parser.add_argument("--json", help="将结果写入 JSON 文件")
+    parser.add_argument("--strict", action="store_true", help="任一角色超出预算或导入了应延迟导入的模块时返回非零退出码")
+    args = parser.parse_args()
+    results = run(args.repeat, args.top)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+    if args.strict and any(r["over_budget"] or r["forbidden_imports"] for r in results["roles"].values()):
+        sys.exit(1)
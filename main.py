@@ -1,3 +1,4 @@
+import atexit
 import datetime
 import json
 import logging
@@ -5,15 +6,20 @@ import os
 import sys
 import threading
 import time
-from logging.handlers import RotatingFileHandler
 from multiprocessing import freeze_support
 
-from lastversion import lastversion
-
 import utils
+from BiliVideoChecker import BiliVideoChecker
+from JobScheduler import start_scheduler
 from MainRunner import MainThreadRunner
+from Metrics import MetricsService
+from SpaceManager import SpaceManager
 
 CURRENT_VERSION = "1.1.9.1"
+# 检查配置文件修改时间的间隔，单位秒
+CONFIG_POLL_SECONDS = 5
+# 所有进程共用的日志队列，由主进程中的监听线程写入日志文件
+log_queue = None
 
 
 class versionThread(threading.Thread):
@@ -21,6 +27,7 @@ class versionThread(threading.Thread):
         threading.Thread.__init__(self)
 
     def run(self):
+        from lastversion import lastversion
         latest_version = lastversion.has_update(
             repo="https://github.com.cnpmjs.org/AsaChiri/DDRecorder", current_version=CURRENT_VERSION)
         if latest_version:
@@ -34,6 +41,9 @@ def initroot(root_config: dict):
     root_config.setdefault('print_interval', 60)
     root_config.setdefault('data_path', './')
     root_config.setdefault('request_header', {})
+    api_config: dict = root_config.setdefault('api', {})
+    api_config.setdefault('live', 'https://api.live.bilibili.com')
+    api_config.setdefault('main', 'https://api.bilibili.com')
     root_config.setdefault('enable_baiduyun', False)
 
     logger_config: dict = root_config.setdefault('logger', {})
@@ -44,6 +54,51 @@ def initroot(root_config: dict):
     uploader_config.setdefault('upload_by_edit', False)
     uploader_config.setdefault('thread_pool_workers', 1)
     uploader_config.setdefault('max_retry', 10)
+    uploader_config.setdefault('token_lifetime_days', 30)
+    uploader_config.setdefault('token_refresh_days', 3)
+
+    scheduler_config: dict = root_config.setdefault('scheduler', {})
+    scheduler_config.setdefault('ffmpeg_slots', 1)
+    scheduler_config.setdefault('upload_slots', 1)
+    scheduler_config.setdefault('backup_slots', 1)
+
+    ffmpeg_config: dict = root_config.setdefault('ffmpeg', {})
+    ffmpeg_config.setdefault('nice', 10)
+    ffmpeg_config.setdefault('ionice_class', 'best-effort')
+    ffmpeg_config.setdefault('ionice_level', 7)
+    ffmpeg_config.setdefault('threads', 0)
+    ffmpeg_config.setdefault('recording_threads', 2)
+    ffmpeg_config.setdefault('max_concurrent', 2)
+    ffmpeg_config.setdefault('recording_max_concurrent', 1)
+
+    archive_config: dict = root_config.setdefault('archive', {})
+    archive_config.setdefault('backend', 'bypy')
+    archive_config.setdefault('remote_path', '/L_archives/')
+    archive_config.setdefault('local_path', './archives')
+    archive_config.setdefault('slice_size', 256)
+    archive_config.setdefault('max_workers', 2)
+
+    root_config.setdefault('enable_trace', False)
+    root_config.setdefault('enable_live_listener', True)
+    root_config.setdefault('enable_danmu_index', True)
+
+    metrics_config: dict = root_config.setdefault('metrics', {})
+    metrics_config.setdefault('enabled', False)
+    metrics_config.setdefault('host', '127.0.0.1')
+    metrics_config.setdefault('port', 9105)
+
+    space_config: dict = root_config.setdefault('space', {})
+    space_config.setdefault('high_watermark', 90)
+    space_config.setdefault('low_watermark', 80)
+    space_config.setdefault('check_interval', 60)
+    space_config.setdefault('output_ratio', 3)
+    space_config.setdefault('on_insufficient_space', 'warn')
+    space_config.setdefault('unmanaged_idle_days', 7)
+
+    checker_config: dict = root_config.setdefault('review_checker', {})
+    checker_config.setdefault('max_workers', 2)
+    checker_config.setdefault('request_timeout', 10)
+    checker_config.setdefault('max_interval', 3600)
 
 
 def initspec(spec_config: dict):
@@ -52,6 +107,20 @@ def initspec(spec_config: dict):
 
     recorder_config: dict = spec_config.setdefault('recorder', {})
     recorder_config.setdefault('keep_raw_record', False)
+    recorder_config.setdefault('stall_timeout', 10)
+    recorder_config.setdefault('stall_window', 20)
+    recorder_config.setdefault('stall_ratio', 0.2)
+    recorder_config.setdefault('expected_bitrate', 0)
+    recorder_config.setdefault('remux_during_live', True)
+
+    replay_config: dict = spec_config.setdefault('replay', {})
+    replay_config.setdefault('enabled', False)
+    replay_config.setdefault('buffer_seconds', 300)
+    replay_config.setdefault('max_buffer_mb', 512)
+    replay_config.setdefault('clip_seconds', 60)
+    replay_config.setdefault('auto_trigger', True)
+    replay_config.setdefault('min_danmu', 20)
+    replay_config.setdefault('cooldown', 60)
 
     parser_config: dict = spec_config.setdefault('parser', {})
     parser_config.setdefault('interval', 30)
@@ -75,6 +144,8 @@ def initspec(spec_config: dict):
     record_record.setdefault('upload_record', True)
     record_record.setdefault('keep_record_after_upload', True)
     record_record.setdefault('split_interval', 3600)
+    record_record.setdefault('live_upload', False)
+    record_record.setdefault('live_upload_interval', 3600)
     record_record.setdefault('title', '')
     record_record.setdefault('tid', 27)
     record_record.setdefault('tags', [])
@@ -89,29 +160,76 @@ def initspec(spec_config: dict):
     clips_record.setdefault('desc', '')
 
 
-def run(all_config: dict, logfile_name: str, runner_dict: dict):
-    old_config = all_config
-    try:
-        if len(sys.argv) > 1:
-            all_config_filename = sys.argv[1]
-            with open(all_config_filename, "r", encoding="UTF-8") as f:
-                all_config = json.load(f)
-        else:
-            with open("config.json", "r", encoding="UTF-8") as f:
-                all_config = json.load(f)
-    except Exception as e:
-        print("解析配置文件时出现错误，请检查配置文件！已使用最后一次正确的配置")
-        print("错误详情："+str(e))
-        all_config = old_config
+def collect_metrics(scheduler, space_manager: SpaceManager) -> list:
+    result = []
+    for resource, stat in scheduler.stats().items():
+        result.append(('ddrecorder_scheduler_running',
+                       (('resource', resource),), len(stat['running'])))
+        result.append(('ddrecorder_scheduler_waiting',
+                       (('resource', resource),), len(stat['waiting'])))
+    if space_manager.config is not None:
+        for category, stat in space_manager.stats().items():
+            result.append(('ddrecorder_data_bytes',
+                           (('dir', category),), stat['size']))
+        result.append(('ddrecorder_disk_free_bytes',
+                       (), space_manager.free_space()))
+    return result
+
+
+class ConfigReloader():
+    """按修改时间检查配置文件，文件变化且解析成功时才返回新的配置。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = None
+
+    def poll(self) -> dict:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            if self.mtime is not None:
+                print("读取配置文件时出现错误，已使用最后一次正确的配置")
+                print("错误详情："+str(e))
+                self.mtime = None
+            return None
+        if mtime == self.mtime:
+            return None
+        self.mtime = mtime
+        try:
+            with open(self.path, "r", encoding="UTF-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print("解析配置文件时出现错误，请检查配置文件！已使用最后一次正确的配置")
+            print("错误详情："+str(e))
+            return None
+
+
+def apply_config(all_config: dict, logfile_name: str, runner_dict: dict, scheduler, scheduler_proxy, checker: BiliVideoChecker, space_manager: SpaceManager, metrics: MetricsService) -> dict:
     root_config: dict = all_config.get('root', {})
     initroot(root_config)
     utils.check_and_create_dir(root_config['data_path'])
     utils.check_and_create_dir(root_config['logger']['log_path'])
-    logging.basicConfig(level=utils.get_log_level(root_config['logger']['log_level']),
-                        format='%(asctime)s %(thread)d %(threadName)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-                        datefmt='%a, %d %b %Y %H:%M:%S',
-                        handlers=[RotatingFileHandler(os.path.join(root_config['logger']['log_path'], logfile_name), maxBytes=100*1024*1024, backupCount=5, mode="a", encoding="utf-8")])
+    # 日志文件只在第一次加载配置时打开，之后只更新日志级别
+    global log_queue
+    if log_queue is None:
+        log_queue, listener = utils.start_log_listener(
+            root_config['logger']['log_path'], logfile_name)
+        atexit.register(listener.stop)
+    utils.init_logging({'root': root_config}, log_queue)
     utils.init_data_dirs(root_config['data_path'])
+    ffmpeg_config = root_config['ffmpeg']
+    scheduler.set_limits({
+        'ffmpeg': root_config['scheduler']['ffmpeg_slots'],
+        'ffmpeg_process': ffmpeg_config['max_concurrent'],
+        'upload': root_config['scheduler']['upload_slots'],
+        'backup': root_config['scheduler']['backup_slots']
+    }, {'ffmpeg_process': ffmpeg_config['recording_max_concurrent']})
+    checker.apply_config(root_config)
+    space_manager.apply_config(root_config)
+    metrics.apply_config(root_config)
+
+    # 只启动、停止或更新有变化的直播间，正在录制的直播间在下播后才应用新配置
+    room_ids = set()
     for spec_config in all_config.get('spec', []):
         initspec(spec_config)
         config = {
@@ -120,16 +238,26 @@ def run(all_config: dict, logfile_name: str, runner_dict: dict):
             'password_path': sys.argv[2]
         }
         room_id = spec_config['room_id']
-        if room_id in runner_dict:
+        room_ids.add(room_id)
+        if room_id in runner_dict and runner_dict[room_id].is_alive():
             tr: MainThreadRunner = runner_dict[room_id]
-            tr.mr.config = config
+            tr.mr.stop_requested = False
+            if (tr.mr.pending_config or tr.mr.config) != config:
+                logging.info("直播间 %s 的配置已修改", room_id)
+                tr.mr.pending_config = config
         else:
-            tr = MainThreadRunner(config)
+            # 移除后已经停止的直播间重新加入配置时，需要启动新的监控线程
+            logging.info("开始监控直播间 %s", room_id)
+            tr = MainThreadRunner(
+                config, scheduler_proxy, metrics.proxy, log_queue)
             tr.setDaemon(True)
             runner_dict[room_id] = tr
             tr.start()
-    utils.print_log(runner_dict)
-    time.sleep(root_config['print_interval'])
+    for room_id, tr in runner_dict.items():
+        if room_id not in room_ids and not tr.mr.stop_requested:
+            logging.info("直播间 %s 已从配置中移除，当前录制结束后停止", room_id)
+            tr.mr.stop_requested = True
+    return root_config
 
 
 if __name__ == "__main__":
@@ -141,6 +269,23 @@ if __name__ == "__main__":
         utils.add_path("./ffmpeg/bin")
     logfile_name = "Main_"+datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')+'.log'
     runner_dict = {}
-    all_config = {}
+    scheduler, scheduler_proxy = start_scheduler({})
+    checker = BiliVideoChecker()
+    space_manager = SpaceManager()
+    metrics = MetricsService()
+    metrics.registry.add_collector(
+        lambda: collect_metrics(scheduler, space_manager))
+    reloader = ConfigReloader(sys.argv[1] if len(sys.argv) > 1 else "config.json")
+    root_config = None
+    last_print_time = 0
     while True:
-        run(all_config, logfile_name, runner_dict)
+        all_config = reloader.poll()
+        if all_config is not None:
+            root_config = apply_config(all_config, logfile_name, runner_dict,
+                                       scheduler, scheduler_proxy, checker, space_manager, metrics)
+        for room_id in [room_id for room_id, tr in runner_dict.items() if tr.mr.stop_requested and not tr.is_alive()]:
+            del runner_dict[room_id]
+        if root_config is not None and time.time()-last_print_time >= root_config['print_interval']:
+            utils.print_log(runner_dict, scheduler, space_manager)
+            last_print_time = time.time()
+        time.sleep(CONFIG_POLL_SECONDS)
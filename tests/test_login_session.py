@@ -0,0 +1,82 @@
+"""登录令牌缓存的测试。
+
+用法：python -m unittest discover tests
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import LoginSession  # noqa: E402
+import main  # noqa: E402
+
+
+class LoginSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        root_config = {'data_path': self.config_dir,
+                       'logger': {'log_path': self.config_dir}}
+        main.initroot(root_config)
+        spec_config = {'room_id': '1', 'uploader': {
+            'account': {'username': 'user'}}}
+        main.initspec(spec_config)
+        password_path = os.path.join(self.config_dir, "passwd.json")
+        with open(password_path, "w", encoding="utf-8") as f:
+            json.dump({'user': 'password'}, f)
+        self.config = {'root': root_config, 'spec': spec_config,
+                       'password_path': password_path}
+        self.logins = 0
+        patcher = mock.patch('LoginSession.core.login',
+                             side_effect=self.fake_login)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(LoginSession._sessions, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.config_dir, ignore_errors=True)
+
+    def fake_login(self, username, password):
+        self.logins += 1
+        # 服务器返回的有效期为 7 天，与配置中的默认值不同
+        return 0, f"access_{self.logins}", f"refresh_{self.logins}", "sid", 1, 7*86400
+
+    def cached_token(self) -> dict:
+        return LoginSession._load_tokens(LoginSession.get_token_path(self.config)).get('user')
+
+    def test_expiry_from_login_response(self):
+        uploader = LoginSession.get_uploader(self.config)
+
+        self.assertEqual(uploader.access_token, "access_1")
+        self.assertAlmostEqual(
+            self.cached_token()['expires_at'], time.time()+7*86400, delta=60)
+
+    def test_auth_error_drops_cached_token(self):
+        uploader = LoginSession.get_uploader(self.config)
+        self.assertIs(LoginSession.get_uploader(self.config), uploader)
+        self.assertTrue(LoginSession.is_auth_error(
+            Exception('{"code": -101, "message": "账号未登录"}')))
+        self.assertFalse(LoginSession.is_auth_error(
+            Exception('{"code": -400}')))
+
+        new_uploader = LoginSession.relogin(self.config, uploader)
+
+        self.assertEqual(self.logins, 2)
+        self.assertEqual(new_uploader.access_token, "access_2")
+        self.assertEqual(self.cached_token()['access_token'], "access_2")
+        # 其他线程拿着旧客户端再次报错时不会丢弃已经刷新的令牌
+        self.assertIs(LoginSession.relogin(
+            self.config, uploader), new_uploader)
+        self.assertEqual(self.logins, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+"""Uploader 提交进度恢复的测试。
+
+用法：python -m unittest discover tests
+"""
+import datetime
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import main  # noqa: E402
+import Uploader  # noqa: E402
+import utils  # noqa: E402
+
+
+def fake_upload_video_part(access_token, sid, mid, part, max_retry) -> bool:
+    part.server_file_name = "server_"+os.path.basename(part.path)
+    return True
+
+
+class ResumeSubmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        root_config = {'data_path': self.data_path,
+                       'logger': {'log_path': self.data_path}}
+        main.initroot(root_config)
+        utils.init_data_dirs(self.data_path)
+        spec_config = {'room_id': '1'}
+        main.initspec(spec_config)
+        self.config = {'root': root_config,
+                       'spec': spec_config, 'password_path': ''}
+        self.global_start = datetime.datetime(2021, 11, 18, 20, 0, 0)
+        self.global_end = self.global_start+datetime.timedelta(hours=2)
+        self.splits_dir = os.path.join(self.data_path, 'splits')
+        os.makedirs(self.splits_dir)
+        self.bili = mock.MagicMock()
+        patcher = mock.patch('LoginSession.get_uploader',
+                             return_value=self.bili)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('Uploader.upload_video_part',
+                             side_effect=fake_upload_video_part)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path, ignore_errors=True)
+
+    def make_part(self, index: int) -> str:
+        path = os.path.join(self.splits_dir, f"{index}.mp4")
+        with open(path, "wb") as f:
+            f.write(b"\0"*(1024*1024+1))
+        return path
+
+    def upload(self, paths: list) -> dict:
+        u = Uploader.Uploader(None, self.splits_dir, self.config, "room")
+        part_queue = queue.Queue()
+        for path in paths:
+            part_queue.put(('record', path, None))
+        part_queue.put((None, None, None))
+        return u.upload_from_queue(part_queue, self.global_start, self.global_end)
+
+    def test_resumed_submission_appends_remaining_parts(self):
+        for upload_by_edit in [False, True]:
+            with self.subTest(upload_by_edit=upload_by_edit):
+                self.config['root']['uploader']['upload_by_edit'] = upload_by_edit
+                self.bili.reset_mock()
+                paths = [self.make_part(i) for i in range(3)]
+                u = Uploader.Uploader(
+                    None, self.splits_dir, self.config, "room")
+                state = u.get_upload_state(self.global_start)
+                # 上次只提交了第一个分P，重启后又切出了两个
+                state.set('record', {'avid': 1, 'bvid': 'BV1',
+                                     'submitted': 1})
+
+                result = self.upload(paths)
+
+                self.assertEqual(result['record'], {'avid': 1, 'bvid': 'BV1'})
+                self.bili.upload.assert_not_called()
+                self.assertEqual([call.kwargs['parts'][0].path for call in self.bili.edit.call_args_list],
+                                 paths[1:])
+                self.assertEqual(u.get_upload_state(self.global_start).get('record')['submitted'], 3)
+                os.remove(state.path)
+
+    def test_finished_submission_is_skipped(self):
+        paths = [self.make_part(i) for i in range(2)]
+        u = Uploader.Uploader(None, self.splits_dir, self.config, "room")
+        u.get_upload_state(self.global_start).set(
+            'record', {'avid': 1, 'bvid': 'BV1', 'submitted': 2})
+
+        result = self.upload(paths)
+
+        self.assertEqual(result['record'], {'avid': 1, 'bvid': 'BV1'})
+        self.bili.upload.assert_not_called()
+        self.bili.edit.assert_not_called()
+
+
+class RecordPartTitleTest(unittest.TestCase):
+    def setUp(self):
+        root_config = {'data_path': tempfile.gettempdir(),
+                       'logger': {'log_path': tempfile.gettempdir()}}
+        main.initroot(root_config)
+        spec_config = {'room_id': '1'}
+        main.initspec(spec_config)
+        spec_config['uploader']['record']['split_interval'] = 3600
+        self.config = {'root': root_config,
+                       'spec': spec_config, 'password_path': ''}
+        patcher = mock.patch('LoginSession.get_uploader')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.global_start = datetime.datetime(2021, 11, 18, 20, 0, 0)
+        self.global_end = self.global_start+datetime.timedelta(hours=2)
+
+    def test_title_uses_cut_bounds(self):
+        u = Uploader.Uploader(None, None, self.config, "room")
+        # 分P起点对齐到了 3600 秒之后的关键帧，中间还有一次断流重连
+        bounds = (datetime.datetime(2021, 11, 18, 21, 0, 4),
+                  datetime.datetime(2021, 11, 18, 22, 0, 30))
+        part = u.record_part("1.mp4", "", self.global_start,
+                             self.global_end, bounds)
+        self.assertEqual(part.title, "21:00:04~22:00:30")
+
+    def test_title_without_bounds_uses_split_interval(self):
+        u = Uploader.Uploader(None, None, self.config, "room")
+        part = u.record_part("1.mp4", "", self.global_start, self.global_end)
+        self.assertEqual(part.title, "21:00:00~22:00:00")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,19 @@
 import ctypes
 import datetime
 import logging
+import multiprocessing
 import os
 import platform
+import shutil
 import threading
+import time
 from collections import Counter
 from enum import Enum
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-import jieba
-import prettytable as pt
+from Tracing import traced
+
+LOCK_TIMEOUT = 120
 
 
 def is_windows() -> bool:
@@ -18,6 +23,11 @@ def is_windows() -> bool:
 
 if is_windows():
     import winreg
+else:
+    import fcntl
+
+# Linux 的 FICLONE ioctl，btrfs、xfs 等文件系统上可以共享数据块复制文件
+FICLONE = 0x40049409
 
 
 def get_log_level(log_level: str) -> int:
@@ -32,16 +42,43 @@ def get_log_level(log_level: str) -> int:
     return logging.INFO
 
 
+def get_log_formatter() -> logging.Formatter:
+    return logging.Formatter(
+        '%(asctime)s %(process)d %(thread)d %(threadName)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
+        '%a, %d %b %Y %H:%M:%S')
+
+
+def start_log_listener(log_path: str, logfile_name: str):
+    """在主进程中启动日志监听线程，所有进程的日志经队列汇总写入同一个按大小轮转的文件，返回 (队列, 监听器)。"""
+    handler = RotatingFileHandler(os.path.join(log_path, logfile_name), maxBytes=100*1024*1024,
+                                  backupCount=5, mode="a", encoding="utf-8")
+    handler.setFormatter(get_log_formatter())
+    log_queue = multiprocessing.Queue(-1)
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    return log_queue, listener
+
+
+def init_logging(config: dict, log_queue=None, logname: str = "DDRecorder") -> None:
+    """配置当前进程的根日志：有日志队列时发送给主进程，否则（如单独运行恢复处理）写入独立的日志文件。"""
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    if log_queue is not None:
+        handler = QueueHandler(log_queue)
+    else:
+        handler = RotatingFileHandler(os.path.join(config['root']['logger']['log_path'],
+                                                   logname+"_"+datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')+'.log'),
+                                      maxBytes=100*1024*1024, backupCount=5, mode="a", encoding="utf-8")
+        handler.setFormatter(get_log_formatter())
+    root_logger.addHandler(handler)
+    root_logger.setLevel(get_log_level(config['root']['logger']['log_level']))
+
+
 def get_logger(config: dict, logname: str):
+    # 记录经根日志统一输出
     logger = logging.getLogger(logname)
     logger.setLevel(get_log_level(config['root']['logger']['log_level']))
-    handler = logging.FileHandler(os.path.join(config['root']['logger']['log_path'],
-                                               logname+"_"+datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')+'.log'),
-                                  mode="a", encoding="utf-8")
-    handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(thread)d %(threadName)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-        '%a, %d %b %Y %H:%M:%S'))
-    logger.addHandler(handler)
     return logger
 
 
@@ -58,6 +95,10 @@ def init_data_dirs(root_dir: str = os.getcwd()) -> None:
     check_and_create_dir(os.path.join(root_dir, 'data', 'danmu'))
     check_and_create_dir(os.path.join(root_dir, 'data', 'outputs'))
     check_and_create_dir(os.path.join(root_dir, 'data', 'splits'))
+    check_and_create_dir(os.path.join(root_dir, 'data', 'manifests'))
+    check_and_create_dir(os.path.join(root_dir, 'data', 'review_queue'))
+    check_and_create_dir(os.path.join(root_dir, 'data', 'traces'))
+    check_and_create_dir(os.path.join(root_dir, 'data', 'replays'))
 
 
 def init_record_dir(room_id: str, global_start: datetime.datetime, root_dir: str = os.getcwd()) -> str:
@@ -74,6 +115,17 @@ def init_danmu_log_dir(room_id: str, global_start: datetime.datetime, root_dir:
     return log_dir
 
 
+def init_replay_dir(room_id: str, global_start: datetime.datetime, root_dir: str = os.getcwd()) -> str:
+    dirs = os.path.join(root_dir, 'data', 'replays',
+                        f"{room_id}_{global_start.strftime('%Y-%m-%d_%H-%M-%S')}")
+    check_and_create_dir(dirs)
+    return dirs
+
+
+def get_replay_trigger_path(room_id: str, root_dir: str = os.getcwd()) -> str:
+    return os.path.join(root_dir, 'data', 'replays', f"{room_id}.trigger")
+
+
 def generate_filename(room_id: str) -> str:
     return f"{room_id}_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.flv"
 
@@ -109,12 +161,105 @@ def get_merge_conf_path(room_id: str, global_start: datetime.datetime, root_dir:
     return filename
 
 
+def get_manifest_path(room_id: str, global_start: datetime.datetime, root_dir: str = os.getcwd()) -> str:
+    filename = os.path.join(root_dir, 'data', 'manifests',
+                            f"{room_id}_{global_start.strftime('%Y-%m-%d_%H-%M-%S')}_manifest.json")
+    return filename
+
+
+def get_live_upload_state_path(room_id: str, global_start: datetime.datetime, root_dir: str = os.getcwd()) -> str:
+    return os.path.join(root_dir, 'data', 'manifests',
+                        f"{room_id}_{global_start.strftime('%Y-%m-%d_%H-%M-%S')}_manifest_live_upload.json")
+
+
+def get_trace_path(room_id: str, global_start: datetime.datetime, root_dir: str = os.getcwd()) -> str:
+    return os.path.join(root_dir, 'data', 'traces',
+                        f"{room_id}_{global_start.strftime('%Y-%m-%d_%H-%M-%S')}_trace.json")
+
+
+def get_danmu_index_path(root_dir: str = os.getcwd()) -> str:
+    return os.path.join(root_dir, 'data', 'danmu_index.sqlite')
+
+
+def get_review_queue_dir(root_dir: str = os.getcwd()) -> str:
+    return os.path.join(root_dir, 'data', 'review_queue')
+
+
+def get_media_cache_path(root_dir: str = os.getcwd()) -> str:
+    return os.path.join(root_dir, 'data', 'media_cache.json')
+
+
+def get_dir_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    if os.path.isdir(path):
+        for filename in os.listdir(path):
+            file_path = os.path.join(path, filename)
+            if os.path.isfile(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
 def del_files_and_dir(dirs: str) -> None:
     for filename in os.listdir(dirs):
         os.remove(os.path.join(dirs, filename))
     os.rmdir(dirs)
 
 
+class FileLock():
+    """跨进程的简单文件锁，用于保护多个进程都会读写的小文件（登录令牌、过审检查任务）。
+
+    锁文件超过 LOCK_TIMEOUT 秒未释放时视为持有者已退出。
+    """
+
+    def __init__(self, path: str):
+        self.path = path+".lock"
+
+    def __enter__(self):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time()-os.path.getmtime(self.path) > LOCK_TIMEOUT:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(0.5)
+
+    def __exit__(self, *args):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def place_file(src: str, dst: str) -> str:
+    """把 src 放到 dst，同一文件系统上优先硬链接，其次 reflink，都不行时才复制，返回实际使用的方式。"""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        pass
+    if not is_windows():
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return 'reflink'
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
 def refresh_reg() -> None:
     HWND_BROADCAST = 0xFFFF
     WM_SETTINGCHANGE = 0x1A
@@ -145,6 +290,7 @@ class state(Enum):
     PROCESSING_RECORDS = 2
     UPLOADING_TO_BILIBILI = 3
     UPLOADING_TO_BAIDUYUN = 4
+    WAITING_FOR_RESOURCE = 5
 
     def __str__(self):
         if self.value == self.ERROR.value:
@@ -159,23 +305,45 @@ class state(Enum):
             return "正在上传至Bilibili"
         if self.value == self.UPLOADING_TO_BAIDUYUN.value:
             return "正在上传至百度网盘"
+        if self.value == self.WAITING_FOR_RESOURCE.value:
+            return "排队等待处理资源"
 
     def __int__(self):
         return self.value
 
 
-def print_log(runner_list: list) -> str:
+def print_log(runner_list: list, scheduler=None, space_manager=None) -> str:
+    import prettytable as pt
     tb = pt.PrettyTable()
     tb.field_names = ["TID", "平台", "房间号", "直播状态", "程序状态", "状态变化时间"]
     for runner in runner_list.values():
         tb.add_row([runner.name, runner.mr.bl.site_name, runner.mr.bl.room_id, "是" if runner.mr.bl.live_status else "否",
                     str(state(runner.mr.current_state.value)), datetime.datetime.fromtimestamp(runner.mr.state_change_time.value)])
-    logging.info(f"正在工作线程数：{threading.activeCount()}\n{tb}\n")
+    queue_tb = ""
+    if scheduler is not None:
+        queue_tb = pt.PrettyTable()
+        queue_tb.field_names = ["资源", "并发上限", "运行中", "排队数",
+                                "当前最长等待(秒)", "平均等待(秒)", "排队作业"]
+        for resource, stat in scheduler.stats().items():
+            queue_tb.add_row([resource, stat['limit'], len(stat['running']), len(stat['waiting']),
+                              int(stat['max_waiting']), int(stat['avg_wait']), "，".join(stat['waiting'])])
+    space_tb = ""
+    if space_manager is not None:
+        space_tb = pt.PrettyTable()
+        space_tb.field_names = ["目录", "占用(GB)", "直播场次"]
+        for category, stat in space_manager.stats().items():
+            space_tb.add_row(
+                [category, f"{stat['size']/1024**3:.2f}", stat['sessions']])
+        space_tb = f"磁盘剩余空间：{space_manager.free_space()/1024**3:.1f}GB\n{space_tb}"
+    logging.info(
+        f"正在工作线程数：{threading.activeCount()}\n{tb}\n{queue_tb}\n{space_tb}\n")
     # logging.info(tb)
     # logging.info("\n")
 
 
+@traced('get_words')
 def get_words(txt, topK=5):
+    import jieba
     seg_list = jieba.cut(txt)  # 对文本进行分词
     c = Counter()
     for x in seg_list:  # 进行词频统计